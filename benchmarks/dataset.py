@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-map
+# Created by the Natural History Museum in London, UK
+
+'''Synthetic specimen datasets for the benchmarks, loaded into the datastore of a
+local CKAN (with the datastore and tiledmap plugins enabled, on PostGIS).
+
+Records have Darwin Core like columns, and their coordinates are clustered around
+collecting localities, as real specimen records are. A few percent of the records
+have no coordinates.
+'''
+
+import csv
+import datetime
+import math
+import random
+import StringIO
+
+from ckanext.tiledmap.db import _get_engine
+
+from ckan.lib.cli import load_config
+from ckan.plugins import toolkit
+
+GENERA = [u'Abies', u'Betula', u'Carabus', u'Dendrobium', u'Erica', u'Felis',
+          u'Gammarus', u'Helix', u'Iris', u'Juncus', u'Lumbricus', u'Mus', u'Nepenthes',
+          u'Orchis', u'Papilio', u'Quercus', u'Rana', u'Salix', u'Turdus', u'Ulva']
+EPITHETS = [u'alba', u'borealis', u'communis', u'dentata', u'europaea', u'fusca',
+            u'grandis', u'hirsuta', u'indica', u'japonica', u'longifolia', u'major',
+            u'nigra', u'officinalis', u'pratensis', u'rubra', u'sylvestris',
+            u'vulgaris']
+COUNTRIES = [u'Brazil', u'China', u'France', u'Indonesia', u'Kenya', u'Mexico',
+             u'Peru', u'South Africa', u'United Kingdom', u'United States']
+BASES_OF_RECORD = [u'PreservedSpecimen', u'FossilSpecimen', u'HumanObservation']
+
+# Datastore fields of the synthetic resources
+FIELDS = [
+    {
+        u'id': u'occurrenceID',
+        u'type': u'text'
+        },
+    {
+        u'id': u'catalogNumber',
+        u'type': u'text'
+        },
+    {
+        u'id': u'scientificName',
+        u'type': u'text'
+        },
+    {
+        u'id': u'genus',
+        u'type': u'text'
+        },
+    {
+        u'id': u'country',
+        u'type': u'text'
+        },
+    {
+        u'id': u'basisOfRecord',
+        u'type': u'text'
+        },
+    {
+        u'id': u'recordedBy',
+        u'type': u'text'
+        },
+    {
+        u'id': u'eventDate',
+        u'type': u'text'
+        },
+    {
+        u'id': u'decimalLatitude',
+        u'type': u'numeric'
+        },
+    {
+        u'id': u'decimalLongitude',
+        u'type': u'numeric'
+        }
+    ]
+
+# Number of collecting localities the coordinates are clustered around
+LOCALITIES = 200
+
+# Number of records loaded into the database at a time
+BATCH_SIZE = 50000
+
+
+def load_ckan(config_path):
+    '''Load the CKAN configuration file, so actions can be called
+
+    :param config_path: the path of the CKAN configuration file
+    :returns: the loaded configuration
+
+    '''
+    return load_config(config_path)
+
+
+def site_context():
+    '''Return an action context of the site user, who is a sysadmin'''
+    user = toolkit.get_action(u'get_site_user')({
+        u'ignore_auth': True
+        }, {})
+    return {
+        u'user': user[u'name']
+        }
+
+
+def localities(seed):
+    '''Return the collecting localities: (latitude, longitude, spread in degrees,
+    weight) tuples, mostly on land-like latitudes
+
+    :param seed: the seed of the random number generator
+
+    '''
+    generator = random.Random(seed)
+    return [(generator.uniform(-55, 70), generator.uniform(-180, 180),
+             generator.choice([0.05, 0.5, 2, 8]), generator.paretovariate(1.2))
+            for i in range(LOCALITIES)]
+
+
+def random_records(count, seed=0):
+    '''Generate `count` synthetic specimen records
+
+    :param count: the number of records
+    :param seed: the seed of the random number generator
+    :returns: an iterator over the records, as lists of values ordered as FIELDS
+
+    '''
+    generator = random.Random(seed)
+    places = localities(seed)
+    total = sum(p[3] for p in places)
+    cumulative = []
+    position = 0
+    for place in places:
+        position += place[3] / total
+        cumulative.append(position)
+    start = datetime.date(1850, 1, 1)
+    for i in xrange(count):
+        point = generator.random()
+        place = places[min(len(places) - 1, _bisect(cumulative, point))]
+        genus = generator.choice(GENERA)
+        latitude = longitude = None
+        if generator.random() > 0.03:
+            latitude = max(-85, min(85, generator.gauss(place[0], place[2])))
+            longitude = (generator.gauss(place[1], place[2]) + 180) % 360 - 180
+        yield [
+            u'urn:benchmark:{0}'.format(i),
+            u'BM{0:08d}'.format(i),
+            u'{0} {1}'.format(genus, generator.choice(EPITHETS)),
+            genus,
+            COUNTRIES[int(abs(place[1])) % len(COUNTRIES)],
+            generator.choice(BASES_OF_RECORD),
+            u'Collector {0}'.format(int(generator.expovariate(0.05))),
+            (start + datetime.timedelta(days=generator.randint(0, 60000))).isoformat(),
+            None if latitude is None else round(latitude, 5),
+            None if longitude is None else round(longitude, 5)
+            ]
+
+
+def _bisect(values, value):
+    '''Return the index of the first of the sorted values that is greater than or equal
+    to the given value'''
+    low, high = 0, len(values)
+    while low < high:
+        middle = (low + high) // 2
+        if values[middle] < value:
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+
+def cluster_centres(seed, count=5):
+    '''Return the (latitude, longitude) of the heaviest collecting localities, where
+    the densest tiles are
+
+    :param seed: the seed the records were generated with
+    :param count: the number of localities
+
+    '''
+    places = sorted(localities(seed), key=lambda p: -p[3])
+    return [(p[0], p[1]) for p in places[:count]]
+
+
+def tile_of(latitude, longitude, z):
+    '''Return the (x, y) web mercator tile of the given point at the given zoom level
+
+    :param latitude: the latitude
+    :param longitude: the longitude
+    :param z: the zoom level
+
+    '''
+    n = 2 ** z
+    x = int((longitude + 180) / 360 * n)
+    y = int((1 - math.log(math.tan(math.radians(latitude)) +
+                          1 / math.cos(math.radians(latitude))) / math.pi) / 2 * n)
+    return min(n - 1, max(0, x)), min(n - 1, max(0, y))
+
+
+def create_resource(context, count, seed=0):
+    '''Create a dataset with a datastore resource holding `count` synthetic records.
+    The records are copied straight into the resource's table, as inserting millions
+    of records through datastore_upsert would take hours.
+
+    :param context: the action context
+    :param count: the number of records
+    :param seed: the seed of the random number generator
+    :returns: tuple (dataset id, resource id)
+
+    '''
+    dataset = toolkit.get_action(u'package_create')(dict(context), {
+        u'name': u'tiledmap-benchmark-{0}-{1}'.format(
+            count, datetime.datetime.utcnow().strftime(u'%Y%m%d%H%M%S'))
+        })
+    resource = toolkit.get_action(u'datastore_create')(dict(context), {
+        u'resource': {
+            u'package_id': dataset[u'id']
+            },
+        u'fields': FIELDS
+        })
+    columns = u', '.join(u'"{0}"'.format(f[u'id']) for f in FIELDS)
+    records = random_records(count, seed)
+    connection = _get_engine(write=True).raw_connection()
+    try:
+        cursor = connection.cursor()
+        loaded = 0
+        while loaded < count:
+            data = StringIO.StringIO()
+            writer = csv.writer(data)
+            for record in records:
+                writer.writerow([u'' if v is None else unicode(v).encode(u'utf-8')
+                                 for v in record])
+                loaded += 1
+                if loaded % BATCH_SIZE == 0:
+                    break
+            data.seek(0)
+            cursor.copy_expert(u'COPY "{0}" ({1}) FROM STDIN WITH CSV'.format(
+                resource[u'resource_id'], columns), data)
+        connection.commit()
+        cursor.execute(u'ANALYZE "{0}"'.format(resource[u'resource_id']))
+        connection.commit()
+    finally:
+        connection.close()
+    return dataset[u'id'], resource[u'resource_id']
+
+
+def view_data(resource_id):
+    '''Return the data dictionary of a tiled map view of a synthetic resource, with
+    all the map styles enabled
+
+    :param resource_id: the resource id
+
+    '''
+    return {
+        u'resource_id': resource_id,
+        u'title': u'Map',
+        u'description': u'',
+        u'view_type': u'tiledmap',
+        u'latitude_field': u'decimalLatitude',
+        u'longitude_field': u'decimalLongitude',
+        u'repeat_map': u'False',
+        u'enable_plot_map': u'True',
+        u'enable_grid_map': u'True',
+        u'enable_heat_map': u'True',
+        u'enable_utf_grid': u'True',
+        u'utf_grid_title': u'scientificName',
+        u'utf_grid_fields': [u'catalogNumber', u'country'],
+        u'plot_marker_color': u'#EE0000',
+        u'plot_marker_line_color': u'#FFFFFF',
+        u'grid_base_color': u'#F02323',
+        u'heat_intensity': u'0.1',
+        u'overlapping_records_view': u''
+        }
+
+
+def delete_dataset(context, dataset_id, resource_id):
+    '''Purge a synthetic dataset and delete its datastore table
+
+    :param context: the action context
+    :param dataset_id: the dataset id
+    :param resource_id: the resource id
+
+    '''
+    toolkit.get_action(u'datastore_delete')(dict(context), {
+        u'resource_id': resource_id,
+        u'force': True
+        })
+    toolkit.get_action(u'dataset_purge')(dict(context), {
+        u'id': dataset_id
+        })
@@ -0,0 +1,605 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-map
+# Created by the Natural History Museum in London, UK
+
+'''Load test a CKAN site's maps by replaying the requests map_view.js makes for
+concurrent users browsing a tiled map view.
+
+Usage:
+    python benchmarks/loadtest.py --url=http://127.0.0.1:5000
+        (--resource-id=<id> --view-id=<id> | --config=<ckan ini> [--rows=100000])
+        [--users=10] [--duration=60] [--ramp-up=10] [--think=2] [--connections=6]
+        [--viewport=1280x800] [--filters=<filters>] [--renderer-port=4000]
+        [--renderer-delay=0] [--database-url=<url>] [--output=results.json]
+
+Each user loads the map's info and the image and UTFGrid tiles covering its
+viewport, then, after pausing `think` seconds on average, pans, zooms in or out, or
+draws or clears a shape. Drawing a shape refreshes the map info and reloads the
+tiles with the `_tmgeom` filter, as the map does. Tiles are requested `connections`
+at a time, as by a browser.
+
+The tile proxy of the CKAN under test must be enabled (`tiledmap.tile_proxy`) and
+pointed at the stub renderer this script starts (`tiledmap.windshaft.host` and
+`tiledmap.windshaft.port`), whose responses are delayed by `renderer-delay` seconds,
+so that the load measured is the load on CKAN and its database. Use
+--renderer-port=0 to keep the site's own renderer.
+
+With --config, a synthetic resource of `rows` records (see benchmarks/dataset.py)
+and its tiled map view are created in the given CKAN, which must be the one under
+test, and deleted afterwards unless --keep is given.
+
+This prints the throughput, errors and latency percentiles of each kind of request
+and, if the database is known (given by --database-url, or the datastore's with
+--config), the database's load during the test: transactions and rows read per
+second, the buffer cache hit ratio and the number of active queries.
+'''
+
+import json
+import math
+import optparse
+import random
+import sys
+import threading
+import time
+import urlparse
+import uuid
+from multiprocessing.pool import ThreadPool
+
+import urllib3
+from ckanext.tiledmap.db import _get_engine
+from ckanext.tiledmap.lib.metrics import percentile
+from ckanext.tiledmap.lib.stub_renderer import StubRenderer
+from dataset import create_resource, delete_dataset, load_ckan, site_context, \
+    view_data
+from sqlalchemy import create_engine
+
+from ckan.plugins import toolkit
+
+TILE_SIZE = 256
+
+# Relative frequency of the users' actions
+ACTIONS = [(u'pan', 5), (u'zoom_in', 2), (u'zoom_out', 1), (u'shape', 2)]
+
+# Statistics of the database the load is measured from, for the current database
+_STATS_QUERY = u'''
+SELECT xact_commit + xact_rollback AS transactions, tup_returned, tup_fetched,
+       blks_read, blks_hit, temp_bytes
+FROM pg_stat_database
+WHERE datname = current_database()
+'''
+
+# Number of queries running on the current database, other than the monitor's
+_ACTIVITY_QUERY = u'''
+SELECT count(*)
+FROM pg_stat_activity
+WHERE datname = current_database() AND state = 'active' AND pid <> pg_backend_pid()
+'''
+
+
+def project(latitude, longitude, z):
+    '''Return the web mercator pixel coordinates of the given point at the given zoom
+    level
+
+    :param latitude: the latitude
+    :param longitude: the longitude
+    :param z: the zoom level
+    :returns: tuple (x, y)
+
+    '''
+    scale = TILE_SIZE * 2 ** z
+    sin_latitude = max(-0.9999, min(0.9999, math.sin(math.radians(latitude))))
+    return ((longitude + 180) / 360 * scale,
+            (0.5 - math.log((1 + sin_latitude) / (1 - sin_latitude)) / (4 * math.pi)) *
+            scale)
+
+
+def unproject(x, y, z):
+    '''Return the point at the given web mercator pixel coordinates
+
+    :param x: the x pixel coordinate
+    :param y: the y pixel coordinate
+    :param z: the zoom level
+    :returns: tuple (latitude, longitude)
+
+    '''
+    scale = TILE_SIZE * 2 ** z
+    n = math.pi - 2 * math.pi * y / scale
+    return math.degrees(math.atan(math.sinh(n))), x / scale * 360 - 180
+
+
+def fit_zoom(bounds, width, height, zoom_bounds, initial_zoom):
+    '''Return the zoom level the map is first shown at: the highest showing the given
+    bounds in the viewport, within the map's initial zoom constraints
+
+    :param bounds: the bounds of the records, as ((lat, lon), (lat, lon))
+    :param width: the width of the viewport, in pixels
+    :param height: the height of the viewport, in pixels
+    :param zoom_bounds: dictionary defining the min and max zoom levels
+    :param initial_zoom: dictionary defining the min and max initial zoom levels
+
+    '''
+    (lat1, lon1), (lat2, lon2) = bounds
+    z = zoom_bounds[u'min']
+    while z < zoom_bounds[u'max']:
+        x1, y1 = project(max(lat1, lat2), min(lon1, lon2), z + 1)
+        x2, y2 = project(min(lat1, lat2), max(lon1, lon2), z + 1)
+        if x2 - x1 > width or y2 - y1 > height:
+            break
+        z += 1
+    return max(initial_zoom[u'min'], min(initial_zoom[u'max'], z))
+
+
+def viewport_tiles(x, y, z, width, height, repeat_map):
+    '''Return the tiles covering the viewport centred on the given pixel coordinates
+
+    :param x: the x pixel coordinate of the centre
+    :param y: the y pixel coordinate of the centre
+    :param z: the zoom level
+    :param width: the width of the viewport, in pixels
+    :param height: the height of the viewport, in pixels
+    :param repeat_map: True if the map wraps around the antimeridian
+    :returns: list of (z, x, y) tuples
+
+    '''
+    n = 2 ** z
+    tiles = []
+    columns = range(int(math.floor((x - width / 2.0) / TILE_SIZE)),
+                    int(math.floor((x + width / 2.0) / TILE_SIZE)) + 1)
+    rows = range(max(0, int(math.floor((y - height / 2.0) / TILE_SIZE))),
+                 min(n - 1, int(math.floor((y + height / 2.0) / TILE_SIZE))) + 1)
+    for row in rows:
+        for column in columns:
+            if repeat_map:
+                column %= n
+            elif not 0 <= column < n:
+                continue
+            if (z, column, row) not in tiles:
+                tiles.append((z, column, row))
+    return tiles
+
+
+class Recorder(object):
+    '''Thread safe record of the requests made during the test'''
+
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+        self.actions = {}
+        self._lock = threading.Lock()
+
+    def request(self, kind, seconds, status):
+        '''Record a request
+
+        :param kind: the kind of request: 'map_info', 'tile' or 'grid'
+        :param seconds: the duration of the request
+        :param status: the HTTP status of the response, or None if it failed
+
+        '''
+        with self._lock:
+            self.latencies.setdefault(kind, []).append(seconds)
+            if status != 200:
+                errors = self.errors.setdefault(kind, {})
+                errors[unicode(status)] = errors.get(unicode(status), 0) + 1
+
+    def action(self, name):
+        '''Record a user action
+
+        :param name: the name of the action
+
+        '''
+        with self._lock:
+            self.actions[name] = self.actions.get(name, 0) + 1
+
+    def summary(self, elapsed):
+        '''Return the throughput, errors and latency percentiles of each kind of
+        request, and of all of them
+
+        :param elapsed: the duration of the test, in seconds
+        :returns: dictionary mapping the kinds of requests to dictionaries defining
+                  count, errors, per_second, and p50_ms, p95_ms and p99_ms
+
+        '''
+        with self._lock:
+            latencies = dict((k, list(v)) for k, v in self.latencies.items())
+            errors = dict((k, dict(v)) for k, v in self.errors.items())
+        latencies[u'all'] = sum(latencies.values(), [])
+        total_errors = {}
+        for counts in errors.values():
+            for status, count in counts.items():
+                total_errors[status] = total_errors.get(status, 0) + count
+        errors[u'all'] = total_errors
+        summary = {}
+        for kind, samples in latencies.items():
+            summary[kind] = {
+                u'count': len(samples),
+                u'errors': errors.get(kind, {}),
+                u'per_second': len(samples) / elapsed
+                }
+            for name, fraction in ((u'p50', 0.5), (u'p95', 0.95), (u'p99', 0.99)):
+                value = percentile(samples, fraction)
+                summary[kind][u'{0}_ms'.format(name)] = \
+                    None if value is None else value * 1000
+        return summary
+
+
+class DatabaseMonitor(object):
+    '''Measures the load on a database while the test runs: its statistics are read
+    when the test starts and stops, and its active queries are counted every
+    `interval` seconds in between. PostgreSQL updates the statistics every half second
+    or so, which is negligible over a test.'''
+
+    def __init__(self, engine, interval=1):
+        '''
+        :param engine: the database engine
+        :param interval: the number of seconds between samples of the active queries
+        '''
+        self.engine = engine
+        self.interval = interval
+        self.active = []
+        self._stopped = threading.Event()
+        self._thread = None
+        self._start_stats = None
+        self._started = None
+
+    def _stats(self):
+        with self.engine.connect() as connection:
+            return dict(connection.execute(_STATS_QUERY).fetchone().items())
+
+    def _sample(self):
+        with self.engine.connect() as connection:
+            while not self._stopped.wait(self.interval):
+                self.active.append(connection.execute(_ACTIVITY_QUERY).scalar())
+
+    def start(self):
+        '''Start measuring'''
+        self._start_stats = self._stats()
+        self._started = time.time()
+        self._thread = threading.Thread(target=self._sample)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        '''Stop measuring
+
+        :returns: dictionary defining transactions_per_second, rows_per_second
+                  (returned and fetched), blocks_read_per_second, cache_hit_ratio,
+                  temp_bytes, and the mean and max numbers of active queries
+
+        '''
+        self._stopped.set()
+        self._thread.join()
+        elapsed = time.time() - self._started
+        stats = self._stats()
+        delta = dict((k, stats[k] - self._start_stats[k]) for k in stats)
+        blocks = delta[u'blks_read'] + delta[u'blks_hit']
+        return {
+            u'transactions_per_second': delta[u'transactions'] / elapsed,
+            u'rows_per_second': (delta[u'tup_returned'] + delta[u'tup_fetched']) /
+                                elapsed,
+            u'blocks_read_per_second': delta[u'blks_read'] / elapsed,
+            u'cache_hit_ratio': float(delta[u'blks_hit']) / blocks if blocks else None,
+            u'temp_bytes': delta[u'temp_bytes'],
+            u'active_queries_mean': float(sum(self.active)) / len(self.active)
+            if self.active else None,
+            u'active_queries_max': max(self.active) if self.active else None
+            }
+
+
+class MapSession(object):
+    '''A user browsing a map view, replaying the requests of map_view.js'''
+
+    def __init__(self, http, options, recorder, seed):
+        '''
+        :param http: the urllib3 pool manager requests are made with
+        :param options: the command line options
+        :param recorder: the Recorder the requests are recorded in
+        :param seed: the seed of the user's random number generator
+        '''
+        self.http = http
+        self.options = options
+        self.recorder = recorder
+        self.random = random.Random(seed)
+        self.session_id = uuid.uuid4().hex
+        self.fetch_count = 0
+        self.width, self.height = [int(v) for v in options.viewport.split(u'x')]
+        self.map_info = None
+        self.geom = None
+        self.loaded = set()
+        self.x = self.y = self.z = None
+
+    def _get(self, kind, url, params):
+        '''Make a request, recording its duration and status
+
+        :returns: the response, or None if the request failed
+
+        '''
+        start = time.time()
+        try:
+            response = self.http.request(u'GET', url, fields=params, retries=False)
+        except urllib3.exceptions.HTTPError:
+            self.recorder.request(kind, time.time() - start, None)
+            return None
+        self.recorder.request(kind, time.time() - start, response.status)
+        return response
+
+    def _filters(self):
+        '''Return the filters parameter of the requests: the page's filters, and the
+        shape drawn if any'''
+        filters = [self.options.filters] if self.options.filters else []
+        if self.geom is not None:
+            filters.append(u'_tmgeom:' + self.geom)
+        return u'|'.join(filters)
+
+    def fetch_map_info(self):
+        '''Fetch the map info, as _fetchMapInfo does
+
+        :returns: True if the map can be drawn
+
+        '''
+        self.fetch_count += 1
+        params = {
+            u'resource_id': self.options.resource_id,
+            u'view_id': self.options.view_id,
+            u'fetch_id': unicode(self.fetch_count),
+            u'session': self.session_id,
+            u'filters': self._filters()
+            }
+        response = self._get(u'map_info', urlparse.urljoin(self.options.url,
+                                                            u'map-info'), params)
+        if response is None or response.status != 200:
+            return False
+        self.map_info = json.loads(response.data)
+        return self.map_info.get(u'geospatial', False)
+
+    def redraw(self, pool):
+        '''Load the tiles of the viewport that aren't loaded yet, as Leaflet does
+
+        :param pool: the thread pool the tiles are requested with
+
+        '''
+        style = self.map_info[u'map_styles'][self.map_info[u'map_style']]
+        params = {
+            u'filters': self._filters(),
+            u'style': self.map_info[u'map_style']
+            }
+        sources = [(u'tile', style[u'tile_source'])]
+        if style.get(u'has_grid') and not self.map_info.get(u'degraded'):
+            sources.append((u'grid', style[u'grid_source']))
+        requests = []
+        for z, x, y in viewport_tiles(self.x, self.y, self.z, self.width, self.height,
+                                      self.map_info.get(u'repeat_map')):
+            if (z, x, y) in self.loaded:
+                continue
+            self.loaded.add((z, x, y))
+            for kind, source in sources:
+                url = source[u'url'].format(z=z, x=x, y=y, s=self.random.choice(
+                    source.get(u'subdomains') or [u'']))
+                source_params = dict(params)
+                source_params.update(source.get(u'params') or {})
+                requests.append((kind, urlparse.urljoin(self.options.url, url),
+                                 source_params))
+        pool.map(lambda r: self._get(*r), requests)
+
+    def set_geom(self, geom, pool):
+        '''Draw or clear a shape, as setGeom does: the map info is refreshed, and the
+        tiles reloaded with the new filters
+
+        :param geom: the WKT of the shape, or None to clear it
+        :param pool: the thread pool the tiles are requested with
+
+        '''
+        self.geom = geom
+        self.fetch_map_info()
+        self.loaded = set()
+        self.redraw(pool)
+
+    def shape(self):
+        '''Return the WKT of a rectangle covering the middle of the viewport'''
+        corners = [unproject(self.x + dx * self.width / 4.0,
+                             self.y + dy * self.height / 4.0, self.z)
+                   for dx, dy in ((-1, -1), (-1, 1), (1, 1), (1, -1), (-1, -1))]
+        return u'POLYGON (({0}))'.format(u', '.join(
+            u'{0:.6f} {1:.6f}'.format(longitude, latitude)
+            for latitude, longitude in corners))
+
+    def act(self, pool):
+        '''Perform a random action
+
+        :param pool: the thread pool the tiles are requested with
+
+        '''
+        zoom_bounds = self.map_info[u'zoom_bounds']
+        total = sum(weight for name, weight in ACTIONS)
+        point = self.random.uniform(0, total)
+        for action, weight in ACTIONS:
+            point -= weight
+            if point <= 0:
+                break
+        if action == u'zoom_in' and self.z >= zoom_bounds[u'max'] or \
+                action == u'zoom_out' and self.z <= zoom_bounds[u'min']:
+            action = u'pan'
+        self.recorder.action(action)
+        if action == u'pan':
+            self.x += self.random.uniform(-0.5, 0.5) * self.width
+            self.y += self.random.uniform(-0.5, 0.5) * self.height
+            self.y = max(0, min(TILE_SIZE * 2 ** self.z, self.y))
+            self.redraw(pool)
+        elif action in (u'zoom_in', u'zoom_out'):
+            factor = 2.0 if action == u'zoom_in' else 0.5
+            self.x, self.y, self.z = self.x * factor, self.y * factor, \
+                self.z + (1 if action == u'zoom_in' else -1)
+            self.loaded = set()
+            self.redraw(pool)
+        elif self.geom is None:
+            self.set_geom(self.shape(), pool)
+        else:
+            self.set_geom(None, pool)
+
+    def run(self, deadline):
+        '''Browse the map until the deadline
+
+        :param deadline: the time at which to stop
+
+        '''
+        pool = ThreadPool(self.options.connections)
+        try:
+            while time.time() < deadline and not self.fetch_map_info():
+                time.sleep(self.options.think or 1)
+            if time.time() >= deadline:
+                return
+            bounds = self.map_info[u'bounds']
+            self.z = fit_zoom(bounds, self.width, self.height,
+                              self.map_info[u'zoom_bounds'],
+                              self.map_info[u'initial_zoom'])
+            x1, y1 = project(bounds[0][0], bounds[0][1], self.z)
+            x2, y2 = project(bounds[1][0], bounds[1][1], self.z)
+            self.x, self.y = (x1 + x2) / 2, (y1 + y2) / 2
+            self.redraw(pool)
+            while True:
+                pause = self.random.expovariate(1.0 / self.options.think) \
+                    if self.options.think else 0
+                if time.time() + pause >= deadline:
+                    break
+                time.sleep(pause)
+                self.act(pool)
+        finally:
+            pool.close()
+            pool.join()
+
+
+def run(options, engine):
+    '''Run the load test
+
+    :param options: the command line options
+    :param engine: the engine of the database whose load is measured, or None
+    :returns: dictionary defining the duration, the requests' summary (see
+              Recorder.summary), the actions and the database's load (see
+              DatabaseMonitor.stop), if measured
+
+    '''
+    http = urllib3.PoolManager(maxsize=options.users * options.connections)
+    recorder = Recorder()
+    monitor = DatabaseMonitor(engine) if engine is not None else None
+    if monitor is not None:
+        monitor.start()
+    start = time.time()
+    deadline = start + options.ramp_up + options.duration
+    threads = []
+    for i in range(options.users):
+        session = MapSession(http, options, recorder, i)
+
+        def browse(session=session, delay=i * float(options.ramp_up) / options.users):
+            time.sleep(delay)
+            session.run(deadline)
+
+        thread = threading.Thread(target=browse)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+    return {
+        u'users': options.users,
+        u'elapsed': elapsed,
+        u'requests': recorder.summary(elapsed),
+        u'actions': recorder.actions,
+        u'database': monitor.stop() if monitor is not None else None
+        }
+
+
+def report(results):
+    '''Print the results of the load test
+
+    :param results: the results, as returned by run()
+
+    '''
+    print u'{0} users for {1:.0f}s'.format(results[u'users'], results[u'elapsed'])
+    print u'{0:<10}{1:>10}{2:>10}{3:>10}{4:>10}{5:>10}{6:>10}'.format(
+        u'request', u'count', u'errors', u'req/s', u'p50 ms', u'p95 ms', u'p99 ms')
+    for kind in (u'map_info', u'tile', u'grid', u'all'):
+        summary = results[u'requests'].get(kind)
+        if summary is None or not summary[u'count']:
+            continue
+        print u'{0:<10}{1:>10}{2:>10}{3:>10.1f}{4:>10.1f}{5:>10.1f}{6:>10.1f}'.format(
+            kind, summary[u'count'], sum(summary[u'errors'].values()),
+            summary[u'per_second'], summary[u'p50_ms'], summary[u'p95_ms'],
+            summary[u'p99_ms'])
+    print u'actions: {0}'.format(u', '.join(
+        u'{0} {1}'.format(k, v) for k, v in sorted(results[u'actions'].items())))
+    database = results[u'database']
+    if database is not None:
+        print u'database: {0:.1f} transactions/s, {1:.0f} rows/s, {2:.1f} blocks ' \
+              u'read/s, {3} temp bytes, active queries {4} on average and {5} at ' \
+              u'most, cache hit ratio {6}'.format(
+                database[u'transactions_per_second'], database[u'rows_per_second'],
+                database[u'blocks_read_per_second'], database[u'temp_bytes'],
+                database[u'active_queries_mean'], database[u'active_queries_max'],
+                database[u'cache_hit_ratio'])
+
+
+def main(options):
+    '''Run the load test with the given command line options
+
+    :param options: the parsed options
+    :returns: the exit status
+
+    '''
+    engine = create_engine(options.database_url) if options.database_url else None
+    created = None
+    if options.config:
+        load_ckan(options.config)
+        context = site_context()
+        created = create_resource(context, options.rows)
+        view = toolkit.get_action(u'resource_view_create')(dict(context),
+                                                           view_data(created[1]))
+        options.resource_id, options.view_id = created[1], view[u'id']
+        engine = engine or _get_engine()
+    renderer = None
+    if options.renderer_port:
+        renderer = StubRenderer(port=options.renderer_port,
+                                delay=options.renderer_delay)
+        renderer.start()
+    try:
+        results = run(options, engine)
+    finally:
+        if renderer is not None:
+            renderer.stop()
+        if created is not None and not options.keep:
+            delete_dataset(context, *created)
+    report(results)
+    if options.output:
+        with open(options.output, u'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    return 0 if not results[u'requests'][u'all'][u'errors'] else 1
+
+
+if __name__ == u'__main__':
+    parser = optparse.OptionParser(usage=__doc__)
+    parser.add_option(u'--url', dest=u'url', default=u'http://127.0.0.1:5000')
+    parser.add_option(u'--resource-id', dest=u'resource_id')
+    parser.add_option(u'--view-id', dest=u'view_id')
+    parser.add_option(u'--config', dest=u'config')
+    parser.add_option(u'--rows', dest=u'rows', type=u'int', default=100000)
+    parser.add_option(u'--keep', dest=u'keep', action=u'store_true', default=False)
+    parser.add_option(u'--users', dest=u'users', type=u'int', default=10)
+    parser.add_option(u'--duration', dest=u'duration', type=u'float', default=60)
+    parser.add_option(u'--ramp-up', dest=u'ramp_up', type=u'float', default=10)
+    parser.add_option(u'--think', dest=u'think', type=u'float', default=2)
+    parser.add_option(u'--connections', dest=u'connections', type=u'int', default=6)
+    parser.add_option(u'--viewport', dest=u'viewport', default=u'1280x800')
+    parser.add_option(u'--filters', dest=u'filters', default=u'')
+    parser.add_option(u'--renderer-port', dest=u'renderer_port', type=u'int',
+                      default=4000)
+    parser.add_option(u'--renderer-delay', dest=u'renderer_delay', type=u'float',
+                      default=0)
+    parser.add_option(u'--database-url', dest=u'database_url')
+    parser.add_option(u'--output', dest=u'output')
+    options, args = parser.parse_args()
+    if not options.config and not (options.resource_id and options.view_id):
+        parser.error(u'--resource-id and --view-id, or --config, are required')
+    if not options.url.endswith(u'/'):
+        options.url += u'/'
+    sys.exit(main(options))
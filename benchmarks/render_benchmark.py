@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-map
+# Created by the Natural History Museum in London, UK
+
+'''Benchmark the builtin renderer on tiles of 10k, 100k and 1M random points.
+
+Usage:
+    python benchmarks/render_benchmark.py [--repeat=5]
+
+For each style and number of points, this prints the best time taken to render and
+encode a tile out of `repeat` runs. The `raster` style is the heatmap drawn from a
+point store's density raster rather than from the points.
+'''
+
+import optparse
+import time
+
+import numpy
+from ckanext.tiledmap.config import config
+from ckanext.tiledmap.lib.occupancy import MERCATOR_EXTENT
+from ckanext.tiledmap.lib.pointstore import density_rasters, morton_coordinates
+from ckanext.tiledmap.lib.render import TILE_SIZE, gradient_table, parse_color, \
+    render_density, render_gridded, render_heatmap, render_plot, to_png
+
+SIZES = [10000, 100000, 1000000]
+
+# The tile the points are generated in
+Z, X, Y = 10, 511, 340
+
+
+def random_points(count, seed=0):
+    '''Return `count` points spread over the benchmark tile and the margin around it,
+    clustered as specimen records usually are
+
+    :param count: the number of points
+    :param seed: the seed of the random number generator
+
+    '''
+    random = numpy.random.RandomState(seed)
+    size = 2 * MERCATOR_EXTENT / 2 ** Z
+    left = X * size - MERCATOR_EXTENT
+    top = MERCATOR_EXTENT - Y * size
+    centres = random.uniform(-0.05, 1.05, size=(50, 2))
+    picked = centres[random.randint(0, len(centres), size=count)]
+    points = picked + random.normal(scale=0.1, size=(count, 2))
+    return left + points[:, 0] * size, top - points[:, 1] * size
+
+
+def raster_pixels(mx, my):
+    '''Return the pixels of the density raster one zoom level below the benchmark
+    tile, as the point store would hold them, relative to the tile
+
+    :param mx: array of web mercator x coordinates
+    :param my: array of web mercator y coordinates
+    :returns: tuple (px, py, counts) of arrays
+
+    '''
+    zoom, keys, counts = next(density_rasters(mx.astype(numpy.float64),
+                                              my.astype(numpy.float64), [Z + 1]))
+    columns, rows = morton_coordinates(keys)
+    return columns / 2.0 - X * TILE_SIZE, rows / 2.0 - Y * TILE_SIZE, counts
+
+
+def styles():
+    '''Return the styles to benchmark, as (name, preparation, rendering) tuples: the
+    preparation function is given (mx, my) and isn't timed, and the rendering function
+    is given the items of the tuple it returns'''
+    fill = parse_color(config[u'tiledmap.style.plot.fill_color'])
+    line = parse_color(config[u'tiledmap.style.plot.line_color'])
+    base = parse_color(config[u'tiledmap.style.gridded.base_color'])
+    gradient = gradient_table(config[u'tiledmap.style.heatmap.gradient'])
+    heatmap_size = int(config[u'tiledmap.style.heatmap.marker_size'])
+    intensity = float(config[u'tiledmap.style.heatmap.intensity'])
+    points = lambda mx, my: (mx, my)
+    return [
+        (u'plot', points, lambda mx, my: render_plot(
+            mx, my, Z, X, Y, int(config[u'tiledmap.style.plot.marker_size']), fill,
+            line)),
+        (u'gridded', points, lambda mx, my: render_gridded(
+            mx, my, Z, X, Y, int(config[u'tiledmap.style.gridded.grid_resolution']),
+            base)),
+        (u'heatmap', points, lambda mx, my: render_heatmap(
+            mx, my, Z, X, Y, heatmap_size, intensity, gradient)),
+        (u'raster', raster_pixels, lambda px, py, counts: render_density(
+            px, py, counts, heatmap_size, intensity, gradient))
+        ]
+
+
+def benchmark(repeat):
+    '''Run the benchmark, printing the results
+
+    :param repeat: the number of runs of each case
+
+    '''
+    print u'{0:<10}{1:>10}{2:>12}{3:>14}'.format(u'style', u'points', u'ms/tile',
+                                                 u'points/s')
+    for count in SIZES:
+        mx, my = random_points(count)
+        mx = mx.astype(numpy.float32)
+        my = my.astype(numpy.float32)
+        for name, prepare, render in styles():
+            data = prepare(mx, my)
+            best = None
+            for i in range(repeat):
+                start = time.time()
+                to_png(render(*data))
+                duration = time.time() - start
+                best = duration if best is None else min(best, duration)
+            print u'{0:<10}{1:>10}{2:>12.1f}{3:>14.0f}'.format(name, count,
+                                                               best * 1000,
+                                                               count / best)
+
+
+if __name__ == u'__main__':
+    parser = optparse.OptionParser(usage=__doc__)
+    parser.add_option(u'--repeat', dest=u'repeat', type=u'int', default=5)
+    options, args = parser.parse_args()
+    benchmark(options.repeat)
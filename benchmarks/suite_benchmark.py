@@ -0,0 +1,340 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-map
+# Created by the Natural History Museum in London, UK
+
+'''Benchmark the map endpoints and maintenance of synthetic resources of 10k to 10M
+specimen records (see benchmarks/dataset.py).
+
+Usage:
+    python benchmarks/suite_benchmark.py --config=/etc/ckan/default/development.ini
+        [--rows=10000,100000] [--repeat=20] [--output=results.json]
+        [--compare=baseline.json] [--tolerance=1.25] [--keep]
+
+The CKAN configuration must enable the datastore and tiledmap plugins, on a PostGIS
+database the benchmark resources can be created in. For each number of rows, this
+loads a resource, creates its tiled map view (timing the validation of the latitude
+and longitude fields and the population of the geometries), then times map-info
+requests with and without filters, the parsing of the request filters, and the tile
+and UTFGrid endpoints of the tile proxy, which are pointed at a stub renderer so that
+only the work done by CKAN is timed.
+
+The results are printed and, with --output, saved as JSON. With --compare, the median
+durations are compared to those of an earlier run: the cases more than `tolerance`
+times slower are listed, and the script exits with status 1.
+'''
+
+import datetime
+import json
+import optparse
+import sys
+import time
+import urllib
+
+import pkg_resources
+import webtest
+from ckanext.tiledmap.config import config as tm_config
+from ckanext.tiledmap.lib.filters import parse_filters
+from ckanext.tiledmap.lib.metrics import percentile
+from ckanext.tiledmap.lib.stub_renderer import StubRenderer
+from ckanext.tiledmap.lib.timing import MemorySink, set_sink
+from dataset import cluster_centres, create_resource, delete_dataset, load_ckan, \
+    site_context, tile_of, view_data
+
+from ckan import model, plugins
+from ckan.common import config
+from ckan.config.middleware import make_app
+from ckan.plugins import toolkit
+
+# Spans of the view creation reported as cases (see ckanext.tiledmap.lib.timing)
+VIEW_SPANS = [u'validate.latitude_field', u'validate.longitude_field',
+              u'geometry.create_columns', u'geometry.populate_columns',
+              u'geometry.refresh_resource']
+
+# Zoom levels the tiles are requested at
+TILE_ZOOMS = [2, 6, 10]
+
+# Number of calls timed by each sample of the filter parsing cases
+PARSE_CALLS = 1000
+
+# Request filters, as sent by the map when a user filters the records and draws a
+# shape. The shape is drawn around the densest collecting locality.
+SPECIES_FILTERS = u'scientificName:Abies alba|basisOfRecord:PreservedSpecimen'
+SHAPE_FILTERS = u'_tmgeom:POLYGON(({0} {1}, {0} {3}, {2} {3}, {2} {1}, {0} {1}))'
+
+
+def summarise(samples):
+    '''Return the summary of the given durations
+
+    :param samples: list of durations, in seconds
+    :returns: dictionary defining count, and min_ms, p50_ms and p95_ms in milliseconds
+
+    '''
+    return {
+        u'count': len(samples),
+        u'min_ms': min(samples) * 1000,
+        u'p50_ms': percentile(samples, 0.5) * 1000,
+        u'p95_ms': percentile(samples, 0.95) * 1000
+        }
+
+
+def measure(function, repeat):
+    '''Return the durations of `repeat` calls to the given function
+
+    :param function: function taking no parameters
+    :param repeat: the number of calls
+    :returns: list of durations, in seconds
+
+    '''
+    samples = []
+    for i in range(repeat):
+        start = time.time()
+        function()
+        samples.append(time.time() - start)
+    return samples
+
+
+def shape_filters(seed):
+    '''Return the filters of a shape of one by one degrees drawn around the densest
+    collecting locality
+
+    :param seed: the seed the records were generated with
+
+    '''
+    latitude, longitude = cluster_centres(seed, 1)[0]
+    return SHAPE_FILTERS.format(max(-180, longitude - 0.5), max(-85, latitude - 0.5),
+                                min(180, longitude + 0.5), min(85, latitude + 0.5))
+
+
+def benchmark_view(context, resource_id, repeat):
+    '''Create the tiled map view of the given resource, and time the validation of
+    its latitude and longitude fields
+
+    :param context: the action context
+    :param resource_id: the resource id
+    :param repeat: the number of runs of the validation cases
+    :returns: tuple (view, results), where results maps case names to summaries
+
+    '''
+    sink = MemorySink()
+    set_sink(sink)
+    try:
+        start = time.time()
+        view = toolkit.get_action(u'resource_view_create')(dict(context),
+                                                           view_data(resource_id))
+        duration = time.time() - start
+    finally:
+        set_sink(None)
+    results = {
+        u'view_create': summarise([duration])
+        }
+    for name in VIEW_SPANS:
+        durations = [d for n, d in sink.spans if n == name]
+        if durations:
+            results[name] = summarise(durations)
+    # The validators only run once when the view is created
+    plugin = plugins.get_plugin(u'tiledmap')
+    validator_context = {
+        u'resource': model.Resource.get(resource_id)
+        }
+    results[u'validate.latitude_field'] = summarise(measure(
+        lambda: plugin._is_latitude_field(u'decimalLatitude', validator_context),
+        repeat))
+    results[u'validate.longitude_field'] = summarise(measure(
+        lambda: plugin._is_longitude_field(u'decimalLongitude', validator_context),
+        repeat))
+    return view, results
+
+
+def benchmark_filters(seed, repeat):
+    '''Time the parsing of the request filters, as done by every map request
+
+    :param seed: the seed the records were generated with
+    :param repeat: the number of samples
+    :returns: dictionary mapping case names to summaries, in milliseconds per call
+
+    '''
+    results = {}
+    cases = [
+        (u'parse_filters.species', urllib.quote(SPECIES_FILTERS)),
+        (u'parse_filters.shape', urllib.quote(u'|'.join([SPECIES_FILTERS,
+                                                         shape_filters(seed)])))
+        ]
+    for name, filters in cases:
+        def parse():
+            for i in xrange(PARSE_CALLS):
+                parse_filters(filters)
+
+        samples = [s / PARSE_CALLS for s in measure(parse, repeat)]
+        results[name] = summarise(samples)
+    return results
+
+
+def benchmark_requests(app, resource_id, view_id, seed, repeat):
+    '''Time the map-info requests, and the tile and UTFGrid requests of the tile proxy,
+    unfiltered and filtered
+
+    :param app: the test application
+    :param resource_id: the resource id
+    :param view_id: the view id
+    :param seed: the seed the records were generated with
+    :param repeat: the number of requests of each case
+    :returns: dictionary mapping case names to summaries
+
+    '''
+    results = {}
+    filters = [
+        (u'unfiltered', None),
+        (u'species', SPECIES_FILTERS),
+        (u'shape', shape_filters(seed))
+        ]
+    latitude, longitude = cluster_centres(seed, 1)[0]
+
+    def request(path, filter_value):
+        params = {
+            u'resource_id': resource_id,
+            u'view_id': view_id,
+            u'style': u'plot'
+            }
+        if filter_value is not None:
+            params[u'filters'] = filter_value.encode(u'utf-8')
+        return lambda: app.get(path, params=params)
+
+    renderer = StubRenderer()
+    renderer.start()
+    saved_config = dict(tm_config)
+    tm_config.update({
+        u'tiledmap.tile_proxy': u'true',
+        u'tiledmap.tile_cache.dir': u'',
+        u'tiledmap.windshaft.hosts': u'',
+        u'tiledmap.windshaft.host': renderer.host,
+        u'tiledmap.windshaft.port': unicode(renderer.port)
+        })
+    try:
+        for name, filter_value in filters:
+            results[u'map_info.{0}'.format(name)] = summarise(
+                measure(request(u'/map-info', filter_value), repeat))
+            for z in TILE_ZOOMS:
+                x, y = tile_of(latitude, longitude, z)
+                results[u'tile.{0}.z{1}'.format(name, z)] = summarise(measure(
+                    request(u'/map-tile/{0}/{1}/{2}.png'.format(z, x, y),
+                            filter_value), repeat))
+                results[u'grid.{0}.z{1}'.format(name, z)] = summarise(measure(
+                    request(u'/map-grid/{0}/{1}/{2}.grid.json'.format(z, x, y),
+                            filter_value), repeat))
+    finally:
+        tm_config.clear()
+        tm_config.update(saved_config)
+        renderer.stop()
+    return results
+
+
+def benchmark(rows, repeat, keep):
+    '''Run the benchmark, printing the results
+
+    :param rows: list of the numbers of rows of the resources
+    :param repeat: the number of runs of each case
+    :param keep: True to keep the resources created
+    :returns: dictionary mapping the numbers of rows to dictionaries mapping case names
+              to summaries
+
+    '''
+    app = webtest.TestApp(make_app(config[u'global_conf'], **config))
+    context = site_context()
+    results = {}
+    for count in rows:
+        seed = count
+        start = time.time()
+        dataset_id, resource_id = create_resource(context, count, seed)
+        cases = {
+            u'load': summarise([time.time() - start])
+            }
+        try:
+            view, view_results = benchmark_view(context, resource_id, repeat)
+            cases.update(view_results)
+            cases.update(benchmark_filters(seed, repeat))
+            cases.update(benchmark_requests(app, resource_id, view[u'id'], seed,
+                                            repeat))
+        finally:
+            if not keep:
+                delete_dataset(context, dataset_id, resource_id)
+        results[unicode(count)] = cases
+        print u'{0} rows'.format(count)
+        print u'{0:<32}{1:>12}{2:>12}{3:>12}'.format(u'case', u'min ms', u'p50 ms',
+                                                      u'p95 ms')
+        for name in sorted(cases):
+            print u'{0:<32}{1:>12.2f}{2:>12.2f}{3:>12.2f}'.format(
+                name, cases[name][u'min_ms'], cases[name][u'p50_ms'],
+                cases[name][u'p95_ms'])
+        print
+    return results
+
+
+def compare(results, baseline, tolerance):
+    '''Return the cases of the results whose median duration regressed compared to the
+    baseline
+
+    :param results: the results, as returned by benchmark()
+    :param baseline: the results of an earlier run
+    :param tolerance: the ratio of the median durations above which a case regressed
+    :returns: list of (rows, case, baseline p50, p50) tuples
+
+    '''
+    regressions = []
+    for rows, cases in sorted(results.items()):
+        for name, summary in sorted(cases.items()):
+            previous = baseline.get(rows, {}).get(name)
+            if previous is not None and \
+                    summary[u'p50_ms'] > previous[u'p50_ms'] * tolerance:
+                regressions.append((rows, name, previous[u'p50_ms'],
+                                    summary[u'p50_ms']))
+    return regressions
+
+
+def main(options):
+    '''Run the benchmark with the given command line options
+
+    :param options: the parsed options
+    :returns: the exit status
+
+    '''
+    load_ckan(options.config)
+    rows = [int(r) for r in options.rows.split(u',')]
+    results = benchmark(rows, options.repeat, options.keep)
+    if options.output:
+        with open(options.output, u'w') as f:
+            json.dump({
+                u'version': pkg_resources.get_distribution(u'ckanext-tiledmap').version,
+                u'created': datetime.datetime.utcnow().isoformat(),
+                u'repeat': options.repeat,
+                u'results': results
+                }, f, indent=2, sort_keys=True)
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline[u'results'], options.tolerance)
+        print u'Compared to {0} ({1}):'.format(baseline[u'version'],
+                                               baseline[u'created'])
+        for rows, name, previous, current in regressions:
+            print u'  {0} rows, {1}: {2:.2f}ms -> {3:.2f}ms'.format(rows, name,
+                                                                  previous, current)
+        if regressions:
+            return 1
+        print u'  no regressions'
+    return 0
+
+
+if __name__ == u'__main__':
+    parser = optparse.OptionParser(usage=__doc__)
+    parser.add_option(u'--config', dest=u'config')
+    parser.add_option(u'--rows', dest=u'rows', default=u'10000,100000')
+    parser.add_option(u'--repeat', dest=u'repeat', type=u'int', default=20)
+    parser.add_option(u'--output', dest=u'output')
+    parser.add_option(u'--compare', dest=u'compare')
+    parser.add_option(u'--tolerance', dest=u'tolerance', type=u'float', default=1.25)
+    parser.add_option(u'--keep', dest=u'keep', action=u'store_true', default=False)
+    options, args = parser.parse_args()
+    if not options.config:
+        parser.error(u'--config is required')
+    sys.exit(main(options))
@@ -7,6 +7,12 @@
 import logging
 
 import sqlalchemy
+from ckanext.tiledmap.lib.maintenance import build_stores, refresh_resource, \
+    reorder_resource
+from ckanext.tiledmap.lib.query import geom_field, geom_field_4326
+from ckanext.tiledmap.lib.seed import seed
+from ckanext.tiledmap.lib.slowlog import query_context
+from ckanext.tiledmap.lib.views import get_tiledmap_views
 from sqlalchemy import func
 from sqlalchemy.sql import select
 
@@ -18,10 +24,35 @@ log = logging.getLogger(u'ckan')
 class AddGeomCommand(toolkit.CkanCommand):
     '''Commands:
         paster ckanextmap add-all-geoms -c /etc/ckan/default/development.ini
+        paster ckanextmap seed-tiles [<resource_id> ...] [--styles=plot,gridded]
+            [--min-zoom=0] [--max-zoom=6] [--workers=4] [--force]
+            -c /etc/ckan/default/development.ini
+        paster ckanextmap reorder-tables [<resource_id> ...] [--force]
+            [--min-correlation=0.9] -c /etc/ckan/default/development.ini
+        paster ckanextmap build-stores [<resource_id> ...]
+            -c /etc/ckan/default/development.ini
     
     Where:
         <config> = path to your ckan config file
+        <resource_id> = resources whose tiles are seeded, tables are reordered or
+            stores are built. Defaults to all the resources with a tiled map view.
     
+    seed-tiles pre-renders the tiles of the unfiltered maps, storing them in the tile
+    cache (see tiledmap.tile_cache.dir). Tiles that are already cached are skipped,
+    unless --force is given, so an interrupted run can be resumed by running the
+    command again.
+
+    reorder-tables stores the rows of each resource's side table (see
+    tiledmap.side_table), or of its table if it has none, in the order of the Hilbert
+    key of their geometries, so neighbouring records are read together. Tables that
+    are still mostly in order are skipped, unless --force is given, so the command can
+    be run periodically. Tables are locked while they are being reordered.
+
+    build-stores builds the side table (see tiledmap.side_table) and the point store
+    (see tiledmap.point_store.dir) of each resource. They are otherwise built by a
+    background job when the geometries of a resource are populated, which needs CKAN
+    2.7 or later and a running jobs worker.
+
     The commands should be run from the ckanext-map directory.
 
     '''
@@ -30,6 +61,26 @@ class AddGeomCommand(toolkit.CkanCommand):
     usage = __doc__
     counter = 0
 
+    parser = toolkit.CkanCommand.standard_parser(verbose=True)
+    parser.add_option(u'-c', u'--config', dest=u'config',
+                      help=u'Config file to use.')
+    parser.add_option(u'--styles', dest=u'styles', default=None,
+                      help=u'Comma separated list of map styles to seed. Defaults to '
+                           u'the styles enabled on each view.')
+    parser.add_option(u'--min-zoom', dest=u'min_zoom', type=u'int', default=0,
+                      help=u'Lowest zoom level to seed.')
+    parser.add_option(u'--max-zoom', dest=u'max_zoom', type=u'int', default=6,
+                      help=u'Highest zoom level to seed.')
+    parser.add_option(u'--workers', dest=u'workers', type=u'int', default=4,
+                      help=u'Number of tiles rendered concurrently.')
+    parser.add_option(u'--force', dest=u'force', action=u'store_true', default=False,
+                      help=u'Render tiles that are already cached again, or reorder '
+                           u'tables that are already in order.')
+    parser.add_option(u'--min-correlation', dest=u'min_correlation', type=u'float',
+                      default=0.9,
+                      help=u'Correlation between the physical and the key order of a '
+                           u'table above which it is not reordered.')
+
     def command(self):
         '''Parse command line arguments and call appropriate method.'''
         if not self.args or self.args[0] in [u'--help', u'-h', u'help']:
@@ -76,7 +127,11 @@ class AddGeomCommand(toolkit.CkanCommand):
 
                 has_col = False
                 inspector = sqlalchemy.inspect(self.datastore_db_engine)
-                cols = inspector.get_columns(resource[u'id'])
+                try:
+                    cols = inspector.get_columns(resource[u'id'])
+                except sqlalchemy.exc.NoSuchTableError:
+                    # Not in the datastore
+                    continue
                 for col in cols:
                     if col[u'name'] == u'latitude':
                         has_col = True
@@ -84,42 +139,95 @@ class AddGeomCommand(toolkit.CkanCommand):
                 log.info(u'Has latitude column: ' + str(has_col))
 
                 if has_col:
-                    # We need to wrap things in a transaction, since SQLAlchemy thinks
-                    # that all selects (including AddGeometryColumn) should be rolled
-                    # back when the connection terminates.
-                    connection = self.datastore_db_engine.connect()
-                    trans = connection.begin()
-
-                    # Use these to remove the columns, if you're doing development things
-                    # connection.execute(sqlalchemy.text("select DropGeometryColumn('"
-                    # + resource['id'] + "', 'geom')"))
-                    # connection.execute(sqlalchemy.text("select DropGeometryColumn('"
-                    # + resource['id'] + "', 'the_geom_webmercator')"))
-
-                    # Add the two geometry columns - one in degrees (EPSG:4326) and one
-                    # in spherical mercator metres (EPSG:3857)
-                    # the_geom_webmercator is used for windshaft
-                    s = select([func.AddGeometryColumn(u'public', resource[u'id'],
-                                                       u'geom', 4326, u'POINT', 2)])
-                    connection.execute(s)
-                    s = select([func.AddGeometryColumn(u'public', resource[u'id'],
-                                                       u'the_geom_webmercator', 3857,
-                                                       u'POINT', 2)])
-                    connection.execute(s)
-
-                    # Create geometries from the latitude and longitude columns. Note
-                    # the bits and pieces of data cleaning that are required!
-                    # This could, in theory, be converted to SQLAlchemy commands but
-                    # LIFEISTOOSHORT
-                    s = sqlalchemy.text(u'update \"' + resource[
-                        u'id'] + u"\" set geom = st_setsrid(st_makepoint("
-                                 u"longitude::float8, latitude::float8), 4326) where "
-                                 u"latitude is not null and latitude != '' and "
-                                 u"latitude not like '%{%'")
-                    connection.execute(s)
-                    s = sqlalchemy.text(u'update \"' + resource[
-                        u'id'] + u'\" set the_geom_webmercator = st_transform(geom, '
-                                 u'3857) where y(geom) < 90 and y(geom) > -90')
-                    connection.execute(s)
-
-                    trans.commit()
+                    # Slow population statements are logged (see
+                    # ckanext.tiledmap.lib.slowlog)
+                    with query_context(resource[u'id']):
+                        self._populate_geoms(resource[u'id'])
+                    refresh_resource(resource[u'id'], populated=True)
+
+    def _populate_geoms(self, resource_id):
+        '''Add the geometry columns to the given resource's table, and populate them
+        from its latitude and longitude columns
+
+        :param resource_id: the resource id
+
+        '''
+        # We need to wrap things in a transaction, since SQLAlchemy thinks that all
+        # selects (including AddGeometryColumn) should be rolled back when the
+        # connection terminates.
+        connection = self.datastore_db_engine.connect()
+        trans = connection.begin()
+
+        # Use these to remove the columns, if you're doing development things
+        # connection.execute(sqlalchemy.text("select DropGeometryColumn('"
+        # + resource['id'] + "', 'geom')"))
+        # connection.execute(sqlalchemy.text("select DropGeometryColumn('"
+        # + resource['id'] + "', 'the_geom_webmercator')"))
+
+        # Add the two geometry columns - one in degrees (EPSG:4326) and one in
+        # spherical mercator metres (EPSG:3857), named as configured so the map
+        # statistics and the tile queries find them
+        # The web mercator column is used for windshaft
+        s = select([func.AddGeometryColumn(u'public', resource_id, geom_field_4326(),
+                                           4326, u'POINT', 2)])
+        connection.execute(s)
+        s = select([func.AddGeometryColumn(u'public', resource_id, geom_field(), 3857,
+                                           u'POINT', 2)])
+        connection.execute(s)
+
+        # Create geometries from the latitude and longitude columns. Note the bits and
+        # pieces of data cleaning that are required!
+        # This could, in theory, be converted to SQLAlchemy commands but LIFEISTOOSHORT
+        s = sqlalchemy.text(u'update "{table}" set "{geom}" = st_setsrid('
+                            u'st_makepoint(longitude::float8, latitude::float8), 4326) '
+                            u"where latitude is not null and latitude != '' and "
+                            u"latitude not like '%{{%'".format(table=resource_id,
+                                                               geom=geom_field_4326()))
+        connection.execute(s)
+        s = sqlalchemy.text(u'update "{table}" set "{geom}" = st_transform('
+                            u'"{geom_4326}", 3857) where y("{geom_4326}") < 90 and '
+                            u'y("{geom_4326}") > -90'.format(
+                                table=resource_id, geom=geom_field(),
+                                geom_4326=geom_field_4326()))
+        connection.execute(s)
+
+        trans.commit()
+
+    def seed_tiles(self):
+        '''Pre-render the tiles of the given resources' tiled map views, or of all
+        the tiled map views'''
+        views = get_tiledmap_views(self.context, self.args[1:] or None)
+        styles = None
+        if self.options.styles:
+            styles = self.options.styles.split(u',')
+        seed(views, styles, self.options.min_zoom, self.options.max_zoom,
+             self.options.workers, self.options.force)
+
+    def reorder_tables(self):
+        '''Reorder the tables of the given resources, or of all the resources with a
+        tiled map view, by the Hilbert key of their geometries'''
+        resource_ids = self._view_resource_ids()
+        for i, resource_id in enumerate(resource_ids):
+            log.info(u'Resource %s of %s: %s', i + 1, len(resource_ids), resource_id)
+            try:
+                reorder_resource(resource_id, self.options.force,
+                                 self.options.min_correlation)
+            except sqlalchemy.exc.DBAPIError:
+                log.exception(u'Failed to reorder resource %s', resource_id)
+
+    def build_stores(self):
+        '''Build the side tables and point stores of the given resources, or of all the
+        resources with a tiled map view'''
+        resource_ids = self._view_resource_ids()
+        for i, resource_id in enumerate(resource_ids):
+            log.info(u'Resource %s of %s: %s', i + 1, len(resource_ids), resource_id)
+            build_stores(resource_id)
+
+    def _view_resource_ids(self):
+        '''Return the ids of the resources given on the command line that have a tiled
+        map view, or of all the resources with a tiled map view, without duplicates'''
+        resource_ids = []
+        for view in get_tiledmap_views(self.context, self.args[1:] or None):
+            if view[u'resource_id'] not in resource_ids:
+                resource_ids.append(view[u'resource_id'])
+        return resource_ids
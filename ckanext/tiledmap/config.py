@@ -56,5 +56,162 @@ config = {
 
     # Templates used for hover and click information on the map.
     u'tiledmap.info_template': u'point_detail',
-    u'tiledmap.quick_info_template': u'point_detail_hover'
+    u'tiledmap.quick_info_template': u'point_detail_hover',
+
+    # Names of the geometry columns. These must match the columns created by
+    # ckanext-dataspatial.
+    u'tiledmap.geom_field': u'_the_geom_webmercator',
+    u'tiledmap.geom_field_4326': u'_geom',
+
+    # Number of records fetched from the database at a time when exporting records.
+    # This bounds the memory used by an export, whatever the number of records.
+    u'tiledmap.export.batch_size': u'1000',
+
+    # Counting the records matching the map filters requires a full scan on large,
+    # weakly filtered resources. When enabled, the counts are estimated from the table
+    # statistics instead, unless fewer than `exact_threshold` records are expected to
+    # match, in which case exact counts are computed.
+    u'tiledmap.count.estimate': u'false',
+    u'tiledmap.count.exact_threshold': u'100000',
+
+    # Resolution, in degrees, of the coarse histogram of geometries stored with the
+    # statistics computed when a resource's geometries are populated. Set to 0 to
+    # disable the histogram.
+    u'tiledmap.stats.histogram_resolution': u'0',
+
+    # Concurrent identical map requests are coalesced so they share a single
+    # computation. The backend is one of 'local' (within each process), 'file' (across
+    # the processes of a host, using lock files in `lock_dir`, which defaults to a
+    # directory in the system's temporary directory) or 'none'. With the 'file'
+    # backend, results are shared between processes for `result_ttl` seconds, and
+    # requests wait up to `wait_timeout` seconds on the same request in another process
+    # before failing. Concurrent requests for the same proxied tile are coalesced too,
+    # up to the `tile_max_zoom` zoom level (-1 to disable), as the tiles of the first
+    # zoom levels are requested by every visitor.
+    u'tiledmap.coalesce.backend': u'local',
+    u'tiledmap.coalesce.result_ttl': u'2',
+    u'tiledmap.coalesce.wait_timeout': u'30',
+    u'tiledmap.coalesce.tile_max_zoom': u'10',
+
+    # Maximum time, in milliseconds, a map query may run for. 0 means no limit.
+    u'tiledmap.query.statement_timeout': u'0',
+
+    # When enabled, map tiles are requested from CKAN (at /map-tile and /map-grid),
+    # which streams them from the renderer, rather than from the renderer directly.
+    # The renderer then need not be publicly reachable. Connections to the renderer
+    # are kept alive and pooled: at most `max_connections` requests are made to the
+    # renderer at once by each process, and requests wait up to `pool_timeout`
+    # seconds for a connection. Responses are streamed in chunks of `chunk_size`
+    # bytes.
+    u'tiledmap.tile_proxy': u'false',
+    u'tiledmap.tile_proxy.max_connections': u'10',
+    u'tiledmap.tile_proxy.pool_timeout': u'5',
+    u'tiledmap.tile_proxy.connect_timeout': u'2',
+    u'tiledmap.tile_proxy.read_timeout': u'30',
+    u'tiledmap.tile_proxy.chunk_size': u'16384',
+
+    # Several renderers can be listed, as space separated 'host:port' entries, in
+    # `tiledmap.windshaft.hosts` (which then takes precedence over
+    # `tiledmap.windshaft.host` and `tiledmap.windshaft.port`). Tiles are assigned to
+    # renderers by consistent hashing, so each renderer caches its own share of the
+    # tiles. When a renderer can't be reached, its tiles are served by the next
+    # renderer on the ring.
+    u'tiledmap.windshaft.hosts': u'',
+
+    # Each renderer is guarded by a circuit breaker when tiles are proxied. Responses
+    # that fail, are server errors or take more than `slow_call` seconds count as
+    # failures. Once `max_failures` of the last `window` responses of a renderer have
+    # failed, the renderer is not called for `reset_timeout` seconds, after which a
+    # single trial request decides whether it is called again.
+    u'tiledmap.circuit.window': u'20',
+    u'tiledmap.circuit.max_failures': u'5',
+    u'tiledmap.circuit.slow_call': u'5',
+    u'tiledmap.circuit.reset_timeout': u'30',
+
+    # Directory in which proxied tiles are cached. When the renderers are unavailable,
+    # the cached tiles are served (even if they are stale), or placeholders if there
+    # are none. Leave empty to disable the cache. Cached tiles are served without
+    # calling the renderers for `ttl` seconds. They are discarded whenever the records
+    # of their resource change.
+    u'tiledmap.tile_cache.dir': u'',
+    u'tiledmap.tile_cache.ttl': u'86400',
+
+    # Bitmaps of the tiles that contain geometries are built for each resource, for
+    # zoom levels up to this one, when its geometries are populated. The tile proxy
+    # answers requests for empty tiles of unfiltered maps without calling the
+    # renderers. Each zoom level takes 4^zoom bits. Set to -1 to disable.
+    u'tiledmap.occupancy.max_zoom': u'10',
+
+    # Maintain a narrow copy of each resource's record ids, geometries and map view
+    # fields, stored in Hilbert curve order, when its geometries are populated. Tiles and
+    # counts of maps that are unfiltered or only filtered by the drawn selection are
+    # computed from it, which reads far fewer pages than the full resource table.
+    u'tiledmap.side_table': u'false',
+
+    # Directory in which the coordinates and ids of each resource's points are
+    # snapshotted, as memory mappable arrays, when its geometries are populated (this
+    # requires numpy). Points are grouped by their tile at the `zoom` level, and the
+    # points of any tile can then be read without querying the database. The offset
+    # index of each resource takes 8 * 4^zoom bytes. Leave empty to disable.
+    u'tiledmap.point_store.dir': u'',
+    u'tiledmap.point_store.zoom': u'8',
+    # Zoom levels of the density rasters stored with the points: the number of points
+    # in each pixel, from which the builtin renderer draws the heatmap tiles of the
+    # raster's zoom level and of the zoom levels above it, whatever the number of
+    # points. Deeper heatmap tiles are drawn from the points.
+    u'tiledmap.point_store.density_zooms': u'1,3,5,7,9,11',
+
+    # Renderer of the tiles served by the tile proxy: 'windshaft', or 'builtin' to
+    # render the image tiles of maps that are not filtered, and their UTFGrid tiles in
+    # the plot style, from the resource's point store (see `tiledmap.point_store.dir`)
+    # within CKAN, using numpy. UTFGrid tiles only read the fields of one record per
+    # grid cell from the database. Other tiles are still requested from the windshaft
+    # renderers.
+    u'tiledmap.renderer': u'windshaft',
+
+    # Number of worker processes rendering the tiles of the builtin renderer, so
+    # rendering doesn't block the web server's threads. 0 renders tiles in the thread
+    # serving the request. At most `queue_size` tiles wait for a worker; further
+    # requests, and tiles not rendered within `deadline` seconds, are served the
+    # fallback tile. Waiting tiles at the zoom level the client last requested are
+    # rendered first.
+    u'tiledmap.render_pool.processes': u'0',
+    u'tiledmap.render_pool.queue_size': u'64',
+    u'tiledmap.render_pool.deadline': u'10',
+
+    # Read replicas of the datastore database that run the heavy map queries (extents,
+    # exports, UTFGrid records and occupancy checks): whitespace separated database
+    # URLs, each optionally followed by '#' and its weight (1 by default). Replicas
+    # lagging more than `max_lag` seconds behind the primary, as checked every
+    # `check_interval` seconds, are skipped, as are all the replicas for `max_lag`
+    # seconds after a resource's geometries are populated. Note that the lag of a
+    # replica grows while the primary is idle. Leave empty to run the map queries on
+    # `ckan.datastore.read_url`.
+    u'tiledmap.replicas': u'',
+    u'tiledmap.replicas.max_lag': u'30',
+    u'tiledmap.replicas.check_interval': u'10',
+
+    # Where the durations of the phases of map requests (resource and view lookups,
+    # template rendering, extent queries, serialisation) and of geometry population
+    # are emitted: 'log', 'statsd' (to the `statsd` host:port, with metric names
+    # prefixed by `statsd_prefix`), the 'package.module:function' path of a function
+    # returning a sink object, or empty to not emit them. When `header` is true (or
+    # CKAN's debug mode is on), the map requests' timings are also returned in a
+    # Server-Timing header.
+    u'tiledmap.timing.sink': u'',
+    u'tiledmap.timing.statsd': u'localhost:8125',
+    u'tiledmap.timing.statsd_prefix': u'tiledmap',
+    u'tiledmap.timing.header': u'false',
+
+    # Queries slower than `threshold` milliseconds, made while serving map requests,
+    # validating map views or populating geometries, are logged with their parameters,
+    # resource and filters digest. A fraction `explain_sample` of them (0 to 1) are
+    # also explained by a background thread, with EXPLAIN (ANALYZE, BUFFERS) in a
+    # read-only transaction that is rolled back (only the map's own read queries are
+    # analyzed; other statements are explained without being run), subject to a
+    # statement timeout of `explain_timeout` milliseconds. Set the threshold to 0 to
+    # disable.
+    u'tiledmap.slowlog.threshold': u'0',
+    u'tiledmap.slowlog.explain_sample': u'1',
+    u'tiledmap.slowlog.explain_timeout': u'60000'
     }
@@ -0,0 +1,34 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-map
+# Created by the Natural History Museum in London, UK
+
+from ckan.plugins import toolkit
+
+
+class AdminController(toolkit.BaseController):
+    '''Controller for the sysadmin pages of the tiled map views.
+
+    The performance figures of the resources that have a tiled map view are shown at
+    `/ckan-admin/tiledmap`, and are available from the `tiledmap_performance` action.
+    '''
+
+    def performance(self):
+        '''Controller action that lists the resources that have a tiled map view, with
+        their performance figures. Sysadmins only.
+
+        :returns: the rendered page
+
+        '''
+        context = {
+            u'user': toolkit.c.user
+            }
+        try:
+            resources = toolkit.get_action(u'tiledmap_performance')(context, {})
+        except toolkit.NotAuthorized:
+            toolkit.abort(401, toolkit._(u'Need to be system administrator to '
+                                         u'administer'))
+        return toolkit.render(u'tiledmap_performance.html', {
+            u'resources': resources
+            })
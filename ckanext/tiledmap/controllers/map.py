@@ -5,10 +5,35 @@
 # Created by the Natural History Museum in London, UK
 
 import json
+import re
+import time
 import urllib
 
 from ckanext.tiledmap.config import config
-from ckanext.tiledmap.db import _get_engine
+from ckanext.tiledmap.db import MAX_FETCH_ID, QuerySuperseded, QueryTimeout, \
+    _get_engine, map_connection
+from ckanext.tiledmap.lib.counts import estimate_extent, query_extent
+from ckanext.tiledmap.lib.export import EXPORT_FORMATS, export
+from ckanext.tiledmap.lib.filters import filters_digest, filters_key, normalise_q, \
+    parse_filters
+from ckanext.tiledmap.lib.metrics import record_cache, record_latency
+from ckanext.tiledmap.lib.occupancy import is_tile_empty
+from ckanext.tiledmap.lib.pointstore import get_point_store
+from ckanext.tiledmap.lib.query import GEOM_FILTER
+from ckanext.tiledmap.lib.render import use_builtin_renderer
+from ckanext.tiledmap.lib.render_pool import render
+from ckanext.tiledmap.lib.renderer import RendererUnavailable, fetch_tile, \
+    get_backends, is_degraded, params_digest, renderer_params
+from ckanext.tiledmap.lib.sidetable import query_table
+from ckanext.tiledmap.lib.singleflight import LockTimeout, coalesce
+from ckanext.tiledmap.lib.slowlog import query_context
+from ckanext.tiledmap.lib.stats import get_stats
+from ckanext.tiledmap.lib.styles import grid_params, query_fields, tile_params
+from ckanext.tiledmap.lib.timing import span, start_recording, stop_recording
+from ckanext.tiledmap.lib.tile_cache import CONTENT_TYPES, EMPTY_GRID, TRANSPARENT_PNG, \
+    get_cached_tile, open_cache_writer
+from ckanext.tiledmap.lib.utfgrid import render_grid
+from sqlalchemy.exc import DBAPIError, DataError, InternalError, ProgrammingError
 
 from ckan.lib.render import find_template
 from ckan.plugins import toolkit
@@ -24,7 +49,20 @@ class MapController(toolkit.BaseController):
     The map setting and information is available at `/map-info`.
     This request expects a 'resource_id' parameter, and accepts `filters` and
     `q` formatted as per resource view URLs.
+
+    The records matching the current map filters (including the drawn selection) can
+    be downloaded from `/map-export.{csv,geojson,ndjson}`, which accepts the same
+    parameters.
+
+    When `tiledmap.tile_proxy` is enabled, the map tiles are served from
+    `/map-tile/{z}/{x}/{y}.png` and `/map-grid/{z}/{x}/{y}.grid.json`, which stream
+    them from the renderer.
     
+    The phases of each request are timed (see ckanext.tiledmap.lib.timing), and the
+    timings are returned in a `Server-Timing` header when `tiledmap.timing.header` or
+    CKAN's `debug` option is enabled. The queries slower than
+    `tiledmap.slowlog.threshold` are logged (see ckanext.tiledmap.lib.slowlog).
+
     See ckanext.tiledmap.config for configuration options.
 
 
@@ -35,6 +73,8 @@ class MapController(toolkit.BaseController):
 
         This will trigger a 400 error if the resource_id parameter is missing.
         '''
+        self._started = time.time()
+        start_recording()
         # Run super
         super(MapController, self).__before__(action, **params)
 
@@ -46,18 +86,20 @@ class MapController(toolkit.BaseController):
 
         try:
             resource_show = toolkit.get_action(u'resource_show')
-            self.resource = resource_show(None, {
-                u'id': self.resource_id
-                })
+            with span(u'map.resource_show'):
+                self.resource = resource_show(None, {
+                    u'id': self.resource_id
+                    })
         except toolkit.ObjectNotFound:
             toolkit.abort(404, toolkit._(u'Resource not found'))
         except toolkit.NotAuthorized:
             toolkit.abort(401, toolkit._(u'Unauthorized to read resources'))
         resource_view_show = toolkit.get_action(u'resource_view_show')
         self.view_id = toolkit.request.params.get(u'view_id')
-        self.view = resource_view_show(None, {
-            u'id': self.view_id
-            })
+        with span(u'map.resource_view_show'):
+            self.view = resource_view_show(None, {
+                u'id': self.view_id
+                })
 
         # Read resource-dependent parameters
         self.info_title = self.view[u'utf_grid_title']
@@ -71,9 +113,26 @@ class MapController(toolkit.BaseController):
         self.quick_info_template = config[u'tiledmap.quick_info_template']
         self.repeat_map = self.view[u'repeat_map']
 
-        # Fields that need to be added to the query. Note that postgres query fails
-        # with duplicate names
-        self.query_fields = set(self.info_fields).union(set([self.info_title]))
+        # Fields that need to be added to the query
+        self.query_fields = query_fields(self.view)
+
+    def __after__(self, action, **params):
+        '''Record the duration of map-info and tile requests (see
+        ckanext.tiledmap.lib.metrics), and return the timings of the request's phases
+        in a Server-Timing header, if enabled'''
+        super(MapController, self).__after__(action, **params)
+        kind = {
+            u'map_info': u'map_info',
+            u'tile': u'tile',
+            u'grid': u'tile'
+            }.get(action)
+        if kind is not None:
+            record_latency(self.resource_id, kind, time.time() - self._started)
+        timings = stop_recording()
+        if timings is not None and timings.spans and (
+                toolkit.asbool(config[u'tiledmap.timing.header']) or
+                toolkit.asbool(config.get(u'debug', False))):
+            toolkit.response.headers[u'Server-Timing'] = timings.header()
 
     def map_info(self):
         '''Controller action that returns metadata about a given map.
@@ -86,12 +145,10 @@ class MapController(toolkit.BaseController):
         '''
         # Specific parameters
         fetch_id = toolkit.request.params.get(u'fetch_id')
-        tile_url_base = u'http://{host}:{port}/database/{database}/table/{table}'.format(
-            host=config[u'tiledmap.windshaft.host'],
-            port=config[u'tiledmap.windshaft.port'],
-            database=_get_engine().url.database,
-            table=self.resource_id
-            )
+        if fetch_id is not None and fetch_id.isdigit() and int(fetch_id) > MAX_FETCH_ID:
+            toolkit.abort(400, toolkit._(u'Invalid fetch id'))
+        with span(u'map.tile_urls'):
+            tile_url, grid_url, source_params, subdomains = self._get_tile_urls()
 
         ## Ensure we have at least one map style
         if not self.view[u'enable_plot_map'] and not self.view[
@@ -102,28 +159,29 @@ class MapController(toolkit.BaseController):
                 })
 
         # Prepare result
-        quick_info_template_name = u'{base}.{format}.mustache'.format(
-            base=self.quick_info_template,
-            format=str(self.resource[u'format']).lower()
-            )
-        if not find_template(quick_info_template_name):
-            quick_info_template_name = self.quick_info_template + u'.mustache'
-        info_template_name = u'{base}.{format}.mustache'.format(
-            base=self.info_template,
-            format=str(self.resource[u'format']).lower()
-            )
-        if not find_template(info_template_name):
-            info_template_name = self.info_template + u'.mustache'
-
-        quick_info_template = toolkit.render(quick_info_template_name, {
-            u'title': self.info_title,
-            u'fields': self.info_fields
-            })
-        info_template = toolkit.render(info_template_name, {
-            u'title': self.info_title,
-            u'fields': self.info_fields,
-            u'overlapping_records_view': self.view[u'overlapping_records_view']
-            })
+        with span(u'map.templates'):
+            quick_info_template_name = u'{base}.{format}.mustache'.format(
+                base=self.quick_info_template,
+                format=str(self.resource[u'format']).lower()
+                )
+            if not find_template(quick_info_template_name):
+                quick_info_template_name = self.quick_info_template + u'.mustache'
+            info_template_name = u'{base}.{format}.mustache'.format(
+                base=self.info_template,
+                format=str(self.resource[u'format']).lower()
+                )
+            if not find_template(info_template_name):
+                info_template_name = self.info_template + u'.mustache'
+
+            quick_info_template = toolkit.render(quick_info_template_name, {
+                u'title': self.info_title,
+                u'fields': self.info_fields
+                })
+            info_template = toolkit.render(info_template_name, {
+                u'title': self.info_title,
+                u'fields': self.info_fields,
+                u'overlapping_records_view': self.view[u'overlapping_records_view']
+                })
         result = {
             u'geospatial': True,
             u'geom_count': 0,
@@ -230,10 +288,8 @@ class MapController(toolkit.BaseController):
                 u'controls': [u'drawShape', u'mapType', u'fullScreen', u'miniMap'],
                 u'has_grid': False,
                 u'tile_source': {
-                    u'url': tile_url_base + '/{z}/{x}/{y}.png',
-                    u'params': {
-                        u'intensity': config[u'tiledmap.style.heatmap.intensity'],
-                        }
+                    u'url': tile_url,
+                    u'params': tile_params(u'heatmap')
                     },
                 }
             result[u'map_style'] = u'heatmap'
@@ -247,16 +303,12 @@ class MapController(toolkit.BaseController):
                 u'has_grid': self.view[u'enable_utf_grid'],
                 u'grid_resolution': int(config[u'tiledmap.style.plot.grid_resolution']),
                 u'tile_source': {
-                    u'url': tile_url_base + '/{z}/{x}/{y}.png',
-                    u'params': {
-                        u'base_color': config[u'tiledmap.style.gridded.base_color']
-                        }
+                    u'url': tile_url,
+                    u'params': tile_params(u'gridded')
                     },
                 u'grid_source': {
-                    u'url': tile_url_base + '/{z}/{x}/{y}.grid.json',
-                    u'params': {
-                        u'interactivity': u','.join(self.query_fields)
-                        }
+                    u'url': grid_url,
+                    u'params': grid_params(self.view)
                     }
                 }
             result[u'map_style'] = u'gridded'
@@ -270,44 +322,404 @@ class MapController(toolkit.BaseController):
                 u'has_grid': self.view[u'enable_utf_grid'],
                 u'grid_resolution': int(config[u'tiledmap.style.plot.grid_resolution']),
                 u'tile_source': {
-                    u'url': tile_url_base + '/{z}/{x}/{y}.png',
-                    u'params': {
-                        u'fill_color': config[u'tiledmap.style.plot.fill_color'],
-                        u'line_color': config[u'tiledmap.style.plot.line_color']
-                        }
+                    u'url': tile_url,
+                    u'params': tile_params(u'plot')
                     },
                 u'grid_source': {
-                    u'url': tile_url_base + '/{z}/{x}/{y}.grid.json',
-                    u'params': {
-                        u'interactivity': u','.join(self.query_fields)
-                        }
+                    u'url': grid_url,
+                    u'params': grid_params(self.view)
                     }
                 }
             result[u'map_style'] = u'plot'
 
+        for style in result[u'map_styles'].values():
+            for source in [u'tile_source', u'grid_source']:
+                if source in style:
+                    style[source][u'params'].update(source_params)
+                    if subdomains:
+                        style[source][u'subdomains'] = subdomains
+
+        # Tell the client to back off when tiles can't be rendered
+        result[u'degraded'] = toolkit.asbool(
+            config[u'tiledmap.tile_proxy']) and is_degraded()
+
         # Get query extent and count
-        info = toolkit.get_action(u'datastore_query_extent')({}, {
-            u'resource_id': self.resource_id,
-            u'filters': self._get_request_filters(),
-            u'limit': 1,
-            u'q': urllib.unquote(toolkit.request.params.get(u'q', u'')),
-            u'fields': u'_id'
-            })
+        with span(u'map.extent'):
+            info = self._get_extent_info()
         result[u'total_count'] = info[u'total_count']
         result[u'geom_count'] = info[u'geom_count']
+        result[u'counts_estimated'] = info[u'counts_estimated']
         if info[u'bounds']:
             result[u'bounds'] = info[u'bounds']
 
         toolkit.response.headers[u'Content-type'] = u'application/json'
-        return json.dumps(result)
+        with span(u'map.serialise'):
+            return json.dumps(result)
+
+    def export(self, file_format):
+        '''Controller action that streams the records matching the current map filters
+        and selection.
+
+        The records are read from the database using a server side cursor and written
+        out as they are read, so memory usage does not depend on the number of records
+        exported.
+
+        :param file_format: one of csv, geojson or ndjson
+        :returns: A generator yielding the encoded records
+
+        '''
+        if file_format not in EXPORT_FORMATS:
+            toolkit.abort(400, toolkit._(u'Unsupported export format'))
+        content_type, extension = EXPORT_FORMATS[file_format]
+
+        fields = toolkit.get_action(u'datastore_search')({}, {
+            u'resource_id': self.resource_id,
+            u'limit': 0
+            })[u'fields']
+        fields = [f[u'id'] for f in fields]
+        filters = self._get_request_filters()
+        if set(filters) - set(fields) - set([GEOM_FILTER]):
+            toolkit.abort(400, toolkit._(u'Invalid filters'))
+
+        try:
+            body = export(self.resource_id, fields, file_format, filters,
+                          q=self._get_request_q(),
+                          batch_size=int(config[u'tiledmap.export.batch_size']))
+        except (DataError, InternalError, ProgrammingError):
+            # Malformed geometries fail with an internal error
+            toolkit.abort(400, toolkit._(u'Invalid filters'))
+        toolkit.response.headers[u'Content-type'] = content_type
+        toolkit.response.headers[u'Content-disposition'] = \
+            u'attachment; filename="{0}.{1}"'.format(self.resource_id, extension)
+        return body
+
+    def tile(self, z, x, y):
+        '''Controller action that streams an image tile from the renderer.
+
+        :param z: zoom level
+        :param x: tile column
+        :param y: tile row
+        :returns: An iterable over the tile's content
+
+        '''
+        with self._query_context():
+            return self._proxy_tile(z, x, y, u'png')
+
+    def grid(self, z, x, y):
+        '''Controller action that streams an UTFGrid tile from the renderer.
+
+        :param z: zoom level
+        :param x: tile column
+        :param y: tile row
+        :returns: An iterable over the tile's content
+
+        '''
+        with self._query_context():
+            return self._proxy_tile(z, x, y, u'grid.json')
+
+    def _proxy_tile(self, z, x, y, extension):
+        '''Stream the given tile from the renderer.
+
+        The renderer's response is passed on as it is read, without being buffered, and
+        the connection to the renderer is then returned to the pool to be reused.
+
+        Tiles of the unfiltered map that the resource's occupancy bitmaps show to be
+        empty are answered immediately with a placeholder. Tiles cached less than
+        `tiledmap.tile_cache.ttl` seconds ago (including tiles stored by the seed-tiles
+        command) are served from the cache. If the renderer is unavailable, busy or
+        fails, the last cached version of the tile is served instead, or a placeholder
+        if the tile isn't cached. Tiles are rendered from the resource's side table
+        when it can answer the request (see ckanext.tiledmap.lib.sidetable).
+
+        When `tiledmap.renderer` is set to 'builtin', the image tiles of unfiltered
+        maps, and their UTFGrid tiles in the plot style, are rendered from the
+        resource's point store, without calling the renderer.
+
+        :param z: zoom level
+        :param x: tile column
+        :param y: tile row
+        :param extension: 'png' for image tiles, or 'grid.json' for UTFGrid tiles
+        :returns: An iterable over the tile's content
+
+        '''
+        if not toolkit.asbool(config[u'tiledmap.tile_proxy']):
+            toolkit.abort(404, toolkit._(u'Tiles are not served by CKAN'))
+        if not (z.isdigit() and x.isdigit() and y.isdigit()):
+            toolkit.abort(400, toolkit._(u'Invalid tile coordinates'))
+        z, x, y = int(z), int(x), int(y)
+        filters = self._get_request_filters()
+        q = self._get_request_q()
+        if not filters and not q and is_tile_empty(self.resource_id, z, x, y):
+            toolkit.response.headers[u'Content-Type'] = CONTENT_TYPES[extension]
+            return TRANSPARENT_PNG if extension == u'png' else EMPTY_GRID
+        params = toolkit.request.params.items()
+        cached = get_cached_tile(self.resource_id, z, x, y, extension,
+                                 params_digest(renderer_params(params)))
+        if cached is not None and time.time() - cached[1] < float(
+                config[u'tiledmap.tile_cache.ttl']):
+            toolkit.response.headers[u'Content-Type'] = CONTENT_TYPES[extension]
+            record_cache(self.resource_id, True)
+            return cached[0]
+        record_cache(self.resource_id, False)
+        if z <= int(config[u'tiledmap.coalesce.tile_max_zoom']):
+            # Concurrent requests for the same tile share a single rendering. The
+            # renderer's response can only be streamed once, so it is read in full
+            # (storing it in the tile cache) and its content shared.
+            key = (u'tile', self.resource_id, z, x, y, extension,
+                   params_digest(renderer_params(params)))
+            try:
+                tile = coalesce(key, lambda: self._fetch_tile(
+                    z, x, y, extension, params, filters, q, buffer=True))
+            except LockTimeout:
+                tile = None
+        else:
+            tile = self._fetch_tile(z, x, y, extension, params, filters, q)
+        if tile is None:
+            return self._fallback_tile(z, x, y, extension, params)
+        status, headers, body = tile
+        toolkit.response.status_int = status
+        for header, value in headers.items():
+            toolkit.response.headers[header] = value
+        return body
+
+    def _fetch_tile(self, z, x, y, extension, params, filters, q, buffer=False):
+        '''Render the given tile with the builtin renderer if it can, and request it
+        from the renderer otherwise, storing it in the tile cache.
+
+        :param z: zoom level
+        :param x: tile column
+        :param y: tile row
+        :param extension: 'png' for image tiles, or 'grid.json' for UTFGrid tiles
+        :param params: list of (name, value) request parameters
+        :param filters: dictionary of field name to list of values
+        :param q: full text query
+        :param buffer: if True, the renderer's response is read in full rather than
+                       streamed (Default value = False)
+        :returns: tuple (status, headers, body) where body is the tile's content, or an
+                  iterable over it if it is streamed, or None if the renderer failed
+                  and the fallback tile must be served
+
+        '''
+        if not filters and not q and use_builtin_renderer() and (
+                extension == u'png' or
+                toolkit.request.params.get(u'style', u'plot') == u'plot') and \
+                get_point_store(self.resource_id) is not None:
+            content = self._render_tile(z, x, y, extension, params)
+            if content is None:
+                return None
+            return 200, {
+                u'Content-Type': CONTENT_TYPES[extension]
+                }, content
+        table = query_table(self.resource_id, filters, q, self.query_fields)
+        try:
+            status, headers, body = fetch_tile(self.resource_id, z, x, y, extension,
+                                               params, table)
+        except RendererUnavailable:
+            return None
+        if status >= 500:
+            body.close()
+            return None
+        if buffer:
+            # Reading the body to the end stores the tile and releases the connection
+            body = b''.join(body)
+        return status, headers, body
+
+    def _render_tile(self, z, x, y, extension, params):
+        '''Render the given tile with the builtin renderer, storing it in the tile
+        cache. Image tiles are rendered by the render pool's worker processes if it is
+        enabled (see ckanext.tiledmap.lib.render_pool); if the pool's queue is full or
+        the tile isn't rendered by its deadline, the fallback tile is served. UTFGrid
+        tiles are built from the point store and the fields of one record per grid
+        cell (see ckanext.tiledmap.lib.utfgrid).
+
+        :param z: zoom level
+        :param x: tile column
+        :param y: tile row
+        :param extension: 'png' for image tiles, or 'grid.json' for UTFGrid tiles
+        :param params: list of (name, value) request parameters
+        :returns: The tile's content, or None if it could not be rendered
+
+        '''
+        try:
+            if extension == u'png':
+                content = render(self.resource_id,
+                                 toolkit.request.params.get(u'style', u'plot'), z, x, y,
+                                 dict(params), self._get_session())
+            else:
+                content = render_grid(self.resource_id,
+                                      get_point_store(self.resource_id), z, x, y,
+                                      self.query_fields)
+        except (RendererUnavailable, DBAPIError):
+            return None
+        cache_writer = open_cache_writer(self.resource_id, z, x, y, extension,
+                                         params_digest(renderer_params(params)))
+        if cache_writer is not None:
+            cache_writer.write(content)
+            cache_writer.commit()
+        return content
+
+    def _fallback_tile(self, z, x, y, extension, params):
+        '''Return the last cached version of the given tile, or a placeholder if it
+        isn't cached. Either way the response is marked as stale, and must not be
+        cached by the client.
+
+        :param z: zoom level
+        :param x: tile column
+        :param y: tile row
+        :param extension: 'png' for image tiles, or 'grid.json' for UTFGrid tiles
+        :param params: list of (name, value) request parameters
+        :returns: The tile's content
+
+        '''
+        toolkit.response.headers[u'Content-Type'] = CONTENT_TYPES[extension]
+        toolkit.response.headers[u'Cache-Control'] = u'no-cache'
+        toolkit.response.headers[u'Warning'] = u'110 - "Response is Stale"'
+        cached = get_cached_tile(self.resource_id, z, x, y, extension,
+                                 params_digest(renderer_params(params)))
+        if cached is not None:
+            return cached[0]
+        if extension == u'png':
+            return TRANSPARENT_PNG
+        return EMPTY_GRID
+
+    def _get_tile_urls(self):
+        '''Return the URL templates of the image and UTFGrid tiles, the parameters to
+        add to their query strings and the list of values of the `{s}` placeholder.
+
+        When several renderers are configured and tiles are requested from them
+        directly, the URL templates start with `http://{s}/` and the browser spreads
+        its requests over the renderers. Tiles requested directly are rendered from the
+        resource's side table if it can answer the request filters, which only change
+        along with the URL of the map page.
+
+        Proxied tile URLs only carry the client session when the render pool, which
+        uses it to prioritise the tiles of the session's current zoom level, is
+        enabled: otherwise they are the same for every client, and can be cached by
+        the browser and any proxy in front of CKAN.
+
+        :returns: tuple (tile url, grid url, parameters, subdomains), where subdomains
+                  is None if the URLs have no `{s}` placeholder
+
+        '''
+        if toolkit.asbool(config[u'tiledmap.tile_proxy']):
+            url_base = toolkit.request.script_name
+            params = {
+                u'resource_id': self.resource_id,
+                u'view_id': self.view_id
+                }
+            if int(config[u'tiledmap.render_pool.processes']) > 0:
+                params[u'session'] = self._get_session() or u''
+            return (url_base + u'/map-tile/{z}/{x}/{y}.png',
+                    url_base + u'/map-grid/{z}/{x}/{y}.grid.json', params, None)
+        backends = get_backends()
+        subdomains = None
+        if len(backends) > 1:
+            host = u'{s}'
+            subdomains = backends
+        else:
+            host = backends[0]
+        q = self._get_request_q()
+        url_base = u'http://{host}/database/{database}/table/{table}'.format(
+            host=host,
+            database=_get_engine().url.database,
+            table=query_table(self.resource_id, self._get_request_filters(), q,
+                              self.query_fields)
+            )
+        return (url_base + u'/{z}/{x}/{y}.png', url_base + u'/{z}/{x}/{y}.grid.json',
+                {}, subdomains)
+
+    def _get_extent_info(self):
+        '''Return the record count, geometry count and bounds of the records matching
+        the request filters.
+
+        Unfiltered requests are served from the statistics computed when the geometries
+        were populated, if available. Otherwise the records are counted in the
+        resource's side table if it can answer the request, or in the resource's
+        table. If `tiledmap.count.estimate` is enabled and the query planner expects a
+        large number of records to match, the counts are estimated from the table
+        statistics rather than computed exactly; `counts_estimated` is set accordingly.
+
+        Concurrent identical requests are coalesced, so they all wait on and share a
+        single computation. The queries are subject to `tiledmap.query.statement_timeout`
+        and are cancelled if the same client session issues a request with a later
+        `fetch_id`.
+
+        :returns: A dictionary defining total_count, geom_count, bounds and
+                  counts_estimated
+
+        '''
+        filters = self._get_request_filters()
+        q = self._get_request_q()
+        key = (u'extent', self.resource_id) + filters_key(filters, q)
+        try:
+            return coalesce(key, lambda: self._compute_extent_info(filters, q),
+                            retry_on=(QuerySuperseded,))
+        except (QueryTimeout, QuerySuperseded, LockTimeout):
+            toolkit.abort(503, toolkit._(u'The map query timed out or was superseded'))
+        except (DataError, InternalError, ProgrammingError):
+            # Malformed geometries fail with an internal error
+            toolkit.abort(400, toolkit._(u'Invalid filters'))
+
+    def _compute_extent_info(self, filters, q):
+        '''Compute the extent information returned by _get_extent_info, using the
+        stored statistics if possible and querying the database otherwise.
+
+        :param filters: dictionary of field name to list of values
+        :param q: full text query
+
+        '''
+        if not filters and not q:
+            stats = get_stats(self.resource_id)
+            if stats is not None:
+                return {
+                    u'total_count': stats[u'total_count'],
+                    u'geom_count': stats[u'geom_count'],
+                    u'bounds': stats[u'bounds'],
+                    u'counts_estimated': False
+                    }
+        fetch_id = toolkit.request.params.get(u'fetch_id', u'')
+        fetch_id = int(fetch_id) if fetch_id.isdigit() else None
+        table = query_table(self.resource_id, filters, q)
+        with query_context(self.resource_id, filters_digest(filters, q)), \
+                map_connection(self._get_session(), fetch_id,
+                               resource_id=self.resource_id) as connection:
+            if toolkit.asbool(config[u'tiledmap.count.estimate']):
+                info = estimate_extent(connection, table, filters, q,
+                                       int(config[u'tiledmap.count.exact_threshold']))
+                if info is not None:
+                    info[u'counts_estimated'] = True
+                    return info
+            info = query_extent(connection, table, filters, q)
+            info[u'counts_estimated'] = False
+            return info
+
+    def _query_context(self):
+        '''Return a context manager under which the slow queries made for the request
+        are logged with the resource and filters they were made for (see
+        ckanext.tiledmap.lib.slowlog)'''
+        return query_context(self.resource_id, filters_digest(
+            self._get_request_filters(), self._get_request_q()))
+
+    def _get_session(self):
+        '''Return the client session identifier sent with the request, used to cancel
+        the queries of superseded requests, or None if there is no valid identifier.
+        '''
+        session = toolkit.request.params.get(u'session', u'')
+        if re.match(u'^[0-9a-zA-Z]{1,32}$', session):
+            return session
+        return None
 
     def _get_request_filters(self):
-        ''' '''
-        filters = {}
-        for f in urllib.unquote(toolkit.request.params.get(u'filters', u'')).split(u'|'):
-            if f:
-                (k, v) = f.split(u':', 1)
-                if k not in filters:
-                    filters[k] = []
-                filters[k].append(v)
+        '''Return the filters of the request, as a dictionary of field name to list of
+        values, in canonical form (see ckanext.tiledmap.lib.filters). The filters are
+        parsed once per request.
+        '''
+        filters = getattr(self, u'_request_filters', None)
+        if filters is None:
+            filters = parse_filters(toolkit.request.params.get(u'filters', u''))
+            self._request_filters = filters
         return filters
+
+    def _get_request_q(self):
+        '''Return the full text query of the request, in canonical form'''
+        return normalise_q(urllib.unquote(toolkit.request.params.get(u'q', u'')))
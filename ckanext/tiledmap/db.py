@@ -4,13 +4,54 @@
 # This file is part of ckanext-map
 # Created by the Natural History Museum in London, UK
 
+from contextlib import contextmanager
+
+from ckanext.tiledmap.config import config
+from ckanext.tiledmap.lib.replicas import Replica, ReplicaSet, parse_replicas
+from ckanext.tiledmap.lib.slowlog import analyzed
 from sqlalchemy import create_engine
+from sqlalchemy.exc import OperationalError
 from sqlalchemy.pool import NullPool
 
 from ckan.plugins import toolkit
 
 _read_engine = None
 _write_engine = None
+_replica_set = None
+
+# Prefix of the application name of connections running map queries on behalf of a
+# client session. The full name is '<prefix><session>/<fetch id>'.
+APPLICATION_NAME_PREFIX = u'tiledmap/'
+
+# Largest fetch id, which has at most 18 digits so it always fits in a bigint
+MAX_FETCH_ID = 10 ** 18 - 1
+
+# Postgres error code of cancelled queries (query_canceled)
+_QUERY_CANCELED = u'57014'
+
+# Postgres error code of queries on tables that don't exist (undefined_table)
+_UNDEFINED_TABLE = u'42P01'
+
+
+class QueryTimeout(Exception):
+    '''Raised when a map query exceeds the configured statement timeout'''
+    pass
+
+
+class QuerySuperseded(Exception):
+    '''Raised when a map query is cancelled because the client that requested it has
+    since issued a newer request'''
+    pass
+
+
+def is_undefined_table(error):
+    '''Return True if the given database error was raised because a table the query
+    reads doesn't exist
+
+    :param error: the SQLAlchemy DBAPIError, or the DBAPI error
+
+    '''
+    return getattr(getattr(error, u'orig', error), u'pgcode', None) == _UNDEFINED_TABLE
 
 
 def _get_engine(write=False):
@@ -32,3 +73,116 @@ def _get_engine(write=False):
         if _read_engine is None:
             _read_engine = create_engine(toolkit.config[u'ckan.datastore.read_url'])
         return _read_engine
+
+
+def get_replica_set():
+    '''Return the read replicas configured by `tiledmap.replicas`, as a ReplicaSet'''
+    global _replica_set
+    if _replica_set is None:
+        _replica_set = ReplicaSet(
+            [Replica(url, weight)
+             for url, weight in parse_replicas(config[u'tiledmap.replicas'])],
+            float(config[u'tiledmap.replicas.max_lag']),
+            float(config[u'tiledmap.replicas.check_interval']))
+    return _replica_set
+
+
+def get_map_engine(resource_id=None, session=None):
+    '''Return the engine to run heavy map queries (extents, tiles, grids, exports)
+    on: one of the read replicas if any is configured and up to date (see
+    ckanext.tiledmap.lib.replicas.ReplicaSet), and the read engine otherwise.
+
+    :param resource_id: the resource queried, if any (Default value = None)
+    :param session: the client session the queries are made for, if any
+                    (Default value = None)
+
+    '''
+    replica = get_replica_set().choose(resource_id, session)
+    if replica is None:
+        return _get_engine()
+    return replica.engine
+
+
+def mark_written(resource_id):
+    '''Record that the geometries or records of the given resource were just written,
+    so its map queries are run on the primary until the replicas have caught up
+
+    :param resource_id: the resource id
+
+    '''
+    get_replica_set().mark_written(resource_id)
+
+
+def _cancel_superseded(connection, session, fetch_id):
+    '''Cancel the map queries still running for previous requests of the given client
+    session. This works across processes, as the queries are identified by their
+    connection's application name.
+
+    :param connection: the connection running the current request's queries
+    :param session: the client session
+    :param fetch_id: the (integer) fetch id of the current request
+
+    '''
+    # The fetch id is only parsed from the application names that match the pattern:
+    # the order in which the conditions of a WHERE clause are evaluated isn't defined,
+    # but that of the branches of a CASE is
+    connection.execute(
+        u"SELECT pg_cancel_backend(pid) FROM pg_stat_activity "
+        u"WHERE pid <> pg_backend_pid() AND CASE WHEN application_name ~ %(pattern)s "
+        u"THEN split_part(application_name, '/', 3)::bigint < %(fetch_id)s "
+        u"ELSE false END",
+        {
+            u'pattern': u'^{0}{1}/[0-9]{{1,18}}$'.format(APPLICATION_NAME_PREFIX,
+                                                         session),
+            u'fetch_id': fetch_id
+            }).close()
+
+
+@contextmanager
+def map_connection(session=None, fetch_id=None, statement_timeout=None,
+                   resource_id=None):
+    '''Context manager that provides a read connection, within a transaction, for
+    running map queries. The connection is made to a read replica if possible (see
+    get_map_engine).
+
+    The queries are subject to `tiledmap.query.statement_timeout`. If a client session
+    and fetch id are given, queries still running for earlier fetches of the same
+    session are cancelled, and the queries run here will in turn be cancelled by later
+    fetches.
+
+    :param session: alphanumeric client session identifier (Default value = None)
+    :param fetch_id: integer identifying the request within the session, up to
+                     MAX_FETCH_ID (Default value = None)
+    :param statement_timeout: statement timeout in milliseconds, overriding the
+                              configured value (Default value = None)
+    :param resource_id: the resource queried (Default value = None)
+    :raises QueryTimeout: if a query exceeds the statement timeout
+    :raises QuerySuperseded: if a query is cancelled by a later fetch
+
+    '''
+    if statement_timeout is None:
+        statement_timeout = int(config[u'tiledmap.query.statement_timeout'])
+    connection = get_map_engine(resource_id, session).connect()
+    try:
+        with connection.begin():
+            if statement_timeout > 0:
+                connection.execute(
+                    u"SELECT set_config('statement_timeout', %(timeout)s, true)",
+                    {u'timeout': str(statement_timeout)}).close()
+            if session and fetch_id is not None:
+                connection.execute(
+                    u"SELECT set_config('application_name', %(name)s, true)", {
+                        u'name': u'{0}{1}/{2}'.format(APPLICATION_NAME_PREFIX, session,
+                                                      fetch_id)
+                        }).close()
+                _cancel_superseded(connection, session, fetch_id)
+            # Only map reads are run from here on
+            yield analyzed(connection)
+    except OperationalError as e:
+        if getattr(e.orig, u'pgcode', None) != _QUERY_CANCELED:
+            raise
+        if u'statement timeout' in unicode(e.orig):
+            raise QueryTimeout()
+        raise QuerySuperseded()
+    finally:
+        connection.close()
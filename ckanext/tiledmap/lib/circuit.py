@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-map
+# Created by the Natural History Museum in London, UK
+
+import collections
+import logging
+import threading
+import time
+
+from ckanext.tiledmap.config import config
+
+log = logging.getLogger(__name__)
+
+CLOSED = u'closed'
+OPEN = u'open'
+HALF_OPEN = u'half-open'
+
+_circuits = {}
+_circuits_lock = threading.Lock()
+
+
+class CircuitBreaker(object):
+    '''Stop calling a service that keeps failing or responding slowly.
+
+    The outcome of the last `window` calls is recorded, calls slower than `slow_call`
+    seconds counting as failures. Once `max_failures` of them have failed, the circuit
+    opens and calls are refused for `reset_timeout` seconds. The circuit is then
+    half-open: a single trial call is allowed, which closes the circuit if it succeeds
+    and opens it again otherwise.
+    '''
+
+    def __init__(self, name, window=20, max_failures=5, slow_call=5.0,
+                 reset_timeout=30.0):
+        '''
+        :param name: the name of the service, used for logging
+        :param window: the number of calls whose outcome is recorded
+        :param max_failures: the number of failures within the window that opens the
+                             circuit
+        :param slow_call: the duration, in seconds, above which a call counts as failed
+        :param reset_timeout: the number of seconds for which calls are refused once the
+                              circuit has opened
+        '''
+        self.name = name
+        self.max_failures = max_failures
+        self.slow_call = slow_call
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._outcomes = collections.deque(maxlen=window)
+        self._opened = None
+        self._trial = None
+
+    @property
+    def state(self):
+        '''The state of the circuit: one of CLOSED, OPEN or HALF_OPEN'''
+        with self._lock:
+            return self._state()
+
+    def _state(self):
+        '''Return the state of the circuit. The lock must be held.'''
+        if self._opened is None:
+            return CLOSED
+        if time.time() - self._opened < self.reset_timeout:
+            return OPEN
+        return HALF_OPEN
+
+    def allow(self):
+        '''Return True if a call may be made now. When the circuit is half-open, only
+        one caller is allowed to make a trial call (another is allowed if the trial
+        has not been recorded within `reset_timeout` seconds).
+        '''
+        with self._lock:
+            state = self._state()
+            if state == CLOSED:
+                return True
+            if state == OPEN:
+                return False
+            if self._trial is not None and time.time() - self._trial < self.reset_timeout:
+                return False
+            self._trial = time.time()
+            return True
+
+    def record(self, success, duration=0):
+        '''Record the outcome of a call
+
+        :param success: False if the call failed
+        :param duration: the duration of the call, in seconds
+
+        '''
+        success = success and duration <= self.slow_call
+        with self._lock:
+            state = self._state()
+            if state == CLOSED:
+                self._outcomes.append(success)
+                if self._outcomes.count(False) >= self.max_failures:
+                    log.warning(u'Opening the circuit of %s', self.name)
+                    self._opened = time.time()
+            elif state == HALF_OPEN:
+                # The outcome of the trial call. Calls made before the circuit opened
+                # may still complete while it is open; they are ignored.
+                if success:
+                    log.info(u'Closing the circuit of %s', self.name)
+                    self._outcomes.clear()
+                    self._opened = None
+                else:
+                    self._opened = time.time()
+                self._trial = None
+
+
+def get_circuit(name):
+    '''Return the circuit breaker of the given service, configured from the
+    `tiledmap.circuit.*` options
+
+    :param name: the name of the service
+
+    '''
+    with _circuits_lock:
+        if name not in _circuits:
+            _circuits[name] = CircuitBreaker(
+                name,
+                window=int(config[u'tiledmap.circuit.window']),
+                max_failures=int(config[u'tiledmap.circuit.max_failures']),
+                slow_call=float(config[u'tiledmap.circuit.slow_call']),
+                reset_timeout=float(config[u'tiledmap.circuit.reset_timeout'])
+                )
+        return _circuits[name]
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-map
+# Created by the Natural History Museum in London, UK
+
+import json
+
+from ckanext.tiledmap.lib.prepared import execute_prepared
+from ckanext.tiledmap.lib.query import apply_filters, filter_columns, filter_params, \
+    filter_shape, geom_field_4326, get_table
+from sqlalchemy import func, literal_column
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.sql import select
+
+
+def _plan_rows(connection, query):
+    '''Return the number of rows the query planner expects the given query to return
+
+    :param connection: the database connection
+    :param query: the select query
+
+    '''
+    compiled = query.compile(dialect=connection.dialect)
+    result = connection.execute(u'EXPLAIN (FORMAT JSON) ' + unicode(compiled),
+                                compiled.params)
+    plan = result.fetchone()[0]
+    result.close()
+    if isinstance(plan, basestring):
+        plan = json.loads(plan)
+    return int(plan[0][u'Plan'][u'Plan Rows'])
+
+
+def _table_rows(connection, resource_id):
+    '''Return the number of rows in the given table according to the table statistics,
+    or None if the table has never been analysed.
+
+    :param connection: the database connection
+    :param resource_id: the resource id
+
+    '''
+    result = connection.execute(
+        u"SELECT c.reltuples FROM pg_class c JOIN pg_namespace n "
+        u"ON n.oid = c.relnamespace WHERE n.nspname = 'public' AND c.relname = %(table)s",
+        {u'table': resource_id})
+    row = result.fetchone()
+    result.close()
+    if row is None or row[0] is None or row[0] <= 0:
+        return None
+    return int(row[0])
+
+
+def _estimated_bounds(connection, resource_id):
+    '''Return the bounds of the geometries in the given table according to the table
+    statistics, as ((lat min, lon min), (lat max, lon max)), or None if there are no
+    statistics available.
+
+    :param connection: the database connection
+    :param resource_id: the resource id
+
+    '''
+    extent = func.st_estimatedextent(u'public', resource_id, geom_field_4326())
+    query = select([func.st_ymin(extent), func.st_xmin(extent), func.st_ymax(extent),
+                    func.st_xmax(extent)])
+    try:
+        with connection.begin_nested():
+            result = connection.execute(query)
+            row = result.fetchone()
+            result.close()
+    except DBAPIError:
+        return None
+    if row is None or row[0] is None:
+        return None
+    return (row[0], row[1]), (row[2], row[3])
+
+
+def query_extent(connection, resource_id, filters, q=None):
+    '''Count the records and geometries matching the given filters, and compute the
+    bounds of the geometries. The query is run as a prepared statement, shared by the
+    requests with the same filter shape.
+
+    :param connection: the database connection
+    :param resource_id: the resource id
+    :param filters: dictionary of field name to list of values
+    :param q: full text query, if any
+    :returns: a dictionary defining total_count, geom_count and bounds (as
+              ((lat min, lon min), (lat max, lon max)), or None if there are no
+              geometries)
+
+    '''
+
+    def build():
+        table = get_table(resource_id, filter_columns(filters, q) + [geom_field_4326()])
+        geom = table.c[geom_field_4326()]
+        extent = func.st_extent(geom)
+        query = select([func.count(), func.count(geom), func.st_ymin(extent),
+                        func.st_xmin(extent), func.st_ymax(extent),
+                        func.st_xmax(extent)], from_obj=table)
+        return apply_filters(query, table, filters, q)
+
+    result = execute_prepared(connection, (u'extent', resource_id, geom_field_4326(),
+                                           filter_shape(filters, q)),
+                              build, filter_params(filters, q))
+    row = result.fetchone()
+    result.close()
+    bounds = None
+    if row[2] is not None:
+        bounds = ((row[2], row[3]), (row[4], row[5]))
+    return {
+        u'total_count': row[0],
+        u'geom_count': row[1],
+        u'bounds': bounds
+        }
+
+
+def estimate_extent(connection, resource_id, filters, q=None, exact_threshold=100000):
+    '''Estimate the number of records and geometries matching the given filters using
+    the query planner's statistics, rather than by scanning the table.
+
+    Estimates are only useful when a large number of records match: if the planner
+    expects fewer than `exact_threshold` records to match, this returns None and the
+    caller should compute exact counts. The bounds returned are those of the whole
+    resource, as only used for autozoom.
+
+    :param connection: the database connection, within a transaction
+    :param resource_id: the resource id
+    :param filters: dictionary of field name to list of values
+    :param q: full text query, if any
+    :param exact_threshold: the number of rows under which exact counts are expected
+    :returns: None, or a dictionary defining total_count, geom_count and bounds
+              (which may be None)
+
+    '''
+    table = get_table(resource_id, filter_columns(filters, q) + [geom_field_4326()])
+    total_count = None
+    if not filters and not q:
+        total_count = _table_rows(connection, resource_id)
+    if total_count is None:
+        query = select([literal_column(u'1')], from_obj=table)
+        total_count = _plan_rows(connection, apply_filters(query, table, filters, q))
+    if total_count < exact_threshold:
+        return None
+    query = select([literal_column(u'1')], from_obj=table)
+    query = apply_filters(query, table, filters, q)
+    geom_count = _plan_rows(connection, query.where(table.c[geom_field_4326()] != None))
+    return {
+        u'total_count': total_count,
+        u'geom_count': min(geom_count, total_count),
+        u'bounds': _estimated_bounds(connection, resource_id)
+        }
@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-map
+# Created by the Natural History Museum in London, UK
+
+import csv
+import datetime
+import decimal
+import json
+from cStringIO import StringIO
+
+from ckanext.tiledmap.db import get_map_engine
+from ckanext.tiledmap.lib.filters import filters_digest
+from ckanext.tiledmap.lib.query import apply_filters, filter_columns, geom_field_4326, \
+    get_table
+from ckanext.tiledmap.lib.slowlog import analyzed, query_context
+from sqlalchemy import func
+from sqlalchemy.sql import select
+
+# Name of the column holding the GeoJSON representation of each record's geometry
+GEOJSON_COLUMN = u'_tiledmap_geojson'
+
+# Supported export formats, as format => (content type, file extension)
+EXPORT_FORMATS = {
+    u'csv': (u'text/csv; charset=utf-8', u'csv'),
+    u'geojson': (u'application/vnd.geo+json', u'geojson'),
+    u'ndjson': (u'application/x-ndjson', u'ndjson')
+    }
+
+
+def _json_default(value):
+    '''Serialise values that the json module does not know about
+
+    :param value: the value to serialise
+
+    '''
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return value.isoformat()
+    return unicode(value)
+
+
+def _encode(value):
+    '''Encode a value for the csv module, which doesn't handle unicode
+
+    :param value: the value to encode
+
+    '''
+    if value is None:
+        return u''
+    if isinstance(value, unicode):
+        return value.encode(u'utf-8')
+    if isinstance(value, (list, dict)):
+        return json.dumps(value, default=_json_default)
+    return value
+
+
+def stream_records(resource_id, fields, filters, q=None, batch_size=1000,
+                   geojson=False):
+    '''Return a generator that yields batches of records (as lists of dicts) matching
+    the given filters.
+
+    This uses a server side cursor, so at most `batch_size` records are held in memory
+    at any one time, whatever the number of matching records. The query is run, and
+    its first batch fetched, before the generator is returned, so invalid filters (such
+    as a malformed geometry or a value of the wrong type) raise here rather than once
+    the records are being streamed.
+
+    :param resource_id: the resource to export
+    :param fields: list of field names to export
+    :param filters: dictionary of field name to list of values
+    :param q: full text query, if any
+    :param batch_size: number of records fetched from the database at a time
+    :param geojson: if True, each record will include the GeoJSON geometry of the
+                    record under GEOJSON_COLUMN
+
+    '''
+    table = get_table(resource_id,
+                      fields + filter_columns(filters, q) + [geom_field_4326()])
+    columns = [table.c[f] for f in fields]
+    if geojson:
+        columns.append(func.st_asgeojson(table.c[geom_field_4326()]).label(GEOJSON_COLUMN))
+    query = select(columns, from_obj=table)
+    query = apply_filters(query, table, filters, q)
+    if u'_id' in fields:
+        query = query.order_by(table.c[u'_id'])
+
+    connection = get_map_engine(resource_id).connect()
+    try:
+        # The server side cursor only lives in a transaction, which is rolled back when
+        # the connection is closed
+        connection.begin()
+        with query_context(resource_id, filters_digest(filters, q)):
+            result = analyzed(connection).execution_options(
+                stream_results=True).execute(query)
+            rows = result.fetchmany(batch_size)
+    except Exception:
+        connection.close()
+        raise
+    return _stream_batches(connection, result, rows, batch_size)
+
+
+def _stream_batches(connection, result, rows, batch_size):
+    '''Generator that yields the batches of records of the given result, starting with
+    the rows already fetched, and then closes the connection
+
+    :param connection: the connection the query runs on
+    :param result: the result of the query
+    :param rows: the first batch of rows
+    :param batch_size: number of records fetched from the database at a time
+
+    '''
+    try:
+        while rows:
+            yield [dict(row.items()) for row in rows]
+            rows = result.fetchmany(batch_size)
+    finally:
+        result.close()
+        connection.close()
+
+
+def csv_export(fields, batches):
+    '''Generator that yields the given batches of records as chunks of CSV
+
+    :param fields: list of field names to export
+    :param batches: iterable of lists of records, as returned by stream_records
+
+    '''
+    buf = StringIO()
+    writer = csv.writer(buf)
+    writer.writerow([_encode(f) for f in fields])
+    yield buf.getvalue()
+    for batch in batches:
+        buf = StringIO()
+        writer = csv.writer(buf)
+        for record in batch:
+            writer.writerow([_encode(record[f]) for f in fields])
+        yield buf.getvalue()
+
+
+def ndjson_export(fields, batches):
+    '''Generator that yields the given batches of records as chunks of newline
+    delimited JSON
+
+    :param fields: list of field names to export
+    :param batches: iterable of lists of records, as returned by stream_records
+
+    '''
+    for batch in batches:
+        yield u''.join(
+            json.dumps(dict((f, record[f]) for f in fields),
+                       default=_json_default) + u'\n'
+            for record in batch
+            ).encode(u'utf-8')
+
+
+def geojson_export(fields, batches):
+    '''Generator that yields the given batches of records as chunks of a GeoJSON
+    feature collection. Records without a geometry are exported with a null geometry.
+
+    :param fields: list of field names to export
+    :param batches: iterable of lists of records, as returned by stream_records. These
+                    must have been requested with `geojson=True`.
+
+    '''
+    yield '{"type": "FeatureCollection", "features": ['
+    separator = ''
+    for batch in batches:
+        features = []
+        for record in batch:
+            geometry = record[GEOJSON_COLUMN]
+            features.append(json.dumps({
+                u'type': u'Feature',
+                u'geometry': json.loads(geometry) if geometry else None,
+                u'properties': dict((f, record[f]) for f in fields)
+                }, default=_json_default))
+        yield separator + u',\n'.join(features).encode(u'utf-8')
+        separator = ',\n'
+    yield ']}\n'
+
+
+def export(resource_id, fields, file_format, filters, q=None, batch_size=1000):
+    '''Return a generator that streams the records matching the given filters in the
+    given format
+
+    :param resource_id: the resource to export
+    :param fields: list of field names to export
+    :param file_format: one of the keys of EXPORT_FORMATS
+    :param filters: dictionary of field name to list of values
+    :param q: full text query, if any
+    :param batch_size: number of records fetched from the database at a time
+    :raises sqlalchemy.exc.DBAPIError: if the query fails, for instance because the
+                                       filters are invalid (see stream_records)
+
+    '''
+    writers = {
+        u'csv': csv_export,
+        u'ndjson': ndjson_export,
+        u'geojson': geojson_export
+        }
+    if file_format not in writers:
+        raise ValueError(u'Unsupported export format: {0}'.format(file_format))
+    batches = stream_records(resource_id, fields, filters, q, batch_size,
+                             geojson=(file_format == u'geojson'))
+    return writers[file_format](fields, batches)
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-map
+# Created by the Natural History Museum in London, UK
+
+import hashlib
+import json
+import re
+import urllib
+
+from ckanext.tiledmap.lib.query import GEOM_FILTER
+
+
+def normalise_q(q):
+    '''Return the canonical form of the given full text query: surrounding whitespace
+    removed and inner whitespace collapsed, which doesn't change the words matched
+
+    :param q: the full text query
+
+    '''
+    return u' '.join((q or u'').split())
+
+
+def normalise_geometry(wkt):
+    '''Return the canonical form of the given WKT geometry: upper case, without any
+    whitespace around parentheses and commas, and single spaces between coordinates
+
+    :param wkt: the WKT geometry
+
+    '''
+    return re.sub(u'\\s*([(),])\\s*', u'\\1', u' '.join(wkt.split())).upper()
+
+
+def canonical_filters(filters):
+    '''Return the canonical form of the given filters: empty fields removed, and the
+    values of each field normalised, de-duplicated and sorted. Filters that select the
+    same records in a different order, or with repeated values, have the same
+    canonical form.
+
+    :param filters: dictionary of field name to list of values
+    :returns: dictionary of field name to sorted list of values
+
+    '''
+    result = {}
+    for field, values in filters.items():
+        if field == GEOM_FILTER:
+            values = [normalise_geometry(v) for v in values]
+        values = sorted(set(values))
+        if values:
+            result[field] = values
+    return result
+
+
+def parse_filters(filters):
+    '''Parse the given filters, as formatted in resource view URLs ('field:value|...'),
+    into their canonical form
+
+    :param filters: the URL encoded filters
+    :returns: dictionary of field name to sorted list of values
+
+    '''
+    parsed = {}
+    for f in urllib.unquote(filters or u'').split(u'|'):
+        if f:
+            (k, v) = f.split(u':', 1)
+            parsed.setdefault(k, []).append(v)
+    return canonical_filters(parsed)
+
+
+def format_filters(filters):
+    '''Format the given filters as in resource view URLs, in their canonical order
+
+    :param filters: dictionary of field name to list of values
+
+    '''
+    return u'|'.join(u'{0}:{1}'.format(field, value)
+                     for field, values in sorted(canonical_filters(filters).items())
+                     for value in values)
+
+
+def filters_key(filters, q=None):
+    '''Return a hashable key identifying the records selected by the given filters,
+    for use in in-process caches. Geometries are represented by their hash, so keys
+    stay small whatever the complexity of the drawn shapes.
+
+    :param filters: dictionary of field name to list of values
+    :param q: full text query, if any
+
+    '''
+    key = []
+    for field, values in sorted(canonical_filters(filters).items()):
+        if field == GEOM_FILTER:
+            values = [hashlib.sha1(v.encode(u'utf-8')).hexdigest() for v in values]
+        key.append((field, tuple(values)))
+    return tuple(key), normalise_q(q)
+
+
+def filters_digest(filters, q=None):
+    '''Return a stable digest of the given filters, which is the same for all the
+    equivalent forms of the filters, across processes and servers
+
+    :param filters: dictionary of field name to list of values
+    :param q: full text query, if any
+
+    '''
+    return hashlib.md5(json.dumps(filters_key(filters, q))).hexdigest()
+
+
+def canonical_params(params):
+    '''Return the given request parameters, with the filters and full text query in
+    their canonical form and dropped if they are empty
+
+    :param params: list of (name, value) request parameters
+
+    '''
+    result = []
+    for k, v in params:
+        if k == u'filters':
+            v = format_filters(parse_filters(v))
+        elif k == u'q':
+            v = normalise_q(urllib.unquote(v))
+        if v or k not in (u'filters', u'q'):
+            result.append((k, v))
+    return result
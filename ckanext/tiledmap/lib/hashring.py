@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-map
+# Created by the Natural History Museum in London, UK
+
+import bisect
+import hashlib
+
+
+def _hash(value):
+    '''Return the position of the given value on the ring
+
+    :param value: a string
+
+    '''
+    if isinstance(value, unicode):
+        value = value.encode(u'utf-8')
+    return int(hashlib.md5(value).hexdigest()[:16], 16)
+
+
+class HashRing(object):
+    '''Consistent hashing of keys onto a set of nodes.
+
+    Each node is placed on the ring at `replicas` pseudo-random positions, and a key
+    is assigned to the node at the first position following the key's own position.
+    Adding or removing a node only moves the keys assigned to that node, so the
+    other nodes keep serving (and caching) the same keys.
+    '''
+
+    def __init__(self, nodes, replicas=100):
+        '''
+        :param nodes: list of node names
+        :param replicas: number of positions of each node on the ring
+        '''
+        self.nodes = []
+        for node in nodes:
+            if node not in self.nodes:
+                self.nodes.append(node)
+        self._ring = sorted(
+            (_hash(u'{0}#{1}'.format(node, i)), node)
+            for node in self.nodes for i in range(replicas)
+            )
+        self._positions = [position for position, node in self._ring]
+
+    def get_nodes(self, key):
+        '''Return all the nodes, in order of preference for the given key: the node the
+        key is assigned to first, followed by the nodes to fail over to.
+
+        :param key: a string
+
+        '''
+        nodes = []
+        if not self._ring:
+            return nodes
+        start = bisect.bisect(self._positions, _hash(key))
+        for i in range(len(self._ring)):
+            node = self._ring[(start + i) % len(self._ring)][1]
+            if node not in nodes:
+                nodes.append(node)
+                if len(nodes) == len(self.nodes):
+                    break
+        return nodes
+
+    def get_node(self, key):
+        '''Return the node the given key is assigned to, or None if there are no nodes
+
+        :param key: a string
+
+        '''
+        nodes = self.get_nodes(key)
+        return nodes[0] if nodes else None
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-map
+# Created by the Natural History Museum in London, UK
+
+from ckanext.tiledmap.db import _get_engine
+from ckanext.tiledmap.lib.occupancy import MERCATOR_EXTENT
+from ckanext.tiledmap.lib.query import geom_field
+
+# The number of bits of each coordinate used to compute Hilbert keys: the world is
+# divided into a 2^16 x 2^16 grid, which is about 600m wide cells at the equator.
+HILBERT_ORDER = 16
+
+# Position of a web mercator point along a Hilbert curve covering the world. Points
+# that are close to each other mostly get keys that are close to each other, so
+# ordering rows by this key stores the records of a tile on a few contiguous pages.
+HILBERT_FUNCTION = u'''
+CREATE OR REPLACE FUNCTION tiledmap_hilbert(x double precision, y double precision)
+RETURNS bigint AS $$
+DECLARE
+    n bigint := {size};
+    ix bigint := least(n - 1, greatest(0, floor((x + {extent}) / {width} * n)));
+    iy bigint := least(n - 1, greatest(0, floor(({extent} - y) / {width} * n)));
+    s bigint := n / 2;
+    d bigint := 0;
+    rx integer;
+    ry integer;
+    t bigint;
+BEGIN
+    WHILE s > 0 LOOP
+        rx := CASE WHEN (ix & s) > 0 THEN 1 ELSE 0 END;
+        ry := CASE WHEN (iy & s) > 0 THEN 1 ELSE 0 END;
+        d := d + s * s * ((3 * rx) # ry);
+        IF ry = 0 THEN
+            IF rx = 1 THEN
+                ix := n - 1 - ix;
+                iy := n - 1 - iy;
+            END IF;
+            t := ix;
+            ix := iy;
+            iy := t;
+        END IF;
+        s := s / 2;
+    END LOOP;
+    RETURN d;
+END
+$$ LANGUAGE plpgsql IMMUTABLE STRICT
+'''.format(size=2 ** HILBERT_ORDER, extent=repr(MERCATOR_EXTENT),
+           width=repr(2 * MERCATOR_EXTENT))
+
+_function_created = False
+
+
+def ensure_hilbert_function():
+    '''Create the tiledmap_hilbert database function if it hasn't been created by this
+    process yet'''
+    global _function_created
+    if not _function_created:
+        with _get_engine(write=True).begin() as connection:
+            connection.execute(HILBERT_FUNCTION)
+        _function_created = True
+
+
+def _quote(identifier):
+    '''Return the given identifier quoted for use in SQL statements
+
+    :param identifier: a table, column or index name
+
+    '''
+    return _get_engine(write=True).dialect.identifier_preparer.quote_identifier(
+        identifier)
+
+
+def spatial_key(column=None):
+    '''Return the SQL expression of the Hilbert key of the given web mercator point
+    column. ensure_hilbert_function must have been called before it is used.
+
+    :param column: the quoted column name. Defaults to the web mercator geometry
+                   column.
+
+    '''
+    column = column or _quote(geom_field())
+    return u'tiledmap_hilbert(ST_X({0}), ST_Y({0}))'.format(column)
+
+
+def key_index_name(table):
+    '''Return the name of the Hilbert key index of the given table
+
+    :param table: the table name
+
+    '''
+    return u'{0}_hkey'.format(table)
+
+
+def index_exists(connection, index):
+    '''Return True if the given index exists in the public schema
+
+    :param connection: the database connection
+    :param index: the index name
+
+    '''
+    result = connection.execute(
+        u"SELECT 1 FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace "
+        u"WHERE n.nspname = 'public' AND c.relname = %(index)s AND c.relkind = 'i'",
+        {u'index': index})
+    row = result.fetchone()
+    result.close()
+    return row is not None
+
+
+def create_key_index(connection, table, concurrently=False):
+    '''Create the Hilbert key index of the given table, if it doesn't exist. The index
+    is looked up first, as CREATE INDEX IF NOT EXISTS requires Postgres 9.5.
+
+    :param connection: the database connection. When creating the index concurrently,
+                       it must not be within a transaction.
+    :param table: the table name
+    :param concurrently: if True, the index is built without blocking writes to the
+                         table
+
+    '''
+    if index_exists(connection, key_index_name(table)):
+        return
+    connection.execute(u'CREATE INDEX {concurrently} {index} ON {table} ({key})'.format(
+        concurrently=u'CONCURRENTLY' if concurrently else u'',
+        index=_quote(key_index_name(table)),
+        table=_quote(table),
+        key=spatial_key()
+        ))
+
+
+def key_correlation(connection, table):
+    '''Return the correlation between the physical order of the rows of the given table
+    and their Hilbert keys, according to the statistics of its key index: 1 if the
+    table is in key order, close to 0 if rows are stored in an unrelated order. Returns
+    None if the table has not been analysed since the index was created.
+
+    :param connection: the database connection
+    :param table: the table name
+
+    '''
+    result = connection.execute(
+        u"SELECT correlation FROM pg_stats WHERE schemaname = 'public' "
+        u"AND tablename = %(index)s", {u'index': key_index_name(table)})
+    row = result.fetchone()
+    result.close()
+    if row is None or row[0] is None:
+        return None
+    return abs(row[0])
@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-map
+# Created by the Natural History Museum in London, UK
+
+import logging
+import threading
+
+from ckanext.tiledmap.db import _get_engine, mark_written
+from ckanext.tiledmap.lib.layout import create_key_index, ensure_hilbert_function, \
+    key_correlation, key_index_name
+from ckanext.tiledmap.lib.occupancy import build_occupancy, delete_occupancy
+from ckanext.tiledmap.lib.pointstore import build_point_store, delete_point_store, \
+    store_dir
+from ckanext.tiledmap.lib.sidetable import build_side_table, drop_side_table, \
+    is_enabled as is_side_table_enabled, side_table_columns, side_table_name
+from ckanext.tiledmap.lib.stats import compute_stats, delete_stats, record_populated
+from ckanext.tiledmap.lib.tile_cache import delete_cached_tiles
+from sqlalchemy.exc import DBAPIError
+
+from ckan.plugins import toolkit
+
+try:
+    from ckan.lib.redis import connect_to_redis
+except ImportError:
+    # CKAN < 2.7, which has no background jobs
+    connect_to_redis = None
+
+log = logging.getLogger(__name__)
+
+# Seconds between two progress reports while a table is being reordered
+PROGRESS_INTERVAL = 10
+
+# Redis key set while a refresh of a resource's map data is queued, so the writes
+# made meanwhile don't queue more refreshes
+REFRESH_PENDING_KEY = u'ckanext-tiledmap:refresh-pending:{0}'
+
+# Seconds after which the pending marker expires, in case its job is lost
+REFRESH_PENDING_TTL = 3600
+
+
+def _attempt(description, function, resource_id):
+    '''Call the given function on the resource, logging rather than raising errors
+
+    :param description: description of what the function does, for the log
+    :param function: function that takes the resource id as its only parameter
+    :param resource_id: the resource id
+
+    '''
+    try:
+        function(resource_id)
+    except Exception:
+        log.exception(u'Failed to %s of resource %s', description, resource_id)
+
+
+def refresh_resource(resource_id, stores=True, populated=False):
+    '''Rebuild the precomputed data of a resource. This must be called whenever the
+    geometries of the resource have been (re)populated.
+
+    Failures are logged rather than raised: the map falls back to live queries when the
+    precomputed data is missing. Map queries about the resource are run on the primary
+    database until the read replicas have caught up with the write.
+
+    :param resource_id: the resource id
+    :param stores: if False, the side table and point store, which copy every point of
+                   the resource and take a while to build on large resources, are
+                   discarded rather than rebuilt, and are left to build_stores
+                   (Default value = True)
+    :param populated: whether the geometries were just populated, in which case the
+                      time is recorded for the performance page (Default value = False)
+
+    '''
+    mark_written(resource_id)
+    if populated:
+        _attempt(u'record the population time', record_populated, resource_id)
+    _attempt(u'compute the map statistics', compute_stats, resource_id)
+    _attempt(u'build the tile occupancy bitmaps', build_occupancy, resource_id)
+    if stores:
+        _attempt(u'build the side table', build_side_table, resource_id)
+        _attempt(u'build the point store', build_point_store, resource_id)
+    else:
+        _attempt(u'drop the side table', drop_side_table, resource_id)
+        _attempt(u'delete the point store', delete_point_store, resource_id)
+    _attempt(u'discard the cached tiles', delete_cached_tiles, resource_id)
+    # The precomputed data was written too, and may take a while to build
+    mark_written(resource_id)
+
+
+def build_stores(resource_id):
+    '''Build the side table and the point store of a resource, if they are enabled.
+    This is run by the build-stores command, or as a background job queued when the
+    geometries of the resource are populated (see queue_build_stores).
+
+    :param resource_id: the resource id
+
+    '''
+    mark_written(resource_id)
+    _attempt(u'build the side table', build_side_table, resource_id)
+    _attempt(u'build the point store', build_point_store, resource_id)
+    _attempt(u'discard the cached tiles', delete_cached_tiles, resource_id)
+    mark_written(resource_id)
+
+
+def _enqueue_build_stores(resource_id):
+    '''Queue a background job running build_stores on the given resource'''
+    toolkit.enqueue_job(build_stores, [resource_id],
+                        title=u'Build the map stores of resource {0}'.format(resource_id))
+
+
+def queue_build_stores(resource_id):
+    '''Queue a background job building the side table and the point store of a
+    resource, if either is enabled. Background jobs need CKAN 2.7 or later, and a
+    running worker (paster jobs worker); on earlier versions the stores are built by
+    the build-stores command.
+
+    :param resource_id: the resource id
+
+    '''
+    if not is_side_table_enabled() and store_dir() is None:
+        return
+    if not hasattr(toolkit, u'enqueue_job'):
+        log.info(u'Background jobs are not available: run the build-stores command to '
+                 u'build the map stores of resource %s', resource_id)
+        return
+    _attempt(u'queue the building of the map stores', _enqueue_build_stores,
+             resource_id)
+
+
+def resource_changed(resource_id):
+    '''Handle a change to the records of a resource. Its cached tiles are discarded,
+    and a background job recomputing its precomputed data is queued, unless one is
+    already queued: a series of writes (such as the batches of an import) is followed
+    by a single refresh. Until the job has run, the map is served from the previous
+    data. Without background jobs, the precomputed data is discarded instead (see
+    invalidate_resource).
+
+    :param resource_id: the resource id
+
+    '''
+    mark_written(resource_id)
+    _attempt(u'discard the cached tiles', delete_cached_tiles, resource_id)
+    if connect_to_redis is None or not hasattr(toolkit, u'enqueue_job'):
+        invalidate_resource(resource_id)
+        return
+    _attempt(u'queue the refresh of the map data', _enqueue_refresh, resource_id)
+
+
+def _enqueue_refresh(resource_id):
+    '''Queue a background job running refresh_changed_resource on the given
+    resource, unless one is already queued'''
+    if connect_to_redis().set(REFRESH_PENDING_KEY.format(resource_id), u'1', nx=True,
+                              ex=REFRESH_PENDING_TTL):
+        toolkit.enqueue_job(refresh_changed_resource, [resource_id],
+                            title=u'Refresh the map data of resource {0}'.format(
+                                resource_id))
+
+
+def refresh_changed_resource(resource_id):
+    '''Background job recomputing the precomputed data of a resource whose records
+    changed (see resource_changed). The statistics and occupancy bitmaps are
+    recomputed by this job, and the side table and point store by another one.
+
+    :param resource_id: the resource id
+
+    '''
+    # Writes made from now on queue another refresh
+    connect_to_redis().delete(REFRESH_PENDING_KEY.format(resource_id))
+    refresh_resource(resource_id, stores=False)
+    queue_build_stores(resource_id)
+
+
+def invalidate_resource(resource_id):
+    '''Discard the precomputed data of a resource, so the map falls back to live
+    queries. This is used when its records change and the data can't be refreshed by
+    a background job (see resource_changed).
+
+    :param resource_id: the resource id
+
+    '''
+    mark_written(resource_id)
+    _attempt(u'discard the map statistics', delete_stats, resource_id)
+    _attempt(u'discard the tile occupancy bitmaps', delete_occupancy, resource_id)
+    _attempt(u'drop the side table', drop_side_table, resource_id)
+    _attempt(u'delete the point store', delete_point_store, resource_id)
+    _attempt(u'discard the cached tiles', delete_cached_tiles, resource_id)
+
+
+def _report_progress(pid, table, done):
+    '''Log the progress of the CLUSTER command run by the given backend until `done`
+    is set. This relies on pg_stat_progress_cluster, which is only available from
+    Postgres 12; nothing is logged on earlier versions.
+
+    :param pid: the process id of the backend running CLUSTER
+    :param table: the table being reordered
+    :param done: threading.Event set once the command has completed
+
+    '''
+    while not done.wait(PROGRESS_INTERVAL):
+        try:
+            with _get_engine(write=True).connect() as connection:
+                row = connection.execute(
+                    u'SELECT phase, heap_blks_scanned, heap_blks_total '
+                    u'FROM pg_stat_progress_cluster WHERE pid = %(pid)s',
+                    {u'pid': pid}).fetchone()
+        except DBAPIError:
+            return
+        if row is not None:
+            percent = 100 * row[1] // row[2] if row[2] else 0
+            log.info(u'Reordering %s: %s (%s%% of the table scanned)', table, row[0],
+                     percent)
+
+
+def reorder_resource(resource_id, force=False, min_correlation=0.9):
+    '''Reorder the rows of the given resource's side table if it has one, or of its
+    table otherwise, by the Hilbert key of their geometries, so that the records of a
+    tile are read from a few contiguous pages.
+
+    The key index is created if needed, without blocking writes to the resource's
+    table. Reordering rewrites the table and blocks all access to it while it runs, so
+    tables that are still mostly in key order (as measured by the correlation between
+    their physical order and the key) are skipped. Rows added or updated since the last
+    reorder are appended in no particular order, so this should be run periodically.
+
+    :param resource_id: the resource id
+    :param force: if True, the table is reordered even if it is mostly in key order
+    :param min_correlation: the correlation above which tables are not reordered
+    :returns: True if the table was reordered, False if it was skipped
+
+    '''
+    ensure_hilbert_function()
+    with _get_engine(write=True).connect() as connection:
+        connection = connection.execution_options(isolation_level=u'AUTOCOMMIT')
+        quote = connection.dialect.identifier_preparer.quote_identifier
+        table = resource_id
+        if side_table_columns(connection, resource_id) is not None:
+            table = side_table_name(resource_id)
+        create_key_index(connection, table, concurrently=table == resource_id)
+        connection.execute(u'ANALYZE {0}'.format(quote(table)))
+        correlation = key_correlation(connection, table)
+        if not force and correlation is not None and correlation >= min_correlation:
+            log.info(u'Skipping %s, which is in key order (correlation %.2f)', table,
+                     correlation)
+            return False
+        log.info(u'Reordering %s (correlation %s)', table, correlation)
+        pid = connection.execute(u'SELECT pg_backend_pid()').scalar()
+        done = threading.Event()
+        reporter = threading.Thread(target=_report_progress, args=(pid, table, done))
+        reporter.daemon = True
+        reporter.start()
+        try:
+            connection.execute(u'CLUSTER {table} USING {index}'.format(
+                table=quote(table),
+                index=quote(key_index_name(table))
+                ))
+        finally:
+            done.set()
+        connection.execute(u'ANALYZE {0}'.format(quote(table)))
+    log.info(u'Reordered %s', table)
+    return True
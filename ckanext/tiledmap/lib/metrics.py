@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-map
+# Created by the Natural History Museum in London, UK
+
+import collections
+import math
+import threading
+
+# Number of latency samples kept for each resource and kind of request
+MAX_SAMPLES = 1000
+
+_latencies = {}
+_cache_counts = collections.defaultdict(lambda: [0, 0])
+_lock = threading.Lock()
+
+
+def record_latency(resource_id, kind, seconds):
+    '''Record the duration of a map request. Only the last MAX_SAMPLES durations of
+    each resource and kind are kept.
+
+    :param resource_id: the resource id
+    :param kind: the kind of request, such as 'map_info' or 'tile'
+    :param seconds: the duration of the request
+
+    '''
+    with _lock:
+        samples = _latencies.get((resource_id, kind))
+        if samples is None:
+            samples = _latencies[(resource_id, kind)] = collections.deque(
+                maxlen=MAX_SAMPLES)
+        samples.append(seconds)
+
+
+def record_cache(resource_id, hit):
+    '''Record whether a tile was served from the tile cache
+
+    :param resource_id: the resource id
+    :param hit: True if the tile was served from the cache, False if it was rendered
+
+    '''
+    with _lock:
+        _cache_counts[resource_id][0 if hit else 1] += 1
+
+
+def percentile(samples, fraction):
+    '''Return the given percentile of the samples, using the nearest rank method, or
+    None if there are no samples
+
+    :param samples: iterable of numbers
+    :param fraction: the percentile, between 0 and 1
+
+    '''
+    samples = sorted(samples)
+    if not samples:
+        return None
+    return samples[max(0, int(math.ceil(fraction * len(samples))) - 1)]
+
+
+def resource_metrics(resource_id):
+    '''Return the metrics recorded by this process for the given resource
+
+    :param resource_id: the resource id
+    :returns: dictionary defining tile_cache_hits, tile_cache_misses,
+              tile_cache_hit_rate (None if no tile was requested), and the p50 and p95
+              durations in milliseconds of map_info and tile requests (for instance
+              map_info_p95_ms), which are None if there are no samples
+
+    '''
+    with _lock:
+        hits, misses = _cache_counts.get(resource_id, (0, 0))
+        latencies = dict((kind, list(samples))
+                         for (rid, kind), samples in _latencies.items()
+                         if rid == resource_id)
+    metrics = {
+        u'tile_cache_hits': hits,
+        u'tile_cache_misses': misses,
+        u'tile_cache_hit_rate': float(hits) / (hits + misses) if hits + misses else None
+        }
+    for kind in (u'map_info', u'tile'):
+        for name, fraction in ((u'p50', 0.5), (u'p95', 0.95)):
+            value = percentile(latencies.get(kind, []), fraction)
+            metrics[u'{0}_{1}_ms'.format(kind, name)] = \
+                None if value is None else value * 1000
+    return metrics
+
+
+def reset_metrics():
+    '''Discard all the recorded metrics'''
+    with _lock:
+        _latencies.clear()
+        _cache_counts.clear()
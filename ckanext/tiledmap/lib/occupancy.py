@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-map
+# Created by the Natural History Museum in London, UK
+
+import time
+
+from ckanext.tiledmap.config import config
+from ckanext.tiledmap.db import _get_engine, get_map_engine, is_undefined_table
+from ckanext.tiledmap.lib.prepared import execute_prepared
+from ckanext.tiledmap.lib.query import geom_field, get_table
+from sqlalchemy import Column, Integer, LargeBinary, MetaData, Table, UnicodeText, \
+    and_, bindparam, cast, func
+from sqlalchemy.exc import ProgrammingError
+from sqlalchemy.sql import select
+
+# Half the width of the web mercator projection, in metres
+MERCATOR_EXTENT = 20037508.342789244
+
+metadata = MetaData()
+
+# Per-resource, per-zoom bitsets of the tiles that may contain geometries. Bit
+# (y * 2^zoom + x) of the bitmap of a zoom level is set if tile (x, y) is not empty.
+# The bitmaps are stored uncompressed so single bits can be read without fetching the
+# whole bitmap.
+occupancy_table = Table(
+    u'_tiledmap_occupancy', metadata,
+    Column(u'resource_id', UnicodeText, primary_key=True),
+    Column(u'zoom', Integer, primary_key=True, autoincrement=False),
+    Column(u'bitmap', LargeBinary, nullable=False)
+    )
+
+# Seconds for which tiles aren't looked up once the table was found missing, so each
+# tile doesn't make a failing query (and an error in the Postgres log) until bitmaps
+# are built
+MISSING_TABLE_TTL = 60
+
+_table_created = False
+
+# Time until which the table is assumed to be missing
+_table_missing_until = 0
+
+
+def _ensure_table():
+    '''Create the occupancy table if it doesn't exist yet'''
+    global _table_created
+    if not _table_created:
+        engine = _get_engine(write=True)
+        if not occupancy_table.exists(engine):
+            occupancy_table.create(engine, checkfirst=True)
+            # Store the bitmaps out of line and uncompressed, so reading a single byte
+            # only fetches the page that holds it
+            engine.execute(u'ALTER TABLE _tiledmap_occupancy ALTER COLUMN bitmap '
+                           u'SET STORAGE EXTERNAL')
+        _table_created = True
+
+
+def max_zoom():
+    '''Return the highest zoom level for which occupancy bitmaps are built, or -1 if
+    they are disabled'''
+    return int(config[u'tiledmap.occupancy.max_zoom'])
+
+
+def _occupied_tiles(connection, resource_id, zoom):
+    '''Return the set of (x, y) tiles containing geometries at the given zoom level
+
+    :param connection: the database connection
+    :param resource_id: the resource id
+    :param zoom: the zoom level
+
+    '''
+    table = get_table(resource_id, [geom_field()])
+    geom = table.c[geom_field()]
+    n = 2 ** zoom
+    scale = n / (2 * MERCATOR_EXTENT)
+    x = cast(func.floor((func.st_x(geom) + MERCATOR_EXTENT) * scale), Integer)
+    y = cast(func.floor((MERCATOR_EXTENT - func.st_y(geom)) * scale), Integer)
+    query = select([x, y], from_obj=table).where(geom != None).distinct()
+    return set((min(n - 1, max(0, row[0])), min(n - 1, max(0, row[1])))
+               for row in connection.execute(query))
+
+
+def _bitmap(tiles, zoom):
+    '''Return the bitmap of the given tiles, dilated by one tile: tiles next to an
+    occupied tile are marked as occupied too, as markers drawn near the edge of a tile
+    overflow into its neighbours. Columns wrap around the antimeridian.
+
+    :param tiles: set of (x, y) occupied tiles
+    :param zoom: the zoom level
+
+    '''
+    n = 2 ** zoom
+    bitmap = bytearray((n * n + 7) // 8)
+    for x, y in tiles:
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                ny = y + dy
+                if 0 <= ny < n:
+                    index = ny * n + (x + dx) % n
+                    bitmap[index // 8] |= 1 << (index % 8)
+    return bitmap
+
+
+def build_occupancy(resource_id):
+    '''Build and store the occupancy bitmaps of the given resource, for zoom levels 0
+    to `tiledmap.occupancy.max_zoom`
+
+    :param resource_id: the resource id
+
+    '''
+    top = max_zoom()
+    if top < 0:
+        return
+    global _table_missing_until
+    _ensure_table()
+    _table_missing_until = 0
+    with _get_engine(write=True).begin() as connection:
+        tiles = _occupied_tiles(connection, resource_id, top)
+        connection.execute(occupancy_table.delete().where(
+            occupancy_table.c.resource_id == resource_id))
+        for zoom in range(top, -1, -1):
+            shift = top - zoom
+            zoom_tiles = set((x >> shift, y >> shift) for x, y in tiles)
+            connection.execute(occupancy_table.insert().values(
+                resource_id=resource_id,
+                zoom=zoom,
+                bitmap=bytes(_bitmap(zoom_tiles, zoom))
+                ))
+
+
+def delete_occupancy(resource_id):
+    '''Delete the occupancy bitmaps of the given resource
+
+    :param resource_id: the resource id
+
+    '''
+    _ensure_table()
+    with _get_engine(write=True).begin() as connection:
+        connection.execute(occupancy_table.delete().where(
+            occupancy_table.c.resource_id == resource_id))
+
+
+def is_tile_empty(resource_id, z, x, y):
+    '''Return True if the given tile of the unfiltered map of the resource is known to
+    be empty.
+
+    Beyond `tiledmap.occupancy.max_zoom`, the tile's ancestor at that zoom level is
+    looked up: as bitmaps are dilated by a whole tile, an empty ancestor means the tile
+    is empty too.
+
+    The lookup is run as a prepared statement, as it is run for every tile. Until any
+    bitmaps are built the table doesn't exist, which is remembered for
+    MISSING_TABLE_TTL seconds.
+
+    :param resource_id: the resource id
+    :param z: zoom level
+    :param x: tile column
+    :param y: tile row
+    :returns: True if the tile is empty, False if it may contain geometries or if the
+              resource has no occupancy bitmaps
+
+    '''
+    global _table_missing_until
+    top = max_zoom()
+    if top < 0 or time.time() < _table_missing_until:
+        return False
+    if z > top:
+        x >>= z - top
+        y >>= z - top
+        z = top
+    n = 2 ** z
+    if not (0 <= x < n and 0 <= y < n):
+        return False
+    index = y * n + x
+
+    def build():
+        return select([func.get_byte(func.substring(
+            occupancy_table.c.bitmap, bindparam(u'position'), 1), 0)]).where(and_(
+                occupancy_table.c.resource_id == bindparam(u'resource_id'),
+                occupancy_table.c.zoom == bindparam(u'zoom')))
+
+    engine = get_map_engine(resource_id)
+    try:
+        with engine.connect() as connection:
+            row = execute_prepared(connection, (u'occupancy',), build, {
+                u'position': index // 8 + 1,
+                u'resource_id': resource_id,
+                u'zoom': z
+                }).fetchone()
+    except (ProgrammingError, engine.dialect.dbapi.ProgrammingError) as e:
+        # The table is only created when bitmaps are first built. The statement is
+        # prepared through the DBAPI, whose errors SQLAlchemy doesn't wrap.
+        if not is_undefined_table(e):
+            raise
+        _table_missing_until = time.time() + MISSING_TABLE_TTL
+        return False
+    if row is None:
+        return False
+    return not row[0] & (1 << (index % 8))
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-map
+# Created by the Natural History Museum in London, UK
+
+from ckanext.tiledmap.db import _get_engine
+from ckanext.tiledmap.lib.metrics import resource_metrics
+from ckanext.tiledmap.lib.stats import get_populated, get_stats
+
+# Sizes of a resource's table and indexes, its estimated row count and whether it has a
+# GiST (spatial) index. No row is returned if the table doesn't exist. This avoids
+# to_regclass, which needs Postgres 9.4.
+_TABLE_QUERY = u'''
+SELECT pg_table_size(c.oid) AS table_size,
+       pg_indexes_size(c.oid) AS index_size,
+       c.reltuples::bigint AS estimated_rows,
+       EXISTS(SELECT 1 FROM pg_index i
+              JOIN pg_class ic ON ic.oid = i.indexrelid
+              JOIN pg_am am ON am.oid = ic.relam
+              WHERE i.indrelid = c.oid AND am.amname = 'gist') AS spatial_index
+FROM pg_class c
+JOIN pg_namespace n ON n.oid = c.relnamespace
+WHERE n.nspname = 'public' AND c.relname = %(table)s AND c.relkind = 'r'
+'''
+
+
+def table_info(connection, resource_id):
+    '''Return the sizes of the given resource's table and indexes, its estimated row
+    count and whether it has a spatial index
+
+    :param connection: the database connection
+    :param resource_id: the resource id
+    :returns: dictionary defining table_size and index_size (in bytes),
+              estimated_rows and spatial_index, or None if the table doesn't exist
+
+    '''
+    row = connection.execute(_TABLE_QUERY, {
+        u'table': resource_id
+        }).fetchone()
+    if row is None:
+        return None
+    return dict(row.items())
+
+
+def resource_performance(views):
+    '''Return the performance figures of the resources of the given tiled map views:
+    their row and geometry counts, the time their geometries were last populated, the
+    size of their table and indexes, whether they have a spatial index, and the tile
+    cache hit rate and map request latencies recorded by this process (see
+    ckanext.tiledmap.lib.metrics).
+
+    :param views: list of resource view dictionaries
+    :returns: list of dictionaries, one per resource, ordered as the views
+
+    '''
+    resources = []
+    view_ids = {}
+    for view in views:
+        if view[u'resource_id'] not in view_ids:
+            resources.append(view[u'resource_id'])
+            view_ids[view[u'resource_id']] = []
+        view_ids[view[u'resource_id']].append(view[u'id'])
+    results = []
+    with _get_engine().connect() as connection:
+        for resource_id in resources:
+            info = table_info(connection, resource_id) or {}
+            stats = get_stats(resource_id)
+            populated = get_populated(resource_id)
+            result = {
+                u'resource_id': resource_id,
+                u'view_ids': view_ids[resource_id],
+                u'table_size': info.get(u'table_size'),
+                u'index_size': info.get(u'index_size'),
+                u'spatial_index': info.get(u'spatial_index', False),
+                # Exact counts are only known once the geometries are populated
+                u'row_count': info.get(u'estimated_rows'),
+                u'row_count_estimated': True,
+                u'geom_count': None,
+                u'geometries_populated': populated.isoformat() if populated else None
+                }
+            if stats is not None:
+                result.update({
+                    u'row_count': stats[u'total_count'],
+                    u'row_count_estimated': False,
+                    u'geom_count': stats[u'geom_count']
+                    })
+            result.update(resource_metrics(resource_id))
+            results.append(result)
+    return results
@@ -0,0 +1,383 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-map
+# Created by the Natural History Museum in London, UK
+
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+
+from ckanext.tiledmap.config import config
+from ckanext.tiledmap.db import _get_engine
+from ckanext.tiledmap.lib.occupancy import MERCATOR_EXTENT
+from ckanext.tiledmap.lib.query import geom_field, get_table
+from ckanext.tiledmap.lib.sidetable import query_table
+from sqlalchemy import func
+from sqlalchemy.sql import select
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+log = logging.getLogger(__name__)
+
+# Name of the link pointing at the current version of a resource's point store
+CURRENT = u'current'
+
+# Number of points read from the database at a time when building a point store
+BATCH_SIZE = 100000
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def store_dir():
+    '''Return the directory point stores are written to, or None if they are
+    disabled'''
+    return config[u'tiledmap.point_store.dir'] or None
+
+
+def store_zoom():
+    '''Return the zoom level of the tiles points are grouped by in point stores'''
+    return min(16, max(0, int(config[u'tiledmap.point_store.zoom'])))
+
+
+def _part1by1(values):
+    '''Spread the lower 32 bits of the given integers so that there is a zero bit
+    between each of them
+
+    :param values: integer or numpy array of int64
+
+    '''
+    values = values & 0xffffffff
+    values = (values | (values << 16)) & 0x0000ffff0000ffff
+    values = (values | (values << 8)) & 0x00ff00ff00ff00ff
+    values = (values | (values << 4)) & 0x0f0f0f0f0f0f0f0f
+    values = (values | (values << 2)) & 0x3333333333333333
+    return (values | (values << 1)) & 0x5555555555555555
+
+
+def _compact1by1(values):
+    '''Inverse of _part1by1: gather the even bits of the given integers
+
+    :param values: integer or numpy array of int64
+
+    '''
+    values = values & 0x5555555555555555
+    values = (values | (values >> 1)) & 0x3333333333333333
+    values = (values | (values >> 2)) & 0x0f0f0f0f0f0f0f0f
+    values = (values | (values >> 4)) & 0x00ff00ff00ff00ff
+    values = (values | (values >> 8)) & 0x0000ffff0000ffff
+    return (values | (values >> 16)) & 0xffffffff
+
+
+def morton_keys(x, y):
+    '''Return the Morton (Z-order) keys of the given tiles. At any zoom level up to
+    that of the tiles, the keys of the tiles covered by a single tile form a
+    contiguous range.
+
+    :param x: tile column, as an integer or a numpy array of int64
+    :param y: tile row, as an integer or a numpy array of int64
+
+    '''
+    return _part1by1(x) | (_part1by1(y) << 1)
+
+
+def morton_coordinates(keys):
+    '''Return the tiles of the given Morton keys
+
+    :param keys: numpy array of int64
+    :returns: tuple (columns, rows) of numpy arrays of int64
+
+    '''
+    return _compact1by1(keys), _compact1by1(keys >> 1)
+
+
+def density_zooms():
+    '''Return the zoom levels of the density rasters stored in point stores, in
+    increasing order'''
+    zooms = config[u'tiledmap.point_store.density_zooms'].split(u',')
+    return sorted(set(min(16, max(0, int(z))) for z in zooms if z.strip()))
+
+
+def tile_coordinates(mx, my, zoom):
+    '''Return the tiles containing the given web mercator points
+
+    :param mx: numpy array of x coordinates
+    :param my: numpy array of y coordinates
+    :param zoom: the zoom level
+    :returns: tuple (columns, rows) of numpy arrays of int64
+
+    '''
+    n = 2 ** zoom
+    scale = n / (2 * MERCATOR_EXTENT)
+    x = numpy.floor((mx + MERCATOR_EXTENT) * scale).astype(numpy.int64)
+    y = numpy.floor((MERCATOR_EXTENT - my) * scale).astype(numpy.int64)
+    return numpy.clip(x, 0, n - 1), numpy.clip(y, 0, n - 1)
+
+
+def density_rasters(mx, my, zooms):
+    '''Compute the density rasters of the given points: for each zoom level, the
+    Morton keys of the pixels (the tiles of zoom level + 8) holding points, in
+    increasing order, and the number of points in each. The points are only sorted
+    once, at the deepest zoom level; since the key of a pixel's parent is the key of
+    the pixel shifted by two bits, shallower rasters are merged from deeper ones.
+
+    :param mx: numpy array of web mercator x coordinates
+    :param my: numpy array of web mercator y coordinates
+    :param zooms: the zoom levels
+    :returns: generator of tuples (zoom, keys, counts), deepest zoom level first
+
+    '''
+    previous = max(zooms)
+    keys = numpy.sort(morton_keys(*tile_coordinates(mx, my, previous + 8)))
+    counts = numpy.ones(len(keys), dtype=numpy.int64)
+    for zoom in sorted(zooms, reverse=True):
+        keys = keys >> (2 * (previous - zoom))
+        previous = zoom
+        if len(keys):
+            starts = numpy.flatnonzero(numpy.concatenate([[True],
+                                                          keys[1:] != keys[:-1]]))
+            keys, counts = keys[starts], numpy.add.reduceat(counts, starts)
+        yield zoom, keys, counts
+
+
+class PointStore(object):
+    '''Read only, memory mapped point store of a resource.
+
+    The store holds the web mercator coordinates (as float32) and the record ids (as
+    int64) of the resource's points in separate arrays, sorted by the Morton key of the
+    tile containing each point at the store's zoom level. An offset index gives, for
+    each key, the position of the first point with that key, so the points of any
+    tile at or below the store's zoom level are a contiguous slice of the arrays.
+
+    The store also holds density rasters at a few zoom levels: the number of points
+    within each pixel that holds any, sorted by the Morton key of the pixels, so the
+    pixels of a tile are also a contiguous slice.
+    '''
+
+    def __init__(self, path):
+        '''
+        :param path: the directory holding the store's files
+        '''
+        self.path = path
+        with open(os.path.join(path, u'meta.json')) as f:
+            self.meta = json.load(f)
+        self.zoom = self.meta[u'zoom']
+        self.x = numpy.load(os.path.join(path, u'x.npy'), mmap_mode=u'r')
+        self.y = numpy.load(os.path.join(path, u'y.npy'), mmap_mode=u'r')
+        self.ids = numpy.load(os.path.join(path, u'id.npy'), mmap_mode=u'r')
+        self.index = numpy.load(os.path.join(path, u'index.npy'), mmap_mode=u'r')
+        self.density = {}
+        for zoom in self.meta.get(u'density_zooms', []):
+            self.density[zoom] = tuple(numpy.load(
+                os.path.join(path, u'density-{0}-{1}.npy'.format(zoom, name)),
+                mmap_mode=u'r') for name in (u'keys', u'counts'))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def tile_points(self, z, x, y):
+        '''Return the points within the given tile.
+
+        For tiles at or below the store's zoom level, the arrays returned are views
+        on the memory mapped files, so no data is copied. Deeper tiles are filtered
+        out of the points of their ancestor at the store's zoom level.
+
+        :param z: zoom level
+        :param x: tile column
+        :param y: tile row
+        :returns: tuple (x, y, ids) of numpy arrays
+
+        '''
+        if z <= self.zoom:
+            shift = self.zoom - z
+            start = morton_keys(x << shift, y << shift)
+            first, last = self.index[start], self.index[start + 4 ** shift]
+            return self.x[first:last], self.y[first:last], self.ids[first:last]
+        shift = z - self.zoom
+        key = morton_keys(x >> shift, y >> shift)
+        first, last = self.index[key], self.index[key + 1]
+        xs, ys, ids = self.x[first:last], self.y[first:last], self.ids[first:last]
+        size = 2 * MERCATOR_EXTENT / 2 ** z
+        left = x * size - MERCATOR_EXTENT
+        top = MERCATOR_EXTENT - y * size
+        mask = (xs >= left) & (xs < left + size) & (ys <= top) & (ys > top - size)
+        return xs[mask], ys[mask], ids[mask]
+
+    def tile_density(self, z, x, y):
+        '''Return the pixels of the given tile that hold points, and the number of
+        points in each, from the shallowest density raster at or below the tile's zoom
+        level. The number of pixels read is bounded by the size of the tile at the
+        raster's zoom level, whatever the number of points.
+
+        :param z: zoom level
+        :param x: tile column
+        :param y: tile row
+        :returns: tuple (zoom, x, y, counts), where x and y are the coordinates of the
+                  pixels at the raster's zoom level, or None if the store has no
+                  raster at or below the tile's zoom level
+
+        '''
+        zooms = [zoom for zoom in sorted(self.density) if zoom >= z]
+        if not zooms:
+            return None
+        keys, counts = self.density[zooms[0]]
+        shift = zooms[0] + 8 - z
+        start = morton_keys(x << shift, y << shift)
+        first, last = numpy.searchsorted(keys, [start, start + 4 ** shift])
+        columns, rows = morton_coordinates(numpy.asarray(keys[first:last]))
+        return zooms[0], columns, rows, counts[first:last]
+
+
+def write_point_store(resource_id, mx, my, ids):
+    '''Write the point store of the given resource from the given points, and make it
+    the current version of the store.
+
+    Each version is written to its own directory, and the `current` link is then
+    atomically replaced to point at it, so readers never see a partially written
+    store. Previous versions are deleted; processes that still have them memory mapped
+    keep reading them until they reopen the store. The density rasters of the zoom
+    levels listed in `tiledmap.point_store.density_zooms` are written along with the
+    points.
+
+    :param resource_id: the resource id
+    :param mx: numpy array of web mercator x coordinates
+    :param my: numpy array of web mercator y coordinates
+    :param ids: numpy array of record ids
+
+    '''
+    zoom = store_zoom()
+    directory = os.path.join(store_dir(), resource_id)
+    version = u'{0}-{1}'.format(int(time.time() * 1000), os.getpid())
+    path = os.path.join(directory, version)
+    os.makedirs(path)
+    mx = numpy.asarray(mx, dtype=numpy.float32)
+    my = numpy.asarray(my, dtype=numpy.float32)
+    # Compute the tiles from the stored (rounded) coordinates, so points are always
+    # found in the tile their coordinates fall in
+    keys = morton_keys(*tile_coordinates(mx.astype(numpy.float64),
+                                         my.astype(numpy.float64), zoom))
+    order = numpy.argsort(keys, kind=u'mergesort')
+    numpy.save(os.path.join(path, u'x.npy'), mx[order])
+    numpy.save(os.path.join(path, u'y.npy'), my[order])
+    numpy.save(os.path.join(path, u'id.npy'),
+               numpy.asarray(ids, dtype=numpy.int64)[order])
+    numpy.save(os.path.join(path, u'index.npy'), numpy.searchsorted(
+        keys[order], numpy.arange(4 ** zoom + 1), side=u'left').astype(numpy.int64))
+    zooms = density_zooms()
+    if zooms:
+        for density_zoom, density_keys, counts in density_rasters(
+                mx.astype(numpy.float64), my.astype(numpy.float64), zooms):
+            for name, values in ((u'keys', density_keys), (u'counts', counts)):
+                numpy.save(os.path.join(path, u'density-{0}-{1}.npy'.format(
+                    density_zoom, name)), values)
+    with open(os.path.join(path, u'meta.json'), u'w') as f:
+        json.dump({
+            u'zoom': zoom,
+            u'density_zooms': zooms,
+            u'count': len(order),
+            u'created': time.time()
+            }, f)
+    link = os.path.join(directory, CURRENT)
+    tmp_link = u'{0}.{1}'.format(link, version)
+    os.symlink(version, tmp_link)
+    os.rename(tmp_link, link)
+    for name in os.listdir(directory):
+        if name != version and not name.startswith(CURRENT):
+            shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+
+
+def _read_points(resource_id):
+    '''Read the web mercator coordinates and ids of the given resource's points from
+    the database, from its side table if it has one. The points are counted first, in
+    the same snapshot, so they are written straight into arrays of the right size as
+    they are read rather than held as rows.
+
+    :param resource_id: the resource id
+    :returns: tuple (x, y, ids) of numpy arrays
+
+    '''
+    table = get_table(query_table(resource_id, {}), [u'_id', geom_field()])
+    geom = table.c[geom_field()]
+    query = select([table.c[u'_id'], func.st_x(geom), func.st_y(geom)],
+                   from_obj=table).where(geom != None)
+    with _get_engine().connect() as connection:
+        connection = connection.execution_options(isolation_level=u'REPEATABLE READ')
+        with connection.begin():
+            count = connection.execute(
+                select([func.count()], from_obj=table).where(geom != None)).scalar()
+            mx = numpy.empty(count, dtype=numpy.float32)
+            my = numpy.empty(count, dtype=numpy.float32)
+            ids = numpy.empty(count, dtype=numpy.int64)
+            position = 0
+            result = connection.execution_options(stream_results=True).execute(query)
+            try:
+                while True:
+                    rows = result.fetchmany(BATCH_SIZE)
+                    if not rows:
+                        break
+                    batch = numpy.array(rows, dtype=numpy.float64)
+                    end = position + len(batch)
+                    ids[position:end] = batch[:, 0]
+                    mx[position:end] = batch[:, 1]
+                    my[position:end] = batch[:, 2]
+                    position = end
+            finally:
+                result.close()
+    return mx[:position], my[:position], ids[:position]
+
+
+def build_point_store(resource_id):
+    '''Snapshot the points of the given resource into its point store, if point stores
+    are enabled
+
+    :param resource_id: the resource id
+
+    '''
+    if store_dir() is None:
+        return
+    if numpy is None:
+        log.warning(u'numpy is not installed: the point store of resource %s can not '
+                    u'be built', resource_id)
+        return
+    write_point_store(resource_id, *_read_points(resource_id))
+
+
+def delete_point_store(resource_id):
+    '''Delete the point store of the given resource
+
+    :param resource_id: the resource id
+
+    '''
+    directory = store_dir()
+    if directory is not None:
+        shutil.rmtree(os.path.join(directory, resource_id), ignore_errors=True)
+
+
+def get_point_store(resource_id):
+    '''Return the current point store of the given resource, or None if it has none.
+    Stores are opened once per process, and reopened when they are rebuilt.
+
+    :param resource_id: the resource id
+
+    '''
+    directory = store_dir()
+    if directory is None or numpy is None:
+        return None
+    path = os.path.realpath(os.path.join(directory, resource_id, CURRENT))
+    with _stores_lock:
+        store = _stores.get(resource_id)
+        if store is None or store.path != path:
+            try:
+                store = PointStore(path)
+            except (IOError, OSError, ValueError):
+                _stores.pop(resource_id, None)
+                return None
+            _stores[resource_id] = store
+        return store
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-map
+# Created by the Natural History Museum in London, UK
+
+import hashlib
+import re
+import threading
+from collections import OrderedDict
+
+from sqlalchemy import text
+
+# Maximum number of compiled statements kept by each process, and of statements
+# prepared on each database connection
+MAX_STATEMENTS = 256
+
+# Key of the set of statements prepared on a database connection, in the
+# connection's info dictionary
+PREPARED_INFO_KEY = u'tiledmap_prepared'
+
+# Bind parameter placeholders of statements compiled for psycopg2
+_PLACEHOLDER = re.compile(u'%\\(([^)]+)\\)s')
+
+_statements = OrderedDict()
+_statements_lock = threading.Lock()
+
+
+class Statement(object):
+    '''A query compiled to be prepared on the database server'''
+
+    def __init__(self, sql, names, defaults):
+        '''
+        :param sql: the query's SQL, with positional ($1, $2...) parameters
+        :param names: the names of the bind parameters, in order
+        :param defaults: dictionary of bind parameter values set when the query was
+                         built, which are used for the parameters that aren't given
+                         when the statement is executed
+        '''
+        self.sql = sql
+        self.names = names
+        self.defaults = defaults
+        self.name = u'tiledmap_' + hashlib.md5(sql.encode(u'utf-8')).hexdigest()[:16]
+
+
+def compile_statement(query, dialect):
+    '''Compile the given query into a Statement
+
+    :param query: an SQLAlchemy query, or an SQL string with :name parameters
+    :param dialect: the dialect of the database the statement is prepared on
+
+    '''
+    if isinstance(query, basestring):
+        query = text(query)
+    compiled = query.compile(dialect=dialect)
+    names = []
+
+    def placeholder(match):
+        name = match.group(1)
+        if name not in names:
+            names.append(name)
+        return u'${0}'.format(names.index(name) + 1)
+
+    sql = _PLACEHOLDER.sub(placeholder, unicode(compiled)).replace(u'%%', u'%')
+    return Statement(sql, names, dict(compiled.params))
+
+
+def get_statement(key, build, dialect):
+    '''Return the compiled statement of the given key, building and compiling it if it
+    isn't cached
+
+    :param key: hashable identifying the query
+    :param build: function returning the query, called if the statement isn't cached
+    :param dialect: the dialect of the database the statement is prepared on
+
+    '''
+    with _statements_lock:
+        statement = _statements.pop(key, None)
+        if statement is not None:
+            _statements[key] = statement
+            return statement
+    statement = compile_statement(build(), dialect)
+    with _statements_lock:
+        _statements[key] = statement
+        while len(_statements) > MAX_STATEMENTS:
+            _statements.popitem(last=False)
+    return statement
+
+
+def statement_sql(name):
+    '''Return the SQL of the compiled statement of the given name, or None if this
+    process doesn't have it
+
+    :param name: the name of the statement, as used in EXECUTE statements
+
+    '''
+    with _statements_lock:
+        for statement in _statements.values():
+            if statement.name == name:
+                return statement.sql
+    return None
+
+
+def execute_prepared(connection, key, build, params=None):
+    '''Execute a query as a server-side prepared statement, so it is planned once per
+    database connection rather than every time it is run.
+
+    Queries are identified by a key describing their shape, such as the names of the
+    fields they filter on and the number of values of each: all the queries with the
+    same key must have the same SQL, and only differ by the values of their bind
+    parameters. The query is only built and compiled the first time the key is seen,
+    and only prepared the first time it is run on each connection.
+
+    :param connection: the database connection
+    :param key: hashable identifying the query's shape
+    :param build: function returning the query (an SQLAlchemy query or an SQL string
+                  with :name parameters). It is only called if the query of the key
+                  hasn't been compiled yet.
+    :param params: dictionary of bind parameter values. Parameters that aren't given
+                   keep the values they had when the query was built.
+    :returns: the result of the query
+
+    '''
+    statement = get_statement(key, build, connection.dialect)
+    # The info dictionary lives as long as the underlying DBAPI connection, and so as
+    # long as the statements prepared on it
+    prepared = connection.connection.info.setdefault(PREPARED_INFO_KEY, set())
+    if statement.name not in prepared:
+        if len(prepared) >= MAX_STATEMENTS:
+            connection.execute(u'DEALLOCATE ALL').close()
+            prepared.clear()
+        # Prepared through the DBAPI cursor, so the SQL isn't parsed for parameters
+        cursor = connection.connection.cursor()
+        try:
+            cursor.execute(u'PREPARE {0} AS {1}'.format(statement.name, statement.sql))
+        finally:
+            cursor.close()
+        prepared.add(statement.name)
+    values = dict(statement.defaults)
+    values.update(params or {})
+    if not statement.names:
+        return connection.execute(u'EXECUTE {0}'.format(statement.name))
+    return connection.execute(u'EXECUTE {0} ({1})'.format(
+        statement.name, u', '.join(u'%({0})s'.format(n) for n in statement.names)),
+        dict((n, values[n]) for n in statement.names))
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-map
+# Created by the Natural History Museum in London, UK
+
+from ckanext.tiledmap.config import config
+from sqlalchemy import Column, MetaData, Table, and_, bindparam, func, or_
+
+# The filter used by the map to restrict records to a drawn shape
+GEOM_FILTER = u'_tmgeom'
+
+
+def geom_field():
+    '''Return the name of the web mercator geometry column'''
+    return config[u'tiledmap.geom_field']
+
+
+def geom_field_4326():
+    '''Return the name of the WGS84 geometry column'''
+    return config[u'tiledmap.geom_field_4326']
+
+
+def get_table(resource_id, columns):
+    '''Return an SQLAlchemy table object for the given datastore resource, defining
+    only the given columns.
+
+    :param resource_id: the resource id (and table name)
+    :param columns: iterable of column names to define on the table
+
+    '''
+    metadata = MetaData()
+    names = []
+    for name in columns:
+        if name not in names:
+            names.append(name)
+    return Table(resource_id, metadata, *[Column(name) for name in names])
+
+
+def filter_columns(filters, q=None):
+    '''Return the list of columns needed to apply the given filters
+
+    :param filters: dictionary of field name to list of values
+    :param q: full text query, if any
+
+    '''
+    columns = []
+    for field in filters:
+        if field == GEOM_FILTER:
+            columns.append(geom_field_4326())
+        else:
+            columns.append(field)
+    if q:
+        columns.append(u'_full_text')
+    return columns
+
+
+def _filter_param(position, index):
+    '''Return the name of the bind parameter of a filter value
+
+    :param position: the position of the filtered field, in the sorted field names
+    :param index: the position of the value in the field's values
+
+    '''
+    return u'filter_{0}_{1}'.format(position, index)
+
+
+def filter_clauses(table, filters, q=None):
+    '''Return the list of where clauses that apply the map filters to the given table.
+
+    Field filters are matched for equality (any of the values for a field may match),
+    the `_tmgeom` filter restricts records to those intersecting any of the given WKT
+    geometries, and `q` is matched against the datastore full text index.
+
+    The values are bound to parameters named after the position of the field and of
+    the value (see filter_params), so queries with the same filter_shape have the
+    same SQL.
+
+    :param table: the table, as returned by get_table
+    :param filters: dictionary of field name to list of values
+    :param q: full text query, if any
+
+    '''
+    clauses = []
+    for position, (field, values) in enumerate(sorted(filters.items())):
+        params = [bindparam(_filter_param(position, i), value)
+                  for i, value in enumerate(values)]
+        if field == GEOM_FILTER:
+            column = table.c[geom_field_4326()]
+            clauses.append(or_(*[
+                func.st_intersects(column, func.st_geomfromtext(param, 4326))
+                for param in params
+                ]))
+        else:
+            clauses.append(table.c[field].in_(params))
+    if q:
+        clauses.append(table.c[u'_full_text'].op(u'@@')(
+            func.plainto_tsquery(bindparam(u'filter_q', q))))
+    return clauses
+
+
+def filter_shape(filters, q=None):
+    '''Return the shape of the given filters: the filtered fields and their number of
+    values, and whether there is a full text query. Filters of the same shape only
+    differ by the values of the bind parameters of their clauses.
+
+    :param filters: dictionary of field name to list of values
+    :param q: full text query, if any
+
+    '''
+    return tuple((field, len(values)) for field, values in sorted(filters.items())), \
+        bool(q)
+
+
+def filter_params(filters, q=None):
+    '''Return the values of the bind parameters of the clauses of the given filters
+
+    :param filters: dictionary of field name to list of values
+    :param q: full text query, if any
+    :returns: dictionary of parameter name to value
+
+    '''
+    params = {}
+    for position, (field, values) in enumerate(sorted(filters.items())):
+        for i, value in enumerate(values):
+            params[_filter_param(position, i)] = value
+    if q:
+        params[u'filter_q'] = q
+    return params
+
+
+def apply_filters(query, table, filters, q=None):
+    '''Apply the map filters to the given select query
+
+    :param query: the select query
+    :param table: the table, as returned by get_table
+    :param filters: dictionary of field name to list of values
+    :param q: full text query, if any
+
+    '''
+    clauses = filter_clauses(table, filters, q)
+    if clauses:
+        query = query.where(and_(*clauses))
+    return query
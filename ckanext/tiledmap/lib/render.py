@@ -0,0 +1,480 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-map
+# Created by the Natural History Museum in London, UK
+
+import math
+
+from ckanext.tiledmap.config import config
+from ckanext.tiledmap.lib.occupancy import MERCATOR_EXTENT
+from ckanext.tiledmap.lib.tile_cache import encode_png
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Width and height of the tiles, in pixels
+TILE_SIZE = 256
+
+
+def use_builtin_renderer():
+    '''Return True if image tiles are rendered by the builtin renderer, which requires
+    numpy, rather than by the windshaft renderers'''
+    return config[u'tiledmap.renderer'] == u'builtin' and numpy is not None
+
+
+def parse_color(color):
+    '''Return the (red, green, blue) components of the given colour
+
+    :param color: colour as '#RRGGBB' or '#RGB'
+
+    '''
+    color = color.strip().lstrip(u'#')
+    if len(color) == 3:
+        color = u''.join(c * 2 for c in color)
+    return tuple(int(color[i:i + 2], 16) for i in (0, 2, 4))
+
+
+def gradient_table(gradient):
+    '''Return the 256 colours of the given gradient, as a (256, 3) array
+
+    :param gradient: comma separated list of colours, evenly spread over the gradient
+
+    '''
+    colors = numpy.array([parse_color(c) for c in gradient.split(u',')],
+                         dtype=numpy.float64)
+    stops = numpy.linspace(0, 255, len(colors))
+    positions = numpy.arange(256)
+    return numpy.column_stack([numpy.interp(positions, stops, colors[:, i])
+                               for i in range(3)]).astype(numpy.uint8)
+
+
+def to_png(image):
+    '''Encode the given RGBA image as a PNG
+
+    :param image: (height, width, 4) array of uint8
+
+    '''
+    height, width = image.shape[:2]
+    scanlines = numpy.zeros((height, 1 + width * 4), dtype=numpy.uint8)
+    scanlines[:, 1:] = image.reshape(height, width * 4)
+    return encode_png(width, height, scanlines.tobytes())
+
+
+def pixel_coordinates(mx, my, z, x, y):
+    '''Return the position, in pixels from the top left corner of the given tile, of
+    the given web mercator points
+
+    :param mx: array of x coordinates
+    :param my: array of y coordinates
+    :param z: zoom level
+    :param x: tile column
+    :param y: tile row
+    :returns: tuple (px, py) of float64 arrays
+
+    '''
+    scale = TILE_SIZE * 2 ** z / (2 * MERCATOR_EXTENT)
+    px = (numpy.asarray(mx, dtype=numpy.float64) + MERCATOR_EXTENT) * scale
+    py = (MERCATOR_EXTENT - numpy.asarray(my, dtype=numpy.float64)) * scale
+    return px - x * TILE_SIZE, py - y * TILE_SIZE
+
+
+def _pixel_mask(px, py, margin):
+    '''Return the mask of the pixels hit by the given points, on a canvas extending
+    the tile by `margin` pixels on each side. Points outside of the canvas are dropped.
+
+    :param px: array of x pixel coordinates, relative to the tile
+    :param py: array of y pixel coordinates, relative to the tile
+    :param margin: the width of the margin, in pixels
+    :returns: (size, size) array of booleans
+
+    '''
+    size = TILE_SIZE + 2 * margin
+    cx = numpy.floor(px).astype(numpy.int64) + margin
+    cy = numpy.floor(py).astype(numpy.int64) + margin
+    keep = (cx >= 0) & (cx < size) & (cy >= 0) & (cy < size)
+    mask = numpy.zeros(size * size, dtype=numpy.bool_)
+    mask[cy[keep] * size + cx[keep]] = True
+    return mask.reshape(size, size)
+
+
+def _dilate(mask, radius):
+    '''Return the mask of the pixels within the given distance of a pixel of the
+    given mask. The mask is shifted by each of the offsets within the radius, so the
+    cost only depends on the size of the mask and the radius.
+
+    :param mask: (size, size) array of booleans
+    :param radius: the distance, in pixels
+
+    '''
+    r = int(math.ceil(radius))
+    size = mask.shape[0]
+    padded = numpy.zeros((size + 2 * r, size + 2 * r), dtype=numpy.bool_)
+    padded[r:r + size, r:r + size] = mask
+    result = numpy.zeros_like(mask)
+    for dy in range(-r, r + 1):
+        for dx in range(-r, r + 1):
+            if dx ** 2 + dy ** 2 <= radius ** 2:
+                result |= padded[r + dy:r + dy + size, r + dx:r + dx + size]
+    return result
+
+
+def render_plot(mx, my, z, x, y, marker_size, fill_color, line_color):
+    '''Render the plot style: a disc of `marker_size` pixels across per point, filled
+    with `fill_color` and outlined with `line_color`.
+
+    :param mx: array of web mercator x coordinates, including the points of the
+               neighbouring tiles whose markers may overlap the tile
+    :param my: array of web mercator y coordinates
+    :param z: zoom level
+    :param x: tile column
+    :param y: tile row
+    :param marker_size: the diameter of the markers, in pixels
+    :param fill_color: (red, green, blue) tuple
+    :param line_color: (red, green, blue) tuple
+    :returns: (256, 256, 4) array of uint8
+
+    '''
+    px, py = pixel_coordinates(mx, my, z, x, y)
+    return render_plot_pixels(px, py, marker_size, fill_color, line_color)
+
+
+def render_plot_pixels(px, py, marker_size, fill_color, line_color):
+    '''Render the plot style from the pixel coordinates of the points.
+
+    Points are first reduced to the mask of the pixels they fall on, which is then
+    dilated into the markers' outlines and fills, so the cost of drawing the markers
+    doesn't depend on the number of points. All the outlines are drawn before all the
+    fills, so overlapping markers merge into a single shape. As only the pixels the
+    points fall on matter, the image is the same whether several points in a pixel are
+    given or just one of them.
+
+    :param px: array of x pixel coordinates, relative to the tile
+    :param py: array of y pixel coordinates, relative to the tile
+    :param marker_size: the diameter of the markers, in pixels
+    :param fill_color: (red, green, blue) tuple
+    :param line_color: (red, green, blue) tuple
+    :returns: (256, 256, 4) array of uint8
+
+    '''
+    margin = int(math.ceil(marker_size / 2.0))
+    mask = _pixel_mask(px, py, margin=margin)
+    inner = slice(margin, margin + TILE_SIZE)
+    image = numpy.zeros((TILE_SIZE, TILE_SIZE, 4), dtype=numpy.uint8)
+    image[_dilate(mask, marker_size / 2.0)[inner, inner]] = tuple(line_color) + (255,)
+    image[_dilate(mask, marker_size / 2.0 - 1)[inner, inner]] = \
+        tuple(fill_color) + (255,)
+    return image
+
+
+def grid_cells(px, py, ids, resolution, radius):
+    '''Thin the given points to one representative per cell of a grid over the tile,
+    and spread each representative over the cells its marker covers, as required to
+    build UTFGrid tiles. The representative of a cell is its point with the lowest id.
+
+    :param px: array of x pixel coordinates, relative to the tile, including the
+               points of the neighbouring tiles whose markers may overlap the tile
+    :param py: array of y pixel coordinates, relative to the tile
+    :param ids: array of the ids of the points
+    :param resolution: the width of the cells, in pixels
+    :param radius: the radius of the markers, in pixels
+    :returns: tuple (grid, representatives, counts, columns, rows): grid is a
+              (cells, cells) array of int64, holding for each cell 0 if it isn't
+              covered by a marker or the position + 1 of its representative in the
+              other arrays. The other arrays hold, for each cell holding points, the
+              position of its representative within the given points, the number of
+              points in the cell and the cell's column and row (which are negative or
+              greater than the number of cells for cells outside the tile).
+
+    '''
+    cells = TILE_SIZE // resolution
+    r = int(math.ceil(float(radius) / resolution))
+    size = cells + 2 * r
+    cx = numpy.floor(numpy.asarray(px) / resolution).astype(numpy.int64) + r
+    cy = numpy.floor(numpy.asarray(py) / resolution).astype(numpy.int64) + r
+    inside = numpy.flatnonzero((cx >= 0) & (cx < size) & (cy >= 0) & (cy < size))
+    keys = cy[inside] * size + cx[inside]
+    order = numpy.lexsort((numpy.asarray(ids)[inside], keys))
+    keys = keys[order]
+    starts = numpy.flatnonzero(numpy.concatenate([[True], keys[1:] != keys[:-1]]))
+    counts = numpy.diff(numpy.append(starts, len(keys)))
+    occupied = keys[starts]
+    padded = numpy.zeros(size * size, dtype=numpy.int64)
+    padded[occupied] = numpy.arange(1, len(occupied) + 1)
+    padded = padded.reshape(size, size)
+    grid = padded[r:r + cells, r:r + cells].copy()
+    offsets = sorted((dx ** 2 + dy ** 2, dx, dy) for dx in range(-r, r + 1)
+                     for dy in range(-r, r + 1))
+    for distance, dx, dy in offsets[1:]:
+        if distance * resolution ** 2 > radius ** 2:
+            continue
+        shifted = padded[r + dy:r + dy + cells, r + dx:r + dx + cells]
+        empty = grid == 0
+        grid[empty] = shifted[empty]
+    return (grid, inside[order][starts], counts, occupied % size - r,
+            occupied // size - r)
+
+
+def cell_counts(px, py, resolution):
+    '''Return the number of points in each cell of a grid over the tile
+
+    :param px: array of x pixel coordinates, relative to the tile
+    :param py: array of y pixel coordinates, relative to the tile
+    :param resolution: the width of the cells, in pixels
+    :returns: (cells, cells) array of int64, indexed by row then column
+
+    '''
+    cells = TILE_SIZE // resolution
+    inside = (px >= 0) & (px < TILE_SIZE) & (py >= 0) & (py < TILE_SIZE)
+    column = (px[inside] // resolution).astype(numpy.int64)
+    row = (py[inside] // resolution).astype(numpy.int64)
+    return numpy.bincount(row * cells + column, minlength=cells * cells).reshape(
+        cells, cells)
+
+
+def render_gridded(mx, my, z, x, y, resolution, base_color):
+    '''Render the gridded style: each cell of `resolution` pixels containing points is
+    filled with `base_color`, more opaque as the number of points grows (by a fifth
+    of the full opacity for each power of 10).
+
+    :param mx: array of web mercator x coordinates
+    :param my: array of web mercator y coordinates
+    :param z: zoom level
+    :param x: tile column
+    :param y: tile row
+    :param resolution: the width of the cells, in pixels
+    :param base_color: (red, green, blue) tuple
+    :returns: (256, 256, 4) array of uint8
+
+    '''
+    counts = cell_counts(*pixel_coordinates(mx, my, z, x, y), resolution=resolution)
+    alpha = 0.3 + 0.2 * numpy.log10(numpy.maximum(counts, 1))
+    cells = numpy.zeros(counts.shape + (4,), dtype=numpy.uint8)
+    cells[..., :3] = base_color
+    cells[..., 3] = numpy.where(counts > 0, numpy.clip(alpha, 0, 1) * 255, 0)
+    return cells.repeat(resolution, axis=0).repeat(resolution, axis=1)
+
+
+def _kernel(radius):
+    '''Return a 1D gaussian kernel fading out at the given radius, with a peak of 1
+
+    :param radius: the radius of the kernel, in pixels
+
+    '''
+    r = int(math.ceil(radius))
+    offsets = numpy.arange(-r, r + 1, dtype=numpy.float64)
+    return numpy.exp(-0.5 * (offsets / max(radius / 2.0, 0.5)) ** 2)
+
+
+def density(px, py, radius, size=TILE_SIZE, weights=None):
+    '''Return the kernel density of the given points over a square of pixels: the sum,
+    for each pixel, of the kernel weights (1 at the point, fading to 0 at `radius`
+    pixels) of the points around it.
+
+    The points are first binned into pixels, and the separable kernel is then
+    applied along each axis as a weighted sum of shifted copies of the whole raster,
+    so the cost doesn't depend on the number of points.
+
+    :param px: array of x pixel coordinates, relative to the square
+    :param py: array of y pixel coordinates, relative to the square
+    :param radius: the radius of the kernel, in pixels
+    :param size: the width and height of the square, in pixels
+    :param weights: array of the number of points at each coordinate, if the points
+                    have already been binned
+    :returns: (size, size) array of float64
+
+    '''
+    kernel = _kernel(radius)
+    r = len(kernel) // 2
+    padded = size + 2 * r
+    cx = numpy.floor(px).astype(numpy.int64) + r
+    cy = numpy.floor(py).astype(numpy.int64) + r
+    keep = (cx >= 0) & (cx < padded) & (cy >= 0) & (cy < padded)
+    raster = numpy.bincount(cy[keep] * padded + cx[keep],
+                            None if weights is None else weights[keep],
+                            minlength=padded * padded).reshape(padded, padded)
+    raster = raster.astype(numpy.float64)
+    rows = numpy.zeros((padded, size))
+    for i, weight in enumerate(kernel):
+        rows += weight * raster[:, i:i + size]
+    result = numpy.zeros((size, size))
+    for i, weight in enumerate(kernel):
+        result += weight * rows[i:i + size, :]
+    return result
+
+
+def colorize(values, intensity, gradient):
+    '''Colour the given density raster: each point contributes `intensity` of opacity
+    at its centre, and the resulting opacity selects the colour along the gradient.
+
+    :param values: (height, width) array of densities
+    :param intensity: the opacity of a single point, between 0 and 1
+    :param gradient: the gradient, as returned by gradient_table
+    :returns: (height, width, 4) array of uint8
+
+    '''
+    opacity = 1 - (1 - min(max(intensity, 0.0), 0.999)) ** values
+    levels = numpy.clip(opacity * 255, 0, 255).astype(numpy.uint8)
+    image = numpy.zeros(values.shape + (4,), dtype=numpy.uint8)
+    image[..., :3] = gradient[levels]
+    image[..., 3] = levels
+    return image
+
+
+def render_heatmap(mx, my, z, x, y, marker_size, intensity, gradient):
+    '''Render the heatmap style
+
+    :param mx: array of web mercator x coordinates, including the points of the
+               neighbouring tiles within `marker_size` / 2 pixels of the tile
+    :param my: array of web mercator y coordinates
+    :param z: zoom level
+    :param x: tile column
+    :param y: tile row
+    :param marker_size: the diameter of the area each point contributes to, in pixels
+    :param intensity: the opacity of a single point, between 0 and 1
+    :param gradient: the gradient, as returned by gradient_table
+    :returns: (256, 256, 4) array of uint8
+
+    '''
+    px, py = pixel_coordinates(mx, my, z, x, y)
+    return colorize(density(px, py, marker_size / 2.0), intensity, gradient)
+
+
+def render_density(px, py, counts, marker_size, intensity, gradient):
+    '''Render the heatmap style from the pixels of a density raster, which gives the
+    same image as render_heatmap given the points binned in those pixels
+
+    :param px: array of x pixel coordinates, relative to the tile, of the pixels
+               holding points, including the pixels of the neighbouring tiles within
+               `marker_size` / 2 pixels of the tile
+    :param py: array of y pixel coordinates
+    :param counts: array of the number of points in each pixel
+    :param marker_size: the diameter of the area each point contributes to, in pixels
+    :param intensity: the opacity of a single point, between 0 and 1
+    :param gradient: the gradient, as returned by gradient_table
+    :returns: (256, 256, 4) array of uint8
+
+    '''
+    return colorize(density(px, py, marker_size / 2.0, weights=counts), intensity,
+                    gradient)
+
+
+def neighbourhood_points(store, z, x, y):
+    '''Return the points of the given tile and of its eight neighbours, which are
+    needed to draw the markers that overlap the tile's edges. Columns wrap around the
+    antimeridian, the points of wrapped columns being shifted by the width of the
+    world.
+
+    :param store: the resource's PointStore
+    :param z: zoom level
+    :param x: tile column
+    :param y: tile row
+    :returns: tuple (x, y, ids) of arrays of web mercator coordinates and record ids
+
+    '''
+    n = 2 ** z
+    xs = []
+    ys = []
+    all_ids = []
+    for dx in (-1, 0, 1):
+        column = (x + dx) % n
+        shift = (x + dx - column) // n * 2 * MERCATOR_EXTENT
+        for dy in (-1, 0, 1):
+            if 0 <= y + dy < n:
+                tile_x, tile_y, ids = store.tile_points(z, column, y + dy)
+                xs.append(tile_x + shift if shift else tile_x)
+                ys.append(tile_y)
+                all_ids.append(ids)
+    return numpy.concatenate(xs), numpy.concatenate(ys), numpy.concatenate(all_ids)
+
+
+def neighbourhood_density(store, z, x, y):
+    '''Return the pixels holding points in the given tile and its eight neighbours,
+    read from the store's density rasters. Columns wrap around the antimeridian, as in
+    neighbourhood_points.
+
+    :param store: the resource's PointStore
+    :param z: zoom level
+    :param x: tile column
+    :param y: tile row
+    :returns: tuple (px, py, counts) of arrays, the pixel coordinates being relative to
+              the tile at zoom level z, or None if the store has no density raster at
+              or below the tile's zoom level
+
+    '''
+    n = 2 ** z
+    pxs = []
+    pys = []
+    counts = []
+    for dx in (-1, 0, 1):
+        column = (x + dx) % n
+        shift = (x + dx - column) // n * n * TILE_SIZE
+        for dy in (-1, 0, 1):
+            if 0 <= y + dy < n:
+                pixels = store.tile_density(z, column, y + dy)
+                if pixels is None:
+                    return None
+                zoom, columns, rows, tile_counts = pixels
+                # Pixels of the raster's zoom level are nested within the tile's
+                # pixels, so scaling them down by a power of two bins them exactly
+                scale = 2.0 ** (zoom - z)
+                pxs.append(columns / scale + (shift - x * TILE_SIZE))
+                pys.append(rows / scale - y * TILE_SIZE)
+                counts.append(tile_counts)
+    return numpy.concatenate(pxs), numpy.concatenate(pys), numpy.concatenate(counts)
+
+
+def render_tile(store, style, z, x, y, params):
+    '''Render the given image tile from the resource's point store.
+
+    Heatmap and plot tiles are rendered from the store's density rasters when it has
+    one at or below the tile's zoom level, so their cost doesn't depend on the number
+    of points: the rasters hold each pixel holding points once, with the number of
+    points in it.
+
+    :param store: the resource's PointStore
+    :param style: the map style: one of plot, gridded or heatmap
+    :param z: zoom level
+    :param x: tile column
+    :param y: tile row
+    :param params: dictionary of request parameters, which may override the style's
+                   colours and intensity
+    :returns: the tile, as PNG
+
+    '''
+    if style == u'gridded':
+        mx, my = store.tile_points(z, x, y)[:2]
+        image = render_gridded(
+            mx, my, z, x, y,
+            int(config[u'tiledmap.style.gridded.grid_resolution']),
+            parse_color(params.get(u'base_color') or
+                        config[u'tiledmap.style.gridded.base_color']))
+    elif style == u'heatmap':
+        marker_size = int(config[u'tiledmap.style.heatmap.marker_size'])
+        intensity = float(params.get(u'intensity') or
+                          config[u'tiledmap.style.heatmap.intensity'])
+        gradient = gradient_table(config[u'tiledmap.style.heatmap.gradient'])
+        pixels = neighbourhood_density(store, z, x, y)
+        if pixels is not None:
+            image = render_density(*pixels, marker_size=marker_size,
+                                   intensity=intensity, gradient=gradient)
+        else:
+            mx, my = neighbourhood_points(store, z, x, y)[:2]
+            image = render_heatmap(mx, my, z, x, y, marker_size, intensity, gradient)
+    else:
+        pixels = neighbourhood_density(store, z, x, y)
+        if pixels is not None:
+            px, py = pixels[:2]
+        else:
+            px, py = pixel_coordinates(*neighbourhood_points(store, z, x, y)[:2], z=z,
+                                       x=x, y=y)
+        image = render_plot_pixels(
+            px, py,
+            int(config[u'tiledmap.style.plot.marker_size']),
+            parse_color(params.get(u'fill_color') or
+                        config[u'tiledmap.style.plot.fill_color']),
+            parse_color(params.get(u'line_color') or
+                        config[u'tiledmap.style.plot.line_color']))
+    return to_png(image)
@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-map
+# Created by the Natural History Museum in London, UK
+
+import collections
+import itertools
+import logging
+import multiprocessing
+import threading
+import time
+
+from ckanext.tiledmap.config import config
+from ckanext.tiledmap.lib.pointstore import get_point_store
+from ckanext.tiledmap.lib.render import render_tile
+from ckanext.tiledmap.lib.renderer import RendererBusy, RendererUnavailable
+
+log = logging.getLogger(__name__)
+
+# Maximum number of client sessions whose current zoom level is remembered
+MAX_SESSIONS = 10000
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+class RenderTimeout(RendererUnavailable):
+    '''Raised when a tile could not be rendered before its deadline'''
+    pass
+
+
+def _render(args):
+    '''Render an image tile from the resource's point store
+
+    :param args: tuple (resource id, style, z, x, y, params)
+    :returns: the tile, as PNG
+
+    '''
+    resource_id, style, z, x, y, params = args
+    store = get_point_store(resource_id)
+    if store is None:
+        raise RendererUnavailable(
+            u'Resource {0} has no point store'.format(resource_id))
+    return render_tile(store, style, z, x, y, params)
+
+
+def _serve(connection, function):
+    '''Main loop of the worker processes: receive jobs from the pipe, and send back
+    either an error message, or None followed by the result as raw bytes (so the
+    result is not pickled)
+
+    :param connection: the worker's end of the pipe
+    :param function: the function called on each job's arguments
+
+    '''
+    while True:
+        try:
+            args = connection.recv()
+        except (EOFError, IOError):
+            return
+        try:
+            result = function(args)
+        except Exception as e:
+            connection.send(unicode(e) or e.__class__.__name__)
+            continue
+        connection.send(None)
+        connection.send_bytes(result)
+
+
+class _Job(object):
+    '''A job waiting in the queue of a RenderPool'''
+
+    def __init__(self, args, session, z, deadline, sequence):
+        self.args = args
+        self.session = session
+        self.z = z
+        self.deadline = deadline
+        self.sequence = sequence
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+    def finish(self, result=None, error=None):
+        '''Set the outcome of the job, and wake up the caller waiting for it
+
+        :param result: the result, if the job succeeded
+        :param error: the exception to raise to the caller, if it failed
+
+        '''
+        self.result = result
+        self.error = error
+        self.done.set()
+
+
+class RenderPool(object):
+    '''Pool of worker processes rendering tiles, so CPU bound rendering neither blocks
+    the web server's threads nor is limited to a single core.
+
+    Jobs wait in a bounded queue until a worker is free; submitting a job when the
+    queue is full fails immediately. Each job has a deadline: jobs still queued at
+    their deadline are dropped, and workers still running a job at its deadline are
+    killed and replaced. Queued jobs for tiles at the zoom level the client session
+    last requested are run first, so tiles the user zoomed away from don't delay the
+    tiles they are looking at.
+    '''
+
+    def __init__(self, processes, queue_size, function=_render):
+        '''
+        :param processes: the number of worker processes
+        :param queue_size: the maximum number of jobs waiting for a worker
+        :param function: the function the workers call on each job's arguments, which
+                         must return a byte string
+        '''
+        self.queue_size = queue_size
+        self.function = function
+        self._jobs = []
+        self._zooms = collections.OrderedDict()
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._closed = False
+        self._processes = []
+        self._threads = [threading.Thread(target=self._dispatch)
+                         for i in range(processes)]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def _start_worker(self):
+        '''Start a worker process, and return (process, parent end of its pipe)'''
+        parent, child = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=_serve, args=(child, self.function))
+        process.daemon = True
+        process.start()
+        child.close()
+        with self._condition:
+            self._processes.append(process)
+        return process, parent
+
+    def _stop_worker(self, process, connection):
+        '''Kill the given worker process
+
+        :param process: the process
+        :param connection: the parent end of its pipe
+
+        '''
+        connection.close()
+        if process.is_alive():
+            process.terminate()
+        process.join()
+        with self._condition:
+            self._processes.remove(process)
+
+    def _priority(self, job):
+        '''Return the sort key of the given job: jobs at their session's current zoom
+        level first, then in the order they were submitted. The lock must be held.'''
+        current = job.session is not None and self._zooms.get(job.session) == job.z
+        return 0 if current else 1, job.sequence
+
+    def _next_job(self):
+        '''Remove and return the job to run next, failing the jobs that have passed
+        their deadline, or return None if there are no jobs. The lock must be held.'''
+        now = time.time()
+        for job in [j for j in self._jobs if j.deadline <= now]:
+            self._jobs.remove(job)
+            job.finish(error=RenderTimeout(u'The tile was not rendered in time'))
+        if not self._jobs:
+            return None
+        job = min(self._jobs, key=self._priority)
+        self._jobs.remove(job)
+        return job
+
+    def _dispatch(self):
+        '''Feed jobs to a worker process, for as long as the pool is open'''
+        process, connection = self._start_worker()
+        while True:
+            with self._condition:
+                job = self._next_job()
+                while job is None and not self._closed:
+                    self._condition.wait()
+                    job = self._next_job()
+                if self._closed:
+                    if job is not None:
+                        job.finish(error=RendererUnavailable(u'The pool is closed'))
+                    break
+            try:
+                connection.send(job.args)
+                if not connection.poll(max(0, job.deadline - time.time())):
+                    log.warning(u'Killing a render worker that overran its deadline')
+                    self._stop_worker(process, connection)
+                    process, connection = self._start_worker()
+                    job.finish(
+                        error=RenderTimeout(u'The tile was not rendered in time'))
+                    continue
+                error = connection.recv()
+                if error is None:
+                    job.finish(result=connection.recv_bytes())
+                else:
+                    job.finish(error=RendererUnavailable(error))
+            except (EOFError, IOError) as e:
+                log.warning(u'A render worker died: %s', e)
+                self._stop_worker(process, connection)
+                process, connection = self._start_worker()
+                job.finish(error=RendererUnavailable(u'The render worker died'))
+        self._stop_worker(process, connection)
+
+    def render(self, args, timeout, session=None, z=None):
+        '''Run the given job on a worker, and return its result
+
+        :param args: the arguments passed to the workers' function
+        :param timeout: the number of seconds after which the job is abandoned
+        :param session: the client session the job is run for, if any
+        :param z: the zoom level of the tile
+        :returns: the result, as a byte string
+        :raises RendererBusy: if the queue is full
+        :raises RenderTimeout: if the job didn't complete before the timeout
+        :raises RendererUnavailable: if the job failed
+
+        '''
+        with self._condition:
+            if self._closed:
+                raise RendererUnavailable(u'The pool is closed')
+            if len(self._jobs) >= self.queue_size:
+                raise RendererBusy(u'The render queue is full')
+            if session is not None:
+                self._zooms.pop(session, None)
+                self._zooms[session] = z
+                if len(self._zooms) > MAX_SESSIONS:
+                    self._zooms.popitem(last=False)
+            job = _Job(args, session, z, time.time() + timeout, next(self._sequence))
+            self._jobs.append(job)
+            self._condition.notify()
+        # The dispatchers finish every job by its deadline; the extra second only
+        # guards against the job being lost
+        if not job.done.wait(timeout + 1):
+            raise RenderTimeout(u'The tile was not rendered in time')
+        if job.error is not None:
+            raise job.error
+        return job.result
+
+    def close(self):
+        '''Stop the worker processes. Queued jobs fail.'''
+        with self._condition:
+            self._closed = True
+            for job in self._jobs:
+                job.finish(error=RendererUnavailable(u'The pool is closed'))
+            self._jobs = []
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join()
+
+
+def get_render_pool():
+    '''Return the render pool of this process, configured from the
+    `tiledmap.render_pool.*` options, or None if tiles are rendered in the web
+    server's threads'''
+    global _pool
+    processes = int(config[u'tiledmap.render_pool.processes'])
+    if processes <= 0:
+        return None
+    with _pool_lock:
+        if _pool is None:
+            _pool = RenderPool(processes,
+                               int(config[u'tiledmap.render_pool.queue_size']))
+        return _pool
+
+
+def render(resource_id, style, z, x, y, params, session=None):
+    '''Render an image tile from the resource's point store, in the render pool if it
+    is enabled and in the calling thread otherwise
+
+    :param resource_id: the resource id
+    :param style: the map style
+    :param z: zoom level
+    :param x: tile column
+    :param y: tile row
+    :param params: dictionary of request parameters
+    :param session: the client session requesting the tile, if any
+    :returns: the tile, as PNG
+    :raises RendererUnavailable: if the tile could not be rendered
+
+    '''
+    args = (resource_id, style, z, x, y, params)
+    pool = get_render_pool()
+    if pool is None:
+        return _render(args)
+    return pool.render(args, float(config[u'tiledmap.render_pool.deadline']), session,
+                       z)
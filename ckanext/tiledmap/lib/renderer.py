@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-map
+# Created by the Natural History Museum in London, UK
+
+import hashlib
+import time
+import urllib
+
+from ckanext.tiledmap.config import config
+from ckanext.tiledmap.db import _get_engine
+from ckanext.tiledmap.lib.circuit import OPEN, get_circuit
+from ckanext.tiledmap.lib.filters import canonical_params
+from ckanext.tiledmap.lib.hashring import HashRing
+from ckanext.tiledmap.lib.tile_cache import open_cache_writer
+
+try:
+    import urllib3
+except ImportError:
+    from requests.packages import urllib3
+
+# Headers of the renderer's responses that are passed on to the client
+FORWARDED_HEADERS = [u'Content-Type', u'Cache-Control', u'Expires', u'Last-Modified',
+                     u'ETag']
+
+# Request parameters used by the map controller, which are not passed on to the
+# renderer
+CONTROLLER_PARAMS = [u'resource_id', u'view_id', u'session', u'fetch_id']
+
+_pool_manager = None
+_ring = None
+
+
+class RendererUnavailable(Exception):
+    '''Raised when the renderer can't be reached, or when the circuits of all the
+    renderer backends are open'''
+    pass
+
+
+class RendererBusy(RendererUnavailable):
+    '''Raised when no connection to the renderer became available within
+    `tiledmap.tile_proxy.pool_timeout` seconds'''
+    pass
+
+
+def get_pool_manager():
+    '''Return the HTTP connection pool used to talk to the renderer.
+
+    Connections are kept alive and reused across requests. The pool holds at most
+    `tiledmap.tile_proxy.max_connections` connections per renderer, and requests wait
+    up to `tiledmap.tile_proxy.pool_timeout` seconds for a connection to be available,
+    which bounds the number of concurrent requests made to the renderer.
+    '''
+    global _pool_manager
+    if _pool_manager is None:
+        _pool_manager = urllib3.PoolManager(
+            maxsize=int(config[u'tiledmap.tile_proxy.max_connections']),
+            block=True,
+            retries=False,
+            timeout=urllib3.Timeout(
+                connect=float(config[u'tiledmap.tile_proxy.connect_timeout']),
+                read=float(config[u'tiledmap.tile_proxy.read_timeout'])
+                ))
+    return _pool_manager
+
+
+def get_backends():
+    '''Return the list of renderer backends, as 'host:port' strings.
+
+    These are read from `tiledmap.windshaft.hosts` if it is set, and otherwise from
+    `tiledmap.windshaft.host` and `tiledmap.windshaft.port`. Hosts listed more than
+    once are only returned once, in the position of their first occurrence.
+    '''
+    backends = []
+    for host in config[u'tiledmap.windshaft.hosts'].replace(u',', u' ').split():
+        if u':' not in host:
+            host = u'{0}:{1}'.format(host,
+                                     config.get(u'tiledmap.windshaft.port', u'80'))
+        if host not in backends:
+            backends.append(host)
+    if not backends:
+        backends.append(u'{0}:{1}'.format(config[u'tiledmap.windshaft.host'],
+                                          config[u'tiledmap.windshaft.port']))
+    return backends
+
+
+def get_ring():
+    '''Return the consistent hashing ring of the renderer backends'''
+    global _ring
+    backends = get_backends()
+    if _ring is None or _ring.nodes != backends:
+        _ring = HashRing(backends)
+    return _ring
+
+
+def renderer_params(params):
+    '''Return the query string parameters to pass on to the renderer, with the filters
+    and full text query in their canonical form (see ckanext.tiledmap.lib.filters), so
+    equivalent requests share their cached tiles
+
+    :param params: list of (name, value) request parameters
+    :returns: sorted list of (name, value) utf-8 encoded parameters, without the
+              controller specific parameters
+
+    '''
+    return sorted((k.encode(u'utf-8'), v.encode(u'utf-8'))
+                  for k, v in canonical_params(params) if k not in CONTROLLER_PARAMS)
+
+
+def params_digest(params):
+    '''Return a digest of the given renderer parameters, which identifies the tiles
+    rendered with them
+
+    :param params: list of (name, value) parameters, as returned by renderer_params
+
+    '''
+    return hashlib.md5(urllib.urlencode(sorted(params))).hexdigest()
+
+
+def tile_key(resource_id, z, x, y, params):
+    '''Return the key used to assign a tile to a renderer backend. Requests for the
+    same tile with the same parameters always go to the same backend, so they are
+    served from that backend's cache.
+
+    :param resource_id: the resource id
+    :param z: zoom level
+    :param x: tile column
+    :param y: tile row
+    :param params: list of (name, value) parameters, as returned by renderer_params
+
+    '''
+    return u'{0}/{1}/{2}/{3}/{4}'.format(resource_id, z, x, y, params_digest(params))
+
+
+def is_degraded():
+    '''Return True if the circuits of all the renderer backends are open, in which
+    case tiles are served from the cache or replaced by placeholders'''
+    return all(get_circuit(b).state == OPEN for b in get_backends())
+
+
+def tile_path(table, z, x, y, extension):
+    '''Return the path of the given tile on the renderer
+
+    :param table: the table the tile is rendered from
+    :param z: zoom level
+    :param x: tile column
+    :param y: tile row
+    :param extension: 'png' for image tiles, or 'grid.json' for UTFGrid tiles
+
+    '''
+    return u'/database/{database}/table/{table}/{z}/{x}/{y}.{extension}'.format(
+        database=_get_engine().url.database,
+        table=table,
+        z=z,
+        x=x,
+        y=y,
+        extension=extension
+        )
+
+
+def fetch_tile(resource_id, z, x, y, extension, params, table=None):
+    '''Request the given tile from the renderer, and return the response without
+    reading its body.
+
+    The tile is requested from the backend it is assigned to by consistent hashing,
+    and from the next backends on the ring if that fails. Each backend is guarded by a
+    circuit breaker (see ckanext.tiledmap.lib.circuit): failed, erroneous and slow
+    responses count against the backend's budget, and backends whose circuit is open
+    are not called at all.
+
+    When `tiledmap.tile_cache.dir` is set, successfully rendered tiles are written to
+    the cache as they are streamed.
+
+    :param resource_id: the resource id
+    :param z: zoom level
+    :param x: tile column
+    :param y: tile row
+    :param extension: 'png' for image tiles, or 'grid.json' for UTFGrid tiles
+    :param params: list of (name, value) query string parameters to pass on to the
+                   renderer. Controller specific parameters are removed.
+    :param table: the table to render the tile from (see
+                  ckanext.tiledmap.lib.sidetable.query_table). Defaults to the
+                  resource's table.
+    :returns: tuple (status, headers, body) where headers is a dictionary of the
+              headers to forward, and body is a ResponseBody
+    :raises RendererUnavailable: if none of the backends can be called
+    :raises RendererBusy: if all the connections to the renderer are in use
+
+    '''
+    params = renderer_params(params)
+    backends = get_ring().get_nodes(tile_key(resource_id, z, x, y, params))
+    path = tile_path(table or resource_id, z, x, y, extension)
+    error = u'The circuits of all the renderers are open'
+    for backend in backends:
+        circuit = get_circuit(backend)
+        if not circuit.allow():
+            continue
+        url = u'http://{backend}{path}?{query}'.format(
+            backend=backend,
+            path=path,
+            query=urllib.urlencode(params)
+            )
+        start = time.time()
+        try:
+            response = get_pool_manager().request(
+                u'GET', url, preload_content=False,
+                pool_timeout=float(config[u'tiledmap.tile_proxy.pool_timeout']))
+        except urllib3.exceptions.EmptyPoolError as e:
+            raise RendererBusy(unicode(e))
+        except (urllib3.exceptions.HTTPError, IOError) as e:
+            circuit.record(False)
+            error = unicode(e)
+            continue
+        circuit.record(response.status < 500, time.time() - start)
+        headers = dict((h, response.headers[h]) for h in FORWARDED_HEADERS
+                       if h in response.headers)
+        cache_writer = None
+        if response.status == 200:
+            cache_writer = open_cache_writer(resource_id, z, x, y, extension,
+                                             params_digest(params))
+        return response.status, headers, ResponseBody(response, cache_writer)
+    raise RendererUnavailable(error)
+
+
+class ResponseBody(object):
+    '''Iterable over the body of a renderer response, read in chunks as it is
+    iterated over. The connection is returned to the pool once the body has been fully
+    read, or when the iterable is closed (as WSGI servers do once the response is sent
+    or the client has gone away).
+    '''
+
+    def __init__(self, response, cache_writer=None):
+        '''
+        :param response: the urllib3 response
+        :param cache_writer: optional CacheWriter the body is written to as it is read
+        '''
+        self.response = response
+        self.cache_writer = cache_writer
+
+    def __iter__(self):
+        try:
+            for chunk in self.response.stream(
+                    int(config[u'tiledmap.tile_proxy.chunk_size'])):
+                if self.cache_writer is not None:
+                    self.cache_writer.write(chunk)
+                yield chunk
+            if self.cache_writer is not None:
+                self.cache_writer.commit()
+                self.cache_writer = None
+        finally:
+            self.close()
+
+    def close(self):
+        '''Return the connection to the pool, discarding the cached tile if it was
+        not fully read'''
+        if self.cache_writer is not None:
+            self.cache_writer.abort()
+            self.cache_writer = None
+        self.response.release_conn()
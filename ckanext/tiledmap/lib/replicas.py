@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-map
+# Created by the Natural History Museum in London, UK
+
+import hashlib
+import logging
+import math
+import random
+import threading
+import time
+
+from sqlalchemy import create_engine
+from sqlalchemy.exc import DBAPIError
+
+log = logging.getLogger(__name__)
+
+# Replication lag of a replica, in seconds: 0 when it isn't in recovery (it is a
+# primary), and NULL when it hasn't replayed any transaction yet
+_LAG_QUERY = u'SELECT CASE WHEN pg_is_in_recovery() THEN ' \
+             u'EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) ELSE 0 END'
+
+
+def parse_replicas(value):
+    '''Parse the list of read replicas of the `tiledmap.replicas` option: whitespace
+    separated database URLs, each optionally followed by '#' and its integer weight.
+
+    :param value: the option's value
+    :returns: list of (url, weight) tuples
+
+    '''
+    replicas = []
+    for entry in value.split():
+        url, weight = entry, 1
+        if u'#' in entry:
+            url, suffix = entry.rsplit(u'#', 1)
+            if not suffix.isdigit():
+                raise ValueError(u'Invalid replica weight: {0}'.format(suffix))
+            weight = int(suffix)
+        if weight > 0:
+            replicas.append((url, weight))
+    return replicas
+
+
+class Replica(object):
+    '''A read replica of the datastore database, whose replication lag is checked
+    periodically'''
+
+    def __init__(self, url, weight, measure=None):
+        '''
+        :param url: the database URL
+        :param weight: the share of the map queries routed to the replica, relative to
+                       the other replicas
+        :param measure: function returning the current lag of the replica in seconds,
+                        or None if it is unknown. Defaults to querying the replica.
+        '''
+        self.url = url
+        self.weight = weight
+        self._measure = measure or self._query_lag
+        self._engine = None
+        self._lock = threading.Lock()
+        self._lag = None
+        self._checked = None
+
+    @property
+    def engine(self):
+        '''The SQLAlchemy engine of the replica, created on first use'''
+        with self._lock:
+            if self._engine is None:
+                self._engine = create_engine(self.url)
+            return self._engine
+
+    def _query_lag(self):
+        '''Query the replica for its replication lag'''
+        with self.engine.connect() as connection:
+            lag = connection.execute(_LAG_QUERY).scalar()
+        return None if lag is None else float(lag)
+
+    def lag(self, check_interval):
+        '''Return the replication lag of the replica in seconds, or None if it is
+        unknown or the replica can't be reached. The lag is measured at most once every
+        `check_interval` seconds.
+
+        :param check_interval: the number of seconds a measurement is reused for
+
+        '''
+        with self._lock:
+            now = time.time()
+            if self._checked is not None and now - self._checked < check_interval:
+                return self._lag
+            # Other threads keep using the previous measurement meanwhile
+            self._checked = now
+        try:
+            lag = self._measure()
+        except DBAPIError as e:
+            log.warning(u'Failed to check the replication lag of a replica: %s', e)
+            lag = None
+        with self._lock:
+            self._lag = lag
+        return lag
+
+
+class ReplicaSet(object):
+    '''Routes map queries to the read replicas whose replication lag is within
+    `max_lag` seconds, in proportion to their weights.
+
+    Queries made on behalf of a client session always go to the same replica (as long
+    as its lag allows it), so the session's queries can cancel each other (see
+    ckanext.tiledmap.db.map_connection). Queries about a resource that was written
+    less than `max_lag` seconds ago are not routed to the replicas, which may not have
+    replayed the write yet.
+    '''
+
+    def __init__(self, replicas, max_lag, check_interval):
+        '''
+        :param replicas: list of Replica objects
+        :param max_lag: the replication lag, in seconds, above which a replica isn't
+                        used
+        :param check_interval: the number of seconds between two checks of the lag of
+                               each replica
+        '''
+        self.replicas = replicas
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self._written = {}
+        self._written_lock = threading.Lock()
+
+    def mark_written(self, resource_id):
+        '''Record that the given resource was just written on the primary
+
+        :param resource_id: the resource id
+
+        '''
+        with self._written_lock:
+            now = time.time()
+            self._written[resource_id] = now
+            # Forget the writes that no longer matter
+            for key in [k for k, t in self._written.items() if now - t > self.max_lag]:
+                del self._written[key]
+
+    def recently_written(self, resource_id):
+        '''Return True if the given resource was written less than `max_lag` seconds
+        ago
+
+        :param resource_id: the resource id
+
+        '''
+        with self._written_lock:
+            written = self._written.get(resource_id)
+        return written is not None and time.time() - written <= self.max_lag
+
+    def available(self):
+        '''Return the replicas whose replication lag is within `max_lag` seconds'''
+        available = []
+        for replica in self.replicas:
+            lag = replica.lag(self.check_interval)
+            if lag is not None and lag <= self.max_lag:
+                available.append(replica)
+        return available
+
+    def choose(self, resource_id=None, session=None):
+        '''Return the replica to route a map query to, or None if the query must go to
+        the primary.
+
+        :param resource_id: the resource queried, if any
+        :param session: the client session the query is made for, if any
+
+        '''
+        if resource_id is not None and self.recently_written(resource_id):
+            return None
+        replicas = self.available()
+        if not replicas:
+            return None
+        if session is None:
+            point = random.uniform(0, sum(r.weight for r in replicas))
+            for replica in replicas:
+                point -= replica.weight
+                if point <= 0:
+                    return replica
+            return replicas[-1]
+        # Weighted rendezvous hashing: the session keeps its replica as long as it is
+        # available, and sessions are spread in proportion to the weights
+        return max(replicas, key=lambda r: _rendezvous_score(session, r))
+
+
+def _rendezvous_score(key, replica):
+    '''Return the weighted rendezvous hashing score of the given replica for the given
+    key
+
+    :param key: the key being routed
+    :param replica: the Replica
+
+    '''
+    digest = hashlib.md5(u'{0}/{1}'.format(replica.url, key).encode(u'utf-8'))
+    # Uniform in ]0, 1[
+    point = (int(digest.hexdigest()[:13], 16) + 1) / float(16 ** 13 + 2)
+    return -replica.weight / math.log(point)
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-map
+# Created by the Natural History Museum in London, UK
+
+import Queue
+import logging
+import math
+import threading
+import time
+
+from ckanext.tiledmap.config import config
+from ckanext.tiledmap.lib.renderer import RendererUnavailable, fetch_tile, \
+    params_digest, renderer_params
+from ckanext.tiledmap.lib.sidetable import query_table
+from ckanext.tiledmap.lib.stats import compute_stats, get_stats
+from ckanext.tiledmap.lib.styles import enabled_styles, grid_params, has_grid, \
+    tile_params
+from ckanext.tiledmap.lib.tile_cache import cache_dir, get_cached_tile_mtime
+
+log = logging.getLogger(__name__)
+
+# Maximum latitude of the web mercator projection
+MAX_LATITUDE = 85.0511287798
+
+SEEDED = u'seeded'
+SKIPPED = u'skipped'
+FAILED = u'failed'
+
+
+def tile_range(bounds, z):
+    '''Return the tiles covering the given bounds at the given zoom level
+
+    :param bounds: ((lat min, lon min), (lat max, lon max))
+    :param z: zoom level
+    :returns: tuple ((x min, x max), (y min, y max)), inclusive
+
+    '''
+    (lat_min, lon_min), (lat_max, lon_max) = bounds
+    n = 2 ** z
+
+    def column(lon):
+        return min(n - 1, max(0, int(math.floor((lon + 180.0) / 360.0 * n))))
+
+    def row(lat):
+        lat = math.radians(max(-MAX_LATITUDE, min(MAX_LATITUDE, lat)))
+        y = (1.0 - math.log(math.tan(lat) + 1.0 / math.cos(lat)) / math.pi) / 2.0 * n
+        return min(n - 1, max(0, int(math.floor(y))))
+
+    return (column(lon_min), column(lon_max)), (row(lat_max), row(lat_min))
+
+
+def seed_requests(view, styles, min_zoom, max_zoom, bounds):
+    '''Generate the tile requests made by an unfiltered map of the given view, for the
+    tiles covering the given bounds
+
+    :param view: the resource view
+    :param styles: list of map styles to seed, or None for all the styles enabled on
+                   the view
+    :param min_zoom: the lowest zoom level
+    :param max_zoom: the highest zoom level
+    :param bounds: ((lat min, lon min), (lat max, lon max))
+    :returns: generator of (resource id, z, x, y, extension, params) tuples, where
+              params are the request parameters sent by the map
+
+    '''
+    requests = []
+    for style in enabled_styles(view):
+        if styles is not None and style not in styles:
+            continue
+        params = [(u'filters', u''), (u'style', style)]
+        requests.append((u'png', params + tile_params(style).items()))
+        if has_grid(view, style):
+            requests.append((u'grid.json', params + grid_params(view).items()))
+    for z in range(min_zoom, max_zoom + 1):
+        (x_min, x_max), (y_min, y_max) = tile_range(bounds, z)
+        for x in range(x_min, x_max + 1):
+            for y in range(y_min, y_max + 1):
+                for extension, params in requests:
+                    yield view[u'resource_id'], z, x, y, extension, params
+
+
+def seed_tile(request, force=False):
+    '''Render the given tile, storing it in the tile cache
+
+    :param request: (resource id, z, x, y, extension, params) tuple
+    :param force: if False, tiles that are already cached and fresh are skipped
+    :returns: one of SEEDED, SKIPPED or FAILED
+
+    '''
+    resource_id, z, x, y, extension, params = request
+    if not force:
+        mtime = get_cached_tile_mtime(resource_id, z, x, y, extension,
+                                      params_digest(renderer_params(params)))
+        if mtime is not None and time.time() - mtime < float(
+                config[u'tiledmap.tile_cache.ttl']):
+            return SKIPPED
+    fields = dict(params).get(u'interactivity', u'')
+    table = query_table(resource_id, {}, None, [f for f in fields.split(u',') if f])
+    try:
+        status, headers, body = fetch_tile(resource_id, z, x, y, extension, params,
+                                           table)
+        for chunk in body:
+            pass
+    except RendererUnavailable as e:
+        log.warning(u'Failed to render tile %s/%s/%s/%s.%s: %s', resource_id, z, x, y,
+                    extension, e)
+        return FAILED
+    if status != 200:
+        log.warning(u'Failed to render tile %s/%s/%s/%s.%s: status %s', resource_id, z,
+                    x, y, extension, status)
+        return FAILED
+    return SEEDED
+
+
+def _put(queue, item):
+    '''Put an item in the queue, waiting for a free slot in a way that can be
+    interrupted (with Ctrl-C)
+
+    :param queue: the queue
+    :param item: the item
+
+    '''
+    while True:
+        try:
+            queue.put(item, timeout=1)
+            return
+        except Queue.Full:
+            pass
+
+
+def seed(views, styles=None, min_zoom=0, max_zoom=6, workers=4, force=False):
+    '''Pre-render the tiles of the unfiltered maps of the given views, so the first
+    visitors are served from the cache.
+
+    Only the tiles covering the extent of each resource's geometries are rendered,
+    using `workers` concurrent requests. Tiles that are already cached are skipped
+    (unless `force` is set), so an interrupted run resumes where it stopped. If the
+    tile cache is disabled, the tiles are still rendered, which warms the renderers'
+    own caches.
+
+    :param views: list of tiled map views
+    :param styles: list of map styles to seed, or None for all the styles enabled on
+                   each view
+    :param min_zoom: the lowest zoom level
+    :param max_zoom: the highest zoom level
+    :param workers: the number of tiles rendered concurrently
+    :param force: if True, cached tiles are rendered again
+    :returns: dictionary of outcome (SEEDED, SKIPPED or FAILED) to number of tiles
+
+    '''
+    if cache_dir() is None:
+        log.warning(u'tiledmap.tile_cache.dir is not set: tiles are only cached by the '
+                    u'renderers, and interrupted runs start over')
+    counts = {
+        SEEDED: 0,
+        SKIPPED: 0,
+        FAILED: 0
+        }
+    counts_lock = threading.Lock()
+    queue = Queue.Queue(maxsize=workers * 4)
+
+    def work():
+        while True:
+            request = queue.get()
+            try:
+                if request is None:
+                    return
+                try:
+                    outcome = seed_tile(request, force)
+                except Exception:
+                    log.exception(u'Failed to render tile %s', request[:5])
+                    outcome = FAILED
+                with counts_lock:
+                    counts[outcome] += 1
+                    total = sum(counts.values())
+                if total % 1000 == 0:
+                    log.info(u'%s tiles processed: %s seeded, %s skipped, %s failed',
+                             total, counts[SEEDED], counts[SKIPPED], counts[FAILED])
+            finally:
+                queue.task_done()
+
+    threads = [threading.Thread(target=work) for i in range(workers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for view in views:
+        stats = get_stats(view[u'resource_id']) or compute_stats(view[u'resource_id'])
+        if not stats[u'bounds']:
+            log.info(u'Skipping resource %s, which has no geometries',
+                     view[u'resource_id'])
+            continue
+        log.info(u'Seeding view %s of resource %s', view[u'id'], view[u'resource_id'])
+        for request in seed_requests(view, styles, min_zoom, max_zoom,
+                                     stats[u'bounds']):
+            _put(queue, request)
+    for thread in threads:
+        _put(queue, None)
+    for thread in threads:
+        while thread.is_alive():
+            thread.join(1)
+    log.info(u'Done: %s seeded, %s skipped, %s failed', counts[SEEDED],
+             counts[SKIPPED], counts[FAILED])
+    return counts
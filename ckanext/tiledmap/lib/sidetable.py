@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-map
+# Created by the Natural History Museum in London, UK
+
+import logging
+import threading
+import time
+
+from ckanext.tiledmap.config import config
+from ckanext.tiledmap.db import _get_engine
+from ckanext.tiledmap.lib.layout import create_key_index, ensure_hilbert_function, \
+    key_index_name, spatial_key
+from ckanext.tiledmap.lib.prepared import execute_prepared
+from ckanext.tiledmap.lib.query import GEOM_FILTER, geom_field, geom_field_4326
+from ckanext.tiledmap.lib.styles import query_fields
+from ckanext.tiledmap.lib.views import get_tiledmap_views
+
+from ckan.plugins import toolkit
+
+log = logging.getLogger(__name__)
+
+# Seconds for which the columns of a side table are cached. The cache is cleared when
+# this process builds or drops the table, but other processes only see the change once
+# their cached columns expire.
+COLUMNS_TTL = 10
+
+# Resource id to (time cached, columns of the side table or None)
+_columns = {}
+_columns_lock = threading.Lock()
+
+
+def is_enabled():
+    '''Return True if side tables are maintained and queried'''
+    return toolkit.asbool(config[u'tiledmap.side_table'])
+
+
+def side_table_name(resource_id):
+    '''Return the name of the side table of the given resource
+
+    :param resource_id: the resource id
+
+    '''
+    return u'{0}_tiledmap'.format(resource_id)
+
+
+def side_table_fields(resource_id):
+    '''Return the columns copied to the side table of the given resource: the record
+    id, the geometries and the fields shown by any of the resource's tiled map views
+
+    :param resource_id: the resource id
+
+    '''
+    fields = [u'_id', geom_field(), geom_field_4326()]
+    for view in get_tiledmap_views({
+        u'ignore_auth': True
+        }, [resource_id]):
+        for field in sorted(query_fields(view)):
+            if field not in fields:
+                fields.append(field)
+    return fields
+
+
+def build_side_table(resource_id):
+    '''(Re)build the side table of the given resource, if side tables are enabled.
+
+    The side table holds a copy of the columns needed to render the resource's tiles
+    (see side_table_fields), so tile and extent queries don't read the whole width of
+    the resource's rows. Rows are stored in the order of their Hilbert key (see
+    ckanext.tiledmap.lib.layout), so records that are close to each other are stored
+    on the same pages. The table is built under a temporary name
+    and swapped in, so readers see either the old or the new table.
+
+    :param resource_id: the resource id
+
+    '''
+    if not is_enabled():
+        return
+    ensure_hilbert_function()
+    engine = _get_engine(write=True)
+    quote = engine.dialect.identifier_preparer.quote_identifier
+    name = side_table_name(resource_id)
+    build_name = name + u'_build'
+    with engine.begin() as connection:
+        connection.execute(u'DROP TABLE IF EXISTS {0}'.format(quote(build_name)))
+        connection.execute(
+            u'CREATE TABLE {build} AS SELECT {columns} FROM {table} '
+            u'ORDER BY {key}'.format(
+                build=quote(build_name),
+                columns=u', '.join(quote(f) for f in side_table_fields(resource_id)),
+                table=quote(resource_id),
+                key=spatial_key()
+                ))
+        connection.execute(u'CREATE UNIQUE INDEX ON {0} (_id)'.format(
+            quote(build_name)))
+        for field in [geom_field(), geom_field_4326()]:
+            connection.execute(u'CREATE INDEX ON {0} USING gist ({1})'.format(
+                quote(build_name), quote(field)))
+        create_key_index(connection, build_name)
+        connection.execute(u'DROP TABLE IF EXISTS {0}'.format(quote(name)))
+        connection.execute(u'ALTER TABLE {0} RENAME TO {1}'.format(quote(build_name),
+                                                                    quote(name)))
+        connection.execute(u'ALTER INDEX {0} RENAME TO {1}'.format(
+            quote(key_index_name(build_name)), quote(key_index_name(name))))
+        connection.execute(u'ANALYZE {0}'.format(quote(name)))
+    _forget_columns(resource_id)
+    log.info(u'Built the side table of resource %s', resource_id)
+
+
+def drop_side_table(resource_id):
+    '''Drop the side table of the given resource, if it exists
+
+    :param resource_id: the resource id
+
+    '''
+    engine = _get_engine(write=True)
+    with engine.begin() as connection:
+        connection.execute(u'DROP TABLE IF EXISTS {0}'.format(
+            engine.dialect.identifier_preparer.quote_identifier(
+                side_table_name(resource_id))))
+    _forget_columns(resource_id)
+
+
+def side_table_columns(connection, resource_id):
+    '''Return the set of columns of the side table of the given resource, or None if
+    it doesn't exist
+
+    :param connection: the database connection
+    :param resource_id: the resource id
+
+    '''
+    result = execute_prepared(
+        connection, (u'side_table_columns',), lambda: (
+            u"SELECT a.attname FROM pg_attribute a JOIN pg_class c "
+            u"ON c.oid = a.attrelid JOIN pg_namespace n ON n.oid = c.relnamespace "
+            u"WHERE n.nspname = 'public' AND c.relname = :table AND a.attnum > 0 "
+            u"AND NOT a.attisdropped"), {u'table': side_table_name(resource_id)})
+    columns = set(row[0] for row in result)
+    result.close()
+    return columns or None
+
+
+def _cached_columns(resource_id):
+    '''Return the set of columns of the side table of the given resource, or None if
+    it doesn't exist, as cached for COLUMNS_TTL seconds
+
+    :param resource_id: the resource id
+
+    '''
+    with _columns_lock:
+        cached = _columns.get(resource_id)
+    if cached is not None and time.time() < cached[0] + COLUMNS_TTL:
+        return cached[1]
+    with _get_engine().connect() as connection:
+        columns = side_table_columns(connection, resource_id)
+    with _columns_lock:
+        _columns[resource_id] = (time.time(), columns)
+    return columns
+
+
+def _forget_columns(resource_id):
+    '''Clear the cached columns of the side table of the given resource
+
+    :param resource_id: the resource id
+
+    '''
+    with _columns_lock:
+        _columns.pop(resource_id, None)
+
+
+def query_table(resource_id, filters, q=None, fields=()):
+    '''Return the name of the table to query for the given map request: the side table
+    of the resource if it exists and can answer the request, and otherwise the
+    resource's own table.
+
+    The side table can only answer requests that are not filtered, or only filtered
+    by the drawn selection, and that only need columns it holds. The columns of the
+    side table are cached (see COLUMNS_TTL).
+
+    :param resource_id: the resource id
+    :param filters: dictionary of field name to list of values
+    :param q: full text query, if any
+    :param fields: the fields needed besides the geometries and the record id
+
+    '''
+    if not is_enabled() or q or set(filters) - set([GEOM_FILTER]):
+        return resource_id
+    columns = _cached_columns(resource_id)
+    if columns is None or set(fields) - columns:
+        return resource_id
+    return side_table_name(resource_id)
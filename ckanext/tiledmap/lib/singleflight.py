@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-map
+# Created by the Natural History Museum in London, UK
+
+import cPickle
+import errno
+import fcntl
+import hashlib
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from ckanext.tiledmap.config import config
+
+_single_flight = None
+
+# Seconds between two attempts to take a lock file held by another process
+LOCK_POLL_INTERVAL = 0.05
+
+
+class LockTimeout(Exception):
+    '''Raised when a call waited longer than allowed on the same call in another
+    process'''
+    pass
+
+
+class _Call(object):
+    '''A computation in progress, shared by all the callers waiting on it'''
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    '''Deduplicate concurrent identical computations within a process.
+
+    Concurrent calls to `do` with the same key wait on a single invocation of the
+    function, and all get its result (or exception). Once the computation is over, the
+    next call with the same key invokes the function again: nothing is cached.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, function, retry_on=()):
+        '''Invoke the function and return its result, unless a call with the same key
+        is already in progress, in which case wait for and return that call's result.
+
+        :param key: a hashable key identifying the computation
+        :param function: function that takes no parameters and performs the computation
+        :param retry_on: tuple of exception classes which, when raised by the call being
+                         waited on, are specific to the caller that made it. Waiting
+                         callers then make the call again rather than raising them.
+
+        '''
+        while True:
+            with self._lock:
+                call = self._calls.get(key)
+                leader = call is None
+                if leader:
+                    call = _Call()
+                    self._calls[key] = call
+            if leader:
+                break
+            call.event.wait()
+            if call.error is None:
+                return call.result
+            if not isinstance(call.error[1], retry_on):
+                raise call.error[0], call.error[1], call.error[2]
+        try:
+            call.result = function()
+            return call.result
+        except:
+            call.error = sys.exc_info()
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+
+
+class FileSingleFlight(SingleFlight):
+    '''Deduplicate concurrent identical computations across processes on the same host.
+
+    Calls are first deduplicated within the process, and then serialised across
+    processes using a lock file per key. The process that computes a result stores it
+    next to the lock file, and processes that were waiting on the lock use that result
+    if it is less than `result_ttl` seconds old. Results must be picklable. Calls that
+    wait more than `wait_timeout` seconds on the lock raise LockTimeout.
+    '''
+
+    def __init__(self, lock_dir, result_ttl, wait_timeout=30):
+        super(FileSingleFlight, self).__init__()
+        self.lock_dir = lock_dir
+        self.result_ttl = result_ttl
+        self.wait_timeout = wait_timeout
+        if not os.path.isdir(lock_dir):
+            try:
+                os.makedirs(lock_dir)
+            except OSError:
+                # Another process may have created it meanwhile
+                if not os.path.isdir(lock_dir):
+                    raise
+
+    def do(self, key, function, retry_on=()):
+        '''Invoke the function and return its result, unless a call with the same key
+        is already in progress in this or another process, in which case wait for and
+        return that call's result.
+
+        :param key: a picklable key identifying the computation
+        :param function: function that takes no parameters and performs the computation
+        :param retry_on: tuple of exception classes which, when raised by the call being
+                         waited on, cause waiting callers to make the call again
+
+        '''
+        return super(FileSingleFlight, self).do(
+            key, lambda: self._do_locked(key, function), retry_on)
+
+    def _do_locked(self, key, function):
+        '''Invoke the function while holding the lock file of the given key, unless a
+        fresh result is available.
+
+        :param key: a picklable key identifying the computation
+        :param function: function that takes no parameters and performs the computation
+
+        '''
+        path = os.path.join(self.lock_dir,
+                            hashlib.sha1(cPickle.dumps(key, 2)).hexdigest())
+        with open(path + u'.lock', u'a') as lock_file:
+            self._lock_file(lock_file)
+            try:
+                try:
+                    if time.time() - os.path.getmtime(path) < self.result_ttl:
+                        with open(path, u'rb') as result_file:
+                            return cPickle.load(result_file)
+                except (OSError, IOError, EOFError, cPickle.UnpicklingError):
+                    pass
+                result = function()
+                fd, tmp_path = tempfile.mkstemp(dir=self.lock_dir)
+                with os.fdopen(fd, u'wb') as result_file:
+                    cPickle.dump(result, result_file, 2)
+                os.rename(tmp_path, path)
+                return result
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _lock_file(self, lock_file):
+        '''Take the given lock file, polling for up to `wait_timeout` seconds while
+        another process holds it, as a process stuck on the call must not block the
+        others forever.
+
+        :param lock_file: the open lock file
+        :raises LockTimeout: if the lock could not be taken in time
+
+        '''
+        deadline = time.time() + self.wait_timeout
+        while True:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return
+            except IOError as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+            if time.time() >= deadline:
+                raise LockTimeout(u'Timed out waiting for {0}'.format(lock_file.name))
+            time.sleep(LOCK_POLL_INTERVAL)
+
+
+def get_single_flight():
+    '''Return the request coalescing object, as configured by
+    `tiledmap.coalesce.backend`, or None if coalescing is disabled.
+    '''
+    global _single_flight
+    backend = config[u'tiledmap.coalesce.backend']
+    if backend == u'none':
+        return None
+    if _single_flight is None:
+        if backend == u'file':
+            lock_dir = config.get(u'tiledmap.coalesce.lock_dir') or os.path.join(
+                tempfile.gettempdir(), u'ckanext-tiledmap-locks')
+            _single_flight = FileSingleFlight(
+                lock_dir, float(config[u'tiledmap.coalesce.result_ttl']),
+                float(config[u'tiledmap.coalesce.wait_timeout']))
+        else:
+            _single_flight = SingleFlight()
+    return _single_flight
+
+
+def coalesce(key, function, retry_on=()):
+    '''Invoke the function, deduplicating concurrent identical calls according to the
+    configured coalescing backend.
+
+    :param key: a picklable key identifying the computation
+    :param function: function that takes no parameters and performs the computation
+    :param retry_on: tuple of exception classes which, when raised by the call being
+                     waited on, cause waiting callers to make the call again
+
+    '''
+    single_flight = get_single_flight()
+    if single_flight is None:
+        return function()
+    return single_flight.do(key, function, retry_on)
@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-map
+# Created by the Natural History Museum in London, UK
+
+import hashlib
+import logging
+import Queue
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from ckanext.tiledmap.config import config
+from ckanext.tiledmap.lib.prepared import PREPARED_INFO_KEY, statement_sql
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+log = logging.getLogger(__name__)
+
+# Maximum number of slow queries waiting to be explained. Slow queries are not
+# explained while the queue is full.
+EXPLAIN_QUEUE_SIZE = 16
+
+# Key of the start time of the running query, in the connection's info dictionary
+_START_TIME = u'tiledmap_query_start'
+
+# Execution option marking the read-only queries whose plan may be captured by running
+# them again (see analyzed)
+ANALYZE_OPTION = u'tiledmap_analyze'
+
+_local = threading.local()
+_install_lock = threading.Lock()
+_explain_queue = Queue.Queue(EXPLAIN_QUEUE_SIZE)
+_explain_thread = None
+
+
+def set_query_context(resource_id=None, filters_digest=None):
+    '''Set the resource and filters the queries of the current thread are made for.
+    Only the queries made while a context is set are logged when slow.
+
+    :param resource_id: the resource id, or None to clear the context
+    :param filters_digest: the digest of the request's filters (see
+                           ckanext.tiledmap.lib.filters.filters_digest), if any
+
+    '''
+    _local.context = (resource_id, filters_digest) if resource_id else None
+
+
+@contextmanager
+def query_context(resource_id, filters_digest=None):
+    '''Context manager setting the query context (see set_query_context) of the code
+    it wraps, and restoring the previous context afterwards
+
+    :param resource_id: the resource id
+    :param filters_digest: the digest of the filters, if any
+
+    '''
+    previous = getattr(_local, u'context', None)
+    set_query_context(resource_id, filters_digest)
+    try:
+        yield
+    finally:
+        _local.context = previous
+
+
+def analyzed(connection):
+    '''Return a branch of the given connection whose queries are marked as read-only,
+    so their plan is captured with EXPLAIN ANALYZE when they are slow. The plan of
+    other queries is captured without running them, as they may have side effects
+    even when written as a SELECT (such as pg_cancel_backend or AddGeometryColumn).
+    Prepared map queries (see ckanext.tiledmap.lib.prepared) are always reads.
+
+    :param connection: the database connection
+
+    '''
+    return connection.execution_options(**{ANALYZE_OPTION: True})
+
+
+def normalise_sql(statement):
+    '''Return the given SQL statement on a single line, with its whitespace collapsed
+
+    :param statement: the SQL statement
+
+    '''
+    return u' '.join(statement.split())
+
+
+def _before_execute(conn, cursor, statement, parameters, context, executemany):
+    '''Record the start time of the query'''
+    conn.info[_START_TIME] = time.time()
+
+
+def _after_execute(conn, cursor, statement, parameters, context, executemany):
+    '''Log the query if it took longer than `tiledmap.slowlog.threshold`
+    milliseconds'''
+    start_time = conn.info.pop(_START_TIME, None)
+    if start_time is None:
+        return
+    duration = (time.time() - start_time) * 1000
+    query_context = getattr(_local, u'context', None)
+    threshold = float(config[u'tiledmap.slowlog.threshold'])
+    if query_context is None or threshold <= 0 or duration < threshold or executemany:
+        return
+    resource_id, filters_digest = query_context
+    sql = statement
+    analyze = context is not None and context.execution_options.get(ANALYZE_OPTION,
+                                                                     False)
+    if statement.lstrip().upper().startswith(u'EXECUTE'):
+        # Prepared statement (see ckanext.tiledmap.lib.prepared)
+        prepared_sql = statement_sql(statement.split()[1])
+        if prepared_sql is not None:
+            sql = prepared_sql
+            analyze = True
+    query_id = hashlib.md5(normalise_sql(sql).encode(u'utf-8')).hexdigest()[:12]
+    log.warning(u'Slow map query %s took %.0fms (resource %s, filters %s): %s; '
+                u'parameters: %r', query_id, duration, resource_id, filters_digest,
+                normalise_sql(sql), parameters)
+    if random.random() < float(config[u'tiledmap.slowlog.explain_sample']):
+        _queue_explain(conn.engine, query_id, statement, sql, parameters, analyze)
+
+
+def _queue_explain(engine, query_id, statement, sql, parameters, analyze):
+    '''Queue the given query to have its plan captured by the explain thread'''
+    global _explain_thread
+    with _install_lock:
+        if _explain_thread is None:
+            _explain_thread = threading.Thread(target=_explain_loop)
+            _explain_thread.daemon = True
+            _explain_thread.start()
+    try:
+        _explain_queue.put_nowait((engine, query_id, statement, sql, parameters,
+                                   analyze))
+    except Queue.Full:
+        log.debug(u'Not explaining slow map query %s: the queue is full', query_id)
+
+
+def _explain_loop():
+    '''Main loop of the explain thread'''
+    _local.context = None
+    while True:
+        engine, query_id, statement, sql, parameters, analyze = _explain_queue.get()
+        try:
+            log.warning(u'Plan of slow map query %s:\n%s', query_id,
+                        explain(engine, statement, sql, parameters, analyze))
+        except Exception as e:
+            log.warning(u'Failed to explain slow map query %s: %s', query_id, e)
+
+
+def explain(engine, statement, sql, parameters, analyze=False):
+    '''Return the plan of the given query. Queries marked as read-only (see analyzed)
+    are run by EXPLAIN ANALYZE, within a read-only transaction that is rolled back,
+    and subject to `tiledmap.slowlog.explain_timeout`; other queries are explained
+    without being run.
+
+    :param engine: the engine the query ran on
+    :param statement: the statement, as passed to the DBAPI
+    :param sql: the SQL of the statement, or of the prepared statement it executes
+    :param parameters: the statement's DBAPI parameters
+    :param analyze: True to run the query (Default value = False)
+
+    '''
+    options = u'(ANALYZE, BUFFERS)' if analyze else u''
+    connection = engine.raw_connection()
+    # Prepared statements only exist on the connection that prepared them, so they
+    # are prepared on this one unless it already has them
+    name = None
+    if sql is not statement and statement.split()[1] not in connection.info.get(
+            PREPARED_INFO_KEY, ()):
+        name = statement.split()[1]
+    prepared = False
+    try:
+        cursor = connection.cursor()
+        try:
+            if analyze:
+                # Must come first in the transaction
+                cursor.execute(u'SET TRANSACTION READ ONLY')
+            cursor.execute(u"SELECT set_config('statement_timeout', %(timeout)s, true)",
+                           {u'timeout': config[u'tiledmap.slowlog.explain_timeout']})
+            if name is not None:
+                cursor.execute(u'PREPARE {0} AS {1}'.format(name, sql))
+                prepared = True
+            cursor.execute(u'EXPLAIN {0} {1}'.format(options, statement), parameters)
+            return u'\n'.join(row[0] for row in cursor.fetchall())
+        finally:
+            connection.rollback()
+            if prepared:
+                # Statements are not deallocated by rolling back, and the connection
+                # returns to the pool
+                cursor.execute(u'DEALLOCATE {0}'.format(name))
+                connection.rollback()
+            cursor.close()
+    finally:
+        connection.close()
+
+
+def install():
+    '''Listen to the queries of all the SQLAlchemy engines: those of the datastore,
+    but also those of ckanext-dataspatial, which populates the geometries, and of the
+    paster commands. Only the queries made in a query context are logged, so CKAN's
+    other queries are not. Does nothing if the listeners are already installed.
+    '''
+    with _install_lock:
+        if not event.contains(Engine, u'before_cursor_execute', _before_execute):
+            event.listen(Engine, u'before_cursor_execute', _before_execute)
+            event.listen(Engine, u'after_cursor_execute', _after_execute)
@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-map
+# Created by the Natural History Museum in London, UK
+
+import datetime
+import json
+
+from ckanext.tiledmap.config import config
+from ckanext.tiledmap.db import _get_engine, is_undefined_table
+from ckanext.tiledmap.lib.counts import query_extent
+from ckanext.tiledmap.lib.query import geom_field_4326, get_table
+from sqlalchemy import BigInteger, Column, DateTime, Float, MetaData, Table, UnicodeText, \
+    func
+from sqlalchemy.exc import ProgrammingError
+from sqlalchemy.sql import select
+
+metadata = MetaData()
+
+# Per-resource statistics, stored in the datastore database alongside the resources.
+# The statistics columns are null once discarded (see delete_stats), but the time the
+# geometries were last populated is kept
+stats_table = Table(
+    u'_tiledmap_stats', metadata,
+    Column(u'resource_id', UnicodeText, primary_key=True),
+    Column(u'total_count', BigInteger),
+    Column(u'geom_count', BigInteger),
+    Column(u'lat_min', Float),
+    Column(u'lon_min', Float),
+    Column(u'lat_max', Float),
+    Column(u'lon_max', Float),
+    Column(u'histogram', UnicodeText),
+    Column(u'updated', DateTime),
+    Column(u'populated', DateTime)
+    )
+
+# The statistics columns, as opposed to the population time
+_STATS_COLUMNS = [u'total_count', u'geom_count', u'lat_min', u'lon_min', u'lat_max',
+                  u'lon_max', u'histogram', u'updated']
+
+_table_created = False
+
+
+def _ensure_table():
+    '''Create the statistics table if it doesn't exist yet'''
+    global _table_created
+    if not _table_created:
+        stats_table.create(_get_engine(write=True), checkfirst=True)
+        _table_created = True
+
+
+def _compute_histogram(connection, table, resolution):
+    '''Return the number of geometries in each cell of a grid of the given resolution
+    (in degrees), as a list of [lon cell, lat cell, count] for non-empty cells. Cell
+    (i, j) covers longitudes [i * resolution, (i + 1) * resolution[ and latitudes
+    [j * resolution, (j + 1) * resolution[.
+
+    :param connection: the database connection
+    :param table: the resource table
+    :param resolution: the size of the cells, in degrees
+
+    '''
+    geom = table.c[geom_field_4326()]
+    lon_cell = func.floor(func.st_x(geom) / resolution).label(u'lon_cell')
+    lat_cell = func.floor(func.st_y(geom) / resolution).label(u'lat_cell')
+    query = select([lon_cell, lat_cell, func.count(1)], from_obj=table)
+    query = query.where(geom != None).group_by(lon_cell, lat_cell)
+    return [[int(row[0]), int(row[1]), int(row[2])] for row in connection.execute(query)]
+
+
+def compute_stats(resource_id):
+    '''Compute and store the statistics of the given resource: the number of records,
+    the number of records with a geometry, the bounds of the geometries and, if
+    `tiledmap.stats.histogram_resolution` is set, a coarse histogram of the geometries.
+
+    :param resource_id: the resource id
+    :returns: the statistics, as returned by get_stats
+
+    '''
+    _ensure_table()
+    resolution = float(config[u'tiledmap.stats.histogram_resolution'])
+    with _get_engine(write=True).begin() as connection:
+        extent = query_extent(connection, resource_id, {})
+        bounds = extent[u'bounds'] or ((None, None), (None, None))
+        values = {
+            u'resource_id': resource_id,
+            u'total_count': extent[u'total_count'],
+            u'geom_count': extent[u'geom_count'],
+            u'lat_min': bounds[0][0],
+            u'lon_min': bounds[0][1],
+            u'lat_max': bounds[1][0],
+            u'lon_max': bounds[1][1],
+            u'histogram': None,
+            u'updated': datetime.datetime.utcnow()
+            }
+        if resolution > 0:
+            table = get_table(resource_id, [geom_field_4326()])
+            values[u'histogram'] = json.dumps({
+                u'resolution': resolution,
+                u'cells': _compute_histogram(connection, table, resolution)
+                })
+        _upsert(connection, resource_id, values)
+    return _row_to_stats(values)
+
+
+def record_populated(resource_id):
+    '''Record that the geometries of the given resource have just been populated
+
+    :param resource_id: the resource id
+
+    '''
+    _ensure_table()
+    with _get_engine(write=True).begin() as connection:
+        _upsert(connection, resource_id, {
+            u'populated': datetime.datetime.utcnow()
+            })
+
+
+def _upsert(connection, resource_id, values):
+    '''Update the given columns of the resource's row, inserting the row if there is
+    none. ON CONFLICT needs Postgres 9.5, so this relies on the transaction instead.
+
+    :param connection: the database connection, in a transaction
+    :param resource_id: the resource id
+    :param values: dictionary of column name to value
+
+    '''
+    values = dict(values, resource_id=resource_id)
+    result = connection.execute(stats_table.update().where(
+        stats_table.c.resource_id == resource_id).values(**values))
+    if result.rowcount == 0:
+        connection.execute(stats_table.insert().values(**values))
+
+
+def _get_row(resource_id):
+    '''Return the stored row of the given resource, or None if there is none
+
+    :param resource_id: the resource id
+
+    '''
+    query = select([stats_table]).where(stats_table.c.resource_id == resource_id)
+    try:
+        with _get_engine().connect() as connection:
+            return connection.execute(query).fetchone()
+    except ProgrammingError as e:
+        # The table is only created when statistics are first stored
+        if not is_undefined_table(e):
+            raise
+        return None
+
+
+def get_stats(resource_id):
+    '''Return the stored statistics of the given resource
+
+    :param resource_id: the resource id
+    :returns: None if no statistics are stored, or a dictionary defining total_count,
+              geom_count, bounds (as ((lat min, lon min), (lat max, lon max)), or None
+              if there are no geometries), histogram (or None) and updated.
+
+    '''
+    row = _get_row(resource_id)
+    if row is None or row[u'updated'] is None:
+        return None
+    return _row_to_stats(row)
+
+
+def get_populated(resource_id):
+    '''Return the time the geometries of the given resource were last populated, or
+    None if it wasn't recorded
+
+    :param resource_id: the resource id
+
+    '''
+    row = _get_row(resource_id)
+    return None if row is None else row[u'populated']
+
+
+def delete_stats(resource_id):
+    '''Delete the stored statistics of the given resource. The time its geometries
+    were populated is kept.
+
+    :param resource_id: the resource id
+
+    '''
+    _ensure_table()
+    with _get_engine(write=True).begin() as connection:
+        connection.execute(stats_table.update().where(
+            stats_table.c.resource_id == resource_id).values(
+            **dict((column, None) for column in _STATS_COLUMNS)))
+
+
+def _row_to_stats(row):
+    '''Convert a statistics table row into the dictionary returned by get_stats
+
+    :param row: the row, or dictionary of values
+
+    '''
+    bounds = None
+    if row[u'lat_min'] is not None:
+        bounds = ((row[u'lat_min'], row[u'lon_min']), (row[u'lat_max'], row[u'lon_max']))
+    histogram = None
+    if row[u'histogram']:
+        histogram = json.loads(row[u'histogram'])
+    return {
+        u'total_count': row[u'total_count'],
+        u'geom_count': row[u'geom_count'],
+        u'bounds': bounds,
+        u'histogram': histogram,
+        u'updated': row[u'updated']
+        }
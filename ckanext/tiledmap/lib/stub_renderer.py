@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-map
+# Created by the Natural History Museum in London, UK
+
+import BaseHTTPServer
+import SocketServer
+import base64
+import json
+import socket
+import threading
+import time
+import urlparse
+
+# A 1x1 red PNG, distinct from the transparent placeholder served when the renderer is
+# unavailable
+TILE_PNG = base64.b64decode(
+    u'iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR4nGN4x8DwHwAEvAHuygzW5wAAAABJRU5ErkJggg==')
+
+# An UTFGrid with a single record covering the tile
+TILE_GRID = json.dumps({
+    u'grid': [u'!' * 64] * 64,
+    u'keys': [u'', u'1'],
+    u'data': {
+        u'1': {
+            u'_id': 1
+            }
+        }
+    })
+
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    '''Threaded HTTP server, so concurrent requests are served concurrently'''
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def handle_error(self, request, client_address):
+        '''Ignore errors on connections closed while stopping the renderer'''
+        pass
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''Serve the stub renderer's tiles'''
+    protocol_version = u'HTTP/1.1'
+
+    def setup(self):
+        '''Keep track of the open connection, so it can be closed when the renderer is
+        stopped'''
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.renderer.connections.add(self.connection)
+
+    def finish(self):
+        '''Forget about the connection'''
+        self.server.renderer.connections.discard(self.connection)
+        BaseHTTPServer.BaseHTTPRequestHandler.finish(self)
+
+    def do_GET(self):
+        '''Serve a tile request'''
+        renderer = self.server.renderer
+        url = urlparse.urlparse(self.path)
+        renderer.record(url.path, urlparse.parse_qs(url.query))
+        if renderer.delay:
+            time.sleep(renderer.delay)
+        if renderer.status != 200:
+            body = u'Renderer error'
+            content_type = u'text/plain'
+        elif url.path.endswith(u'.grid.json'):
+            body = TILE_GRID
+            content_type = u'application/json'
+        else:
+            body = TILE_PNG
+            content_type = u'image/png'
+        self.send_response(renderer.status)
+        self.send_header(u'Content-Type', content_type)
+        self.send_header(u'Content-Length', str(len(body)))
+        self.send_header(u'Cache-Control', u'max-age=60')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        '''Don't log requests'''
+        pass
+
+
+class StubRenderer(object):
+    '''Local stand-in for the tile renderer, used by the tests.
+
+    Serves a red PNG for image tiles and a single record UTFGrid for grid tiles, and
+    records the requests it receives. Responses can be delayed, or replaced by errors,
+    to test how the map behaves with a slow or failing renderer.
+
+    Usage:
+
+        renderer = StubRenderer()
+        renderer.start()
+        ... point tiledmap.windshaft.host/port at renderer.host/renderer.port ...
+        renderer.stop()
+    '''
+
+    def __init__(self, host=u'127.0.0.1', port=0, delay=0, status=200):
+        '''
+        :param host: the interface to listen on
+        :param port: the port to listen on. 0 picks a free port.
+        :param delay: number of seconds to wait before each response
+        :param status: the HTTP status of the responses
+        '''
+        self.host = host
+        self.port = port
+        self.delay = delay
+        self.status = status
+        self.requests = []
+        self.connections = set()
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    def record(self, path, params):
+        '''Record a request
+
+        :param path: the path of the request
+        :param params: dictionary of query string parameter to list of values
+
+        '''
+        with self._lock:
+            self.requests.append((path, params))
+
+    def start(self):
+        '''Start serving requests in a background thread'''
+        self._server = _Server((self.host, self.port), _Handler)
+        self._server.renderer = self
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        '''Stop serving requests, and close the connections kept alive'''
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+        for connection in list(self.connections):
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
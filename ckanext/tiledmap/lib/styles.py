@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-map
+# Created by the Natural History Museum in London, UK
+
+from ckanext.tiledmap.config import config
+
+# The map styles, mapped to the view option that enables them
+MAP_STYLES = {
+    u'heatmap': u'enable_heat_map',
+    u'gridded': u'enable_grid_map',
+    u'plot': u'enable_plot_map'
+    }
+
+
+def enabled_styles(view):
+    '''Return the map styles enabled on the given view
+
+    :param view: the resource view
+
+    '''
+    return sorted(style for style, option in MAP_STYLES.items() if view.get(option))
+
+
+def has_grid(view, style):
+    '''Return True if UTFGrid tiles are requested for the given style of the view
+
+    :param view: the resource view
+    :param style: the map style
+
+    '''
+    return style != u'heatmap' and bool(view.get(u'enable_utf_grid'))
+
+
+def query_fields(view):
+    '''Return the fields included in the UTFGrid tiles of the given view. Note that
+    the query fails with duplicate names.
+
+    :param view: the resource view
+
+    '''
+    info_fields = view.get(u'utf_grid_fields', [])
+    if not isinstance(info_fields, list):
+        info_fields = [info_fields]
+    return set(info_fields).union(set([view[u'utf_grid_title']]))
+
+
+def tile_params(style):
+    '''Return the style specific parameters of image tile requests
+
+    :param style: the map style
+
+    '''
+    if style == u'heatmap':
+        return {
+            u'intensity': config[u'tiledmap.style.heatmap.intensity']
+            }
+    if style == u'gridded':
+        return {
+            u'base_color': config[u'tiledmap.style.gridded.base_color']
+            }
+    return {
+        u'fill_color': config[u'tiledmap.style.plot.fill_color'],
+        u'line_color': config[u'tiledmap.style.plot.line_color']
+        }
+
+
+def grid_params(view):
+    '''Return the parameters of UTFGrid tile requests
+
+    :param view: the resource view
+
+    '''
+    return {
+        u'interactivity': u','.join(query_fields(view))
+        }
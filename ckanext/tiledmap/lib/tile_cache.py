@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-map
+# Created by the Natural History Museum in London, UK
+
+import json
+import os
+import shutil
+import struct
+import tempfile
+import zlib
+
+from ckanext.tiledmap.config import config
+
+
+def encode_png(width, height, scanlines):
+    '''Return a PNG image of the given RGBA pixels
+
+    :param width: the width of the image, in pixels
+    :param height: the height of the image, in pixels
+    :param scanlines: the rows of pixels, each preceded by its (PNG filter type) byte,
+                      as a byte string
+
+    '''
+
+    def chunk(chunk_type, data):
+        return struct.pack(u'>I', len(data)) + chunk_type + data + struct.pack(
+            u'>I', zlib.crc32(chunk_type + data) & 0xffffffff)
+
+    header = struct.pack(u'>IIBBBBB', width, height, 8, 6, 0, 0, 0)
+    return b''.join([b'\x89PNG\r\n\x1a\n', chunk(b'IHDR', header),
+                     chunk(b'IDAT', zlib.compress(scanlines, 6)), chunk(b'IEND', b'')])
+
+
+def _transparent_png(size):
+    '''Return a transparent square PNG image
+
+    :param size: the width and height of the image, in pixels
+
+    '''
+    return encode_png(size, size, (b'\x00' * (1 + 4 * size)) * size)
+
+
+# Placeholders served when a tile can neither be rendered nor read from the cache: a
+# transparent PNG, and an UTFGrid with no data.
+TRANSPARENT_PNG = _transparent_png(256)
+EMPTY_GRID = json.dumps({
+    u'grid': [u' ' * 64] * 64,
+    u'keys': [u''],
+    u'data': {}
+    })
+
+CONTENT_TYPES = {
+    u'png': u'image/png',
+    u'grid.json': u'application/json'
+    }
+
+
+def cache_dir():
+    '''Return the directory tiles are cached in, or None if the cache is disabled'''
+    return config[u'tiledmap.tile_cache.dir'] or None
+
+
+def tile_cache_path(resource_id, z, x, y, extension, digest):
+    '''Return the path of the given tile in the cache, or None if the cache is
+    disabled
+
+    :param resource_id: the resource id
+    :param z: zoom level
+    :param x: tile column
+    :param y: tile row
+    :param extension: 'png' for image tiles, or 'grid.json' for UTFGrid tiles
+    :param digest: digest of the parameters the tile was rendered with
+
+    '''
+    directory = cache_dir()
+    if directory is None:
+        return None
+    return os.path.join(directory, resource_id, unicode(z), unicode(x),
+                        u'{0}.{1}.{2}'.format(y, digest, extension))
+
+
+def get_cached_tile(resource_id, z, x, y, extension, digest):
+    '''Return the content of the given tile from the cache
+
+    :param resource_id: the resource id
+    :param z: zoom level
+    :param x: tile column
+    :param y: tile row
+    :param extension: 'png' for image tiles, or 'grid.json' for UTFGrid tiles
+    :param digest: digest of the parameters the tile was rendered with
+    :returns: None if the tile isn't cached, or a tuple (content, mtime)
+
+    '''
+    path = tile_cache_path(resource_id, z, x, y, extension, digest)
+    if path is None:
+        return None
+    try:
+        with open(path, u'rb') as f:
+            return f.read(), os.fstat(f.fileno()).st_mtime
+    except (IOError, OSError):
+        return None
+
+
+def get_cached_tile_mtime(resource_id, z, x, y, extension, digest):
+    '''Return the time at which the given tile was cached, or None if it isn't cached
+
+    :param resource_id: the resource id
+    :param z: zoom level
+    :param x: tile column
+    :param y: tile row
+    :param extension: 'png' for image tiles, or 'grid.json' for UTFGrid tiles
+    :param digest: digest of the parameters the tile was rendered with
+
+    '''
+    path = tile_cache_path(resource_id, z, x, y, extension, digest)
+    if path is None:
+        return None
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+
+def delete_cached_tiles(resource_id):
+    '''Delete all the cached tiles of the given resource
+
+    :param resource_id: the resource id
+
+    '''
+    directory = cache_dir()
+    if directory is not None:
+        shutil.rmtree(os.path.join(directory, resource_id), ignore_errors=True)
+
+
+class CacheWriter(object):
+    '''Write a tile to the cache as it is being received.
+
+    The content is written to a temporary file, which replaces the cached tile once
+    the whole tile has been received, so readers never see partial tiles.
+    '''
+
+    def __init__(self, path):
+        '''
+        :param path: the path of the tile in the cache
+        '''
+        self.path = path
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # Another process may have created it meanwhile
+                if not os.path.isdir(directory):
+                    raise
+        fd, self.tmp_path = tempfile.mkstemp(dir=directory)
+        self.file = os.fdopen(fd, u'wb')
+
+    def write(self, data):
+        '''Write the next chunk of the tile. Failing to write to the cache doesn't
+        prevent the tile from being served, so errors are not raised.
+
+        :param data: the chunk
+
+        '''
+        if self.file is None:
+            return
+        try:
+            self.file.write(data)
+        except (IOError, OSError):
+            self.abort()
+
+    def commit(self):
+        '''Replace the cached tile with the received tile'''
+        if self.file is None:
+            return
+        try:
+            self.file.close()
+            os.rename(self.tmp_path, self.path)
+        except (IOError, OSError):
+            self.abort()
+        self.file = None
+
+    def abort(self):
+        '''Discard the received content'''
+        if self.file is None:
+            return
+        try:
+            self.file.close()
+        except (IOError, OSError):
+            pass
+        self.file = None
+        try:
+            os.unlink(self.tmp_path)
+        except OSError:
+            pass
+
+
+def open_cache_writer(resource_id, z, x, y, extension, digest):
+    '''Return a CacheWriter for the given tile, or None if the cache is disabled or
+    can't be written to
+
+    :param resource_id: the resource id
+    :param z: zoom level
+    :param x: tile column
+    :param y: tile row
+    :param extension: 'png' for image tiles, or 'grid.json' for UTFGrid tiles
+    :param digest: digest of the parameters the tile was rendered with
+
+    '''
+    path = tile_cache_path(resource_id, z, x, y, extension, digest)
+    if path is None:
+        return None
+    try:
+        return CacheWriter(path)
+    except (IOError, OSError):
+        return None
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-map
+# Created by the Natural History Museum in London, UK
+
+import importlib
+import logging
+import re
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+from ckanext.tiledmap.config import config
+
+log = logging.getLogger(__name__)
+
+# Characters not allowed in the metric names of Server-Timing headers
+_INVALID_NAME = re.compile(u'[^0-9A-Za-z_.-]')
+
+_local = threading.local()
+_sink = None
+_sink_lock = threading.Lock()
+
+
+class LogSink(object):
+    '''Sink writing each span to the log'''
+
+    def emit(self, name, duration):
+        log.info(u'%s took %.1fms', name, duration * 1000)
+
+
+class StatsdSink(object):
+    '''Sink sending each span as a StatsD timer, over UDP'''
+
+    def __init__(self, host, port, prefix):
+        '''
+        :param host: the StatsD server's host
+        :param port: the StatsD server's port
+        :param prefix: the prefix of the metric names
+        '''
+        self.address = (host, port)
+        self.prefix = prefix
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def emit(self, name, duration):
+        metric = u'{0}.{1}:{2:.3f}|ms'.format(self.prefix, name, duration * 1000)
+        try:
+            self._socket.sendto(metric.encode(u'utf-8'), self.address)
+        except socket.error as e:
+            log.debug(u'Failed to send a timing to StatsD: %s', e)
+
+
+class MemorySink(object):
+    '''Sink keeping the spans in memory, as a list of (name, duration) tuples'''
+
+    def __init__(self):
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def emit(self, name, duration):
+        with self._lock:
+            self.spans.append((name, duration))
+
+    def names(self):
+        '''Return the names of the spans emitted so far, in order'''
+        with self._lock:
+            return [name for name, duration in self.spans]
+
+
+def _create_sink(name):
+    '''Create the sink of the given `tiledmap.timing.sink` value: 'log', 'statsd', or
+    the 'package.module:function' path of a function returning a sink
+
+    :param name: the option's value
+
+    '''
+    if name == u'log':
+        return LogSink()
+    if name == u'statsd':
+        host, port = config[u'tiledmap.timing.statsd'].rsplit(u':', 1)
+        return StatsdSink(host, int(port), config[u'tiledmap.timing.statsd_prefix'])
+    module, function = name.split(u':', 1)
+    return getattr(importlib.import_module(module), function)()
+
+
+def get_sink():
+    '''Return the sink the spans are emitted to, configured by
+    `tiledmap.timing.sink`, or None if spans are not emitted'''
+    global _sink
+    with _sink_lock:
+        if _sink is None and config[u'tiledmap.timing.sink']:
+            _sink = _create_sink(config[u'tiledmap.timing.sink'])
+        return _sink
+
+
+def set_sink(sink):
+    '''Emit the spans to the given sink rather than the configured one
+
+    :param sink: an object with an emit(name, duration) method, or None to go back to
+                 the configured sink
+
+    '''
+    global _sink
+    with _sink_lock:
+        _sink = sink
+
+
+class Timings(object):
+    '''The spans recorded while serving a request'''
+
+    def __init__(self):
+        self.spans = []
+
+    def header(self):
+        '''Return the spans formatted as the value of a Server-Timing header'''
+        return u', '.join(u'{0};dur={1:.1f}'.format(_INVALID_NAME.sub(u'_', name),
+                                                     duration * 1000)
+                          for name, duration in self.spans)
+
+
+def start_recording():
+    '''Start recording the spans of the current thread, discarding those of the
+    previous request it served
+
+    :returns: the Timings the spans are recorded in
+
+    '''
+    _local.timings = Timings()
+    return _local.timings
+
+
+def stop_recording():
+    '''Stop recording the spans of the current thread
+
+    :returns: the Timings the spans were recorded in, or None if they weren't being
+              recorded
+
+    '''
+    timings = getattr(_local, u'timings', None)
+    _local.timings = None
+    return timings
+
+
+@contextmanager
+def span(name):
+    '''Context manager timing the code it wraps: the duration is emitted to the sink,
+    and recorded in the current thread's Timings if start_recording() was called.
+
+    :param name: the name of the span
+
+    '''
+    start = time.time()
+    try:
+        yield
+    finally:
+        duration = time.time() - start
+        timings = getattr(_local, u'timings', None)
+        if timings is not None:
+            timings.spans.append((name, duration))
+        sink = get_sink()
+        if sink is not None:
+            sink.emit(name, duration)
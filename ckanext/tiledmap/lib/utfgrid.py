@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-map
+# Created by the Natural History Museum in London, UK
+
+import json
+import math
+
+from ckanext.tiledmap.config import config
+from ckanext.tiledmap.db import get_map_engine
+from ckanext.tiledmap.lib.occupancy import MERCATOR_EXTENT
+from ckanext.tiledmap.lib.query import geom_field_4326, get_table
+from ckanext.tiledmap.lib.render import TILE_SIZE, grid_cells, neighbourhood_points, \
+    numpy, pixel_coordinates
+from ckanext.tiledmap.lib.sidetable import query_table
+from ckanext.tiledmap.lib.slowlog import analyzed
+from sqlalchemy import func
+from sqlalchemy.sql import select
+
+
+def encode_key(index):
+    '''Return the character encoding the given key index in the rows of UTFGrid tiles:
+    indexes are offset by 32, skipping the double quote and the backslash
+
+    :param index: the index of the key in the tile's keys
+
+    '''
+    code = index + 32
+    if code >= 34:
+        code += 1
+    if code >= 92:
+        code += 1
+    return unichr(code)
+
+
+def lon_lat(mx, my):
+    '''Return the WGS84 longitude and latitude of the given web mercator point
+
+    :param mx: the x coordinate
+    :param my: the y coordinate
+
+    '''
+    return (mx / MERCATOR_EXTENT * 180,
+            math.degrees(2 * math.atan(math.exp(my / MERCATOR_EXTENT * math.pi)) -
+                         math.pi / 2))
+
+
+def cell_bbox(z, x, y, column, row, resolution):
+    '''Return the WKT polygon, in WGS84, of the given cell of the given tile's UTFGrid
+
+    :param z: zoom level
+    :param x: tile column
+    :param y: tile row
+    :param column: the cell's column within the tile
+    :param row: the cell's row within the tile
+    :param resolution: the width of the grid's cells, in pixels
+
+    '''
+    size = 2 * MERCATOR_EXTENT / (TILE_SIZE * 2 ** z) * resolution
+    left = (x * TILE_SIZE / resolution + column) * size - MERCATOR_EXTENT
+    top = MERCATOR_EXTENT - (y * TILE_SIZE / resolution + row) * size
+    west, north = lon_lat(left, top)
+    east, south = lon_lat(left + size, top - size)
+    return u'POLYGON(({0} {1}, {2} {1}, {2} {3}, {0} {3}, {0} {1}))'.format(
+        west, north, east, south)
+
+
+def _read_records(resource_id, ids, fields):
+    '''Return the given fields of the given records, along with their WGS84
+    coordinates, reading them from the resource's side table if it has one
+
+    :param resource_id: the resource id
+    :param ids: list of record ids
+    :param fields: the fields to read
+    :returns: dictionary of record id to dictionary of field values
+
+    '''
+    if not ids:
+        return {}
+    fields = sorted(fields)
+    table = get_table(query_table(resource_id, {}, None, fields),
+                      [u'_id', geom_field_4326()] + fields)
+    geom = table.c[geom_field_4326()]
+    query = select([table.c[u'_id']] + [table.c[f] for f in fields] + [
+        func.st_y(geom).label(u'_tiledmap_lat'),
+        func.st_x(geom).label(u'_tiledmap_lng')
+        ], from_obj=table).where(table.c[u'_id'].in_(ids))
+    records = {}
+    with get_map_engine(resource_id).connect() as connection:
+        result = analyzed(connection).execute(query)
+        for row in result:
+            records[row[u'_id']] = dict((k, v) for k, v in row.items()
+                                        if k in fields or k.startswith(u'_tiledmap'))
+        result.close()
+    return records
+
+
+def render_grid(resource_id, store, z, x, y, fields):
+    '''Render the UTFGrid tile of an unfiltered plot map from the resource's point
+    store, with cells of `tiledmap.style.plot.grid_resolution` pixels.
+
+    The points are thinned to one representative per cell of the grid (see
+    render.grid_cells), so only the fields of the representatives are read from the
+    database, whatever the number of points in the tile. Each representative carries
+    the number of points in its cell as `_tiledmap_count` and the cell's bounds as
+    `_tiledmap_grid_bbox`, so the records it stands for can be listed.
+
+    :param resource_id: the resource id
+    :param store: the resource's PointStore
+    :param z: zoom level
+    :param x: tile column
+    :param y: tile row
+    :param fields: the fields included in the grid's data
+    :returns: the tile, as JSON
+
+    '''
+    resolution = int(config[u'tiledmap.style.plot.grid_resolution'])
+    mx, my, ids = neighbourhood_points(store, z, x, y)
+    px, py = pixel_coordinates(mx, my, z, x, y)
+    grid, representatives, counts, columns, rows = grid_cells(
+        px, py, ids, resolution, int(config[u'tiledmap.style.plot.marker_size']) / 2.0)
+    # Only keep the representatives whose marker is visible in the tile
+    used = numpy.unique(grid[grid > 0]) - 1
+    renumber = numpy.zeros(len(representatives) + 1, dtype=numpy.int64)
+    renumber[used + 1] = numpy.arange(1, len(used) + 1)
+    grid = renumber[grid]
+    record_ids = [int(i) for i in ids[representatives[used]]]
+    records = _read_records(resource_id, record_ids, fields)
+    data = {}
+    for position, record_id in zip(used, record_ids):
+        record = records.get(record_id)
+        if record is None:
+            continue
+        record[u'_tiledmap_count'] = int(counts[position])
+        record[u'_tiledmap_grid_bbox'] = cell_bbox(z, x, y, int(columns[position]),
+                                                   int(rows[position]), resolution)
+        data[unicode(record_id)] = record
+    characters = numpy.array([encode_key(i) for i in range(len(used) + 1)])
+    return json.dumps({
+        u'grid': [u''.join(row) for row in characters[grid]],
+        u'keys': [u''] + [unicode(i) for i in record_ids],
+        u'data': data
+        }, default=unicode)
@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-map
+# Created by the Natural History Museum in London, UK
+
+from ckan import model
+from ckan.plugins import toolkit
+
+
+def get_tiledmap_views(context, resource_ids=None):
+    '''Return the tiled map views of the given resources, or of all the resources
+
+    :param context: the action context
+    :param resource_ids: optional list of resource ids. Defaults to all the resources
+                         that have a tiled map view.
+    :returns: list of resource view dictionaries
+
+    '''
+    if resource_ids is None:
+        query = model.Session.query(model.ResourceView.resource_id).filter(
+            model.ResourceView.view_type == u'tiledmap').distinct()
+        resource_ids = sorted(row[0] for row in query)
+    views = []
+    for resource_id in resource_ids:
+        views.extend(v for v in toolkit.get_action(u'resource_view_list')(context, {
+            u'id': resource_id
+            }) if v[u'view_type'] == u'tiledmap')
+    return views
+
+
+def has_tiledmap_view(resource_id):
+    '''Return True if the given resource has a tiled map view. Only such resources have
+    precomputed map data, as it is built when their views are created or updated.
+
+    :param resource_id: the resource id
+
+    '''
+    query = model.Session.query(model.ResourceView.id).filter(
+        model.ResourceView.resource_id == resource_id,
+        model.ResourceView.view_type == u'tiledmap')
+    return query.first() is not None
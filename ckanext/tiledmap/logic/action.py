@@ -6,6 +6,12 @@
 
 from ckanext.dataspatial.lib.postgis import (create_postgis_columns, has_postgis_columns,
                                              populate_postgis_columns)
+from ckanext.tiledmap.lib.maintenance import queue_build_stores, refresh_resource, \
+    resource_changed
+from ckanext.tiledmap.lib.performance import resource_performance
+from ckanext.tiledmap.lib.slowlog import query_context
+from ckanext.tiledmap.lib.timing import span
+from ckanext.tiledmap.lib.views import get_tiledmap_views, has_tiledmap_view
 from sqlalchemy.exc import DataError, InternalError, ProgrammingError
 
 from ckan.lib.helpers import flash_error, flash_success
@@ -60,6 +66,79 @@ def resource_view_delete(prev_func, context, data_dict):
     return r
 
 
+@toolkit.chained_action
+def datastore_create(prev_func, context, data_dict):
+    '''Override the datastore's datastore_create so we can refresh the precomputed
+    map data of a resource when records are added to it
+
+    :param prev_func: the function being overridden
+    :param context: 
+    :param data_dict: 
+
+    '''
+    r = prev_func(context, data_dict)
+    if data_dict.get(u'records'):
+        _refresh_map_data(r[u'resource_id'])
+    return r
+
+
+@toolkit.chained_action
+def datastore_upsert(prev_func, context, data_dict):
+    '''Override the datastore's datastore_upsert so we can refresh the precomputed
+    map data of a resource when its records change
+
+    :param prev_func: the function being overridden
+    :param context: 
+    :param data_dict: 
+
+    '''
+    r = prev_func(context, data_dict)
+    _refresh_map_data(data_dict.get(u'resource_id') or data_dict.get(u'id'))
+    return r
+
+
+@toolkit.chained_action
+def datastore_delete(prev_func, context, data_dict):
+    '''Override the datastore's datastore_delete so we can refresh the precomputed
+    map data of a resource when its records are deleted
+
+    :param prev_func: the function being overridden
+    :param context: 
+    :param data_dict: 
+
+    '''
+    r = prev_func(context, data_dict)
+    _refresh_map_data(data_dict.get(u'resource_id') or data_dict.get(u'id'))
+    return r
+
+
+def _refresh_map_data(resource_id):
+    '''Refresh the precomputed map data of a resource whose records changed (see
+    ckanext.tiledmap.lib.maintenance.resource_changed). Resources without a tiled map
+    view have none, so datastore writes to them are left alone.
+
+    :param resource_id: the resource id
+
+    '''
+    if has_tiledmap_view(resource_id):
+        resource_changed(resource_id)
+
+
+def tiledmap_performance(context, data_dict):
+    '''Return the performance figures of the resources that have a tiled map view (see
+    ckanext.tiledmap.lib.performance.resource_performance). Latencies and tile cache
+    hit rates are those recorded by the process serving the request. Sysadmins only.
+
+    :param context: 
+    :param data_dict: may define resource_ids, a list of resource ids to restrict the
+                      figures to
+
+    '''
+    toolkit.check_access(u'tiledmap_performance', context, data_dict)
+    return resource_performance(
+        get_tiledmap_views(context, data_dict.get(u'resource_ids')))
+
+
 def _create_update_resource(r, context, data_dict):
     '''Create/update geom field on the given resource
 
@@ -73,7 +152,9 @@ def _create_update_resource(r, context, data_dict):
         }.items())
     if not has_postgis_columns(data_dict[u'resource_id']):
         try:
-            create_postgis_columns(data_dict[u'resource_id'])
+            with span(u'geometry.create_columns'), query_context(
+                    data_dict[u'resource_id']):
+                create_postgis_columns(data_dict[u'resource_id'])
         except ProgrammingError as e:
             flash_error(toolkit._(
                 u'The extension failed to initialise the database table to support '
@@ -81,11 +162,13 @@ def _create_update_resource(r, context, data_dict):
                 u'administrator.'))
             return
     try:
-        populate_postgis_columns(
-            data_dict[u'resource_id'],
-            data_dict[u'latitude_field'],
-            data_dict[u'longitude_field']
-            )
+        with span(u'geometry.populate_columns'), query_context(
+                data_dict[u'resource_id']):
+            populate_postgis_columns(
+                data_dict[u'resource_id'],
+                data_dict[u'latitude_field'],
+                data_dict[u'longitude_field']
+                )
     except (DataError, InternalError) as e:
         flash_error(toolkit._(
             u'It was not possible to create the geometry data from the given '
@@ -94,4 +177,10 @@ def _create_update_resource(r, context, data_dict):
             u'-90 and +90 and longitude between -180 and +180. Please correct the data '
             u'or select different fields.'))
     else:
+        with span(u'geometry.refresh_resource'), query_context(
+                data_dict[u'resource_id']):
+            # The side table and point store are built by a background job, rather
+            # than while the view is saved
+            refresh_resource(data_dict[u'resource_id'], stores=False, populated=True)
+        queue_build_stores(data_dict[u'resource_id'])
         flash_success(toolkit._(u'Successfully created the geometric data.'))
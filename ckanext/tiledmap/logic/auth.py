@@ -51,3 +51,17 @@ def update_geom_columns(context, data_dict):
 
     '''
     return map_auth(context, data_dict)
+
+
+def tiledmap_performance(context, data_dict):
+    '''Only sysadmins (who bypass auth functions) may see the performance figures of
+    the tiled map resources
+
+    :param context: 
+    :param data_dict: 
+
+    '''
+    return {
+        u'success': False,
+        u'msg': toolkit._(u'Only sysadmins can see the map performance figures')
+        }
@@ -12,6 +12,8 @@ import re
 from ckanext.tiledmap.config import config as plugin_config
 from ckanext.tiledmap.db import _get_engine
 from ckanext.tiledmap.lib.helpers import dwc_field_title, mustache_wrapper
+from ckanext.tiledmap.lib.slowlog import install as install_slowlog, query_context
+from ckanext.tiledmap.lib.timing import span
 from sqlalchemy import Column, MetaData, Numeric, Table, cast, func, not_, or_
 from sqlalchemy.exc import DataError
 from sqlalchemy.sql import select
@@ -45,10 +47,13 @@ class TiledMapPlugin(SingletonPlugin):
         toolkit.add_template_directory(config, u'theme/templates')
         toolkit.add_public_directory(config, u'theme/public')
         toolkit.add_resource(u'theme/public', u'ckanext-tiledmap')
+        toolkit.add_ckan_admin_tab(config, u'tiledmap_performance',
+                                   u'Map performance')
 
     ## IRoutes
     def before_map(self, map):
-        '''Add routes to our tile/grid serving functionality
+        '''Add routes to our tile/grid serving functionality, and to the performance
+        page in the sysadmin area
 
         :param map: 
 
@@ -62,24 +67,37 @@ class TiledMapPlugin(SingletonPlugin):
         map.connect('/map-info',
                     controller=u'ckanext.tiledmap.controllers.map:MapController',
                     action=u'map_info')
+        map.connect('/map-export.{file_format}',
+                    controller=u'ckanext.tiledmap.controllers.map:MapController',
+                    action=u'export')
+        map.connect(u'tiledmap_performance', '/ckan-admin/tiledmap',
+                    controller=u'ckanext.tiledmap.controllers.admin:AdminController',
+                    action=u'performance')
 
         return map
 
     ## IActions
     def get_actions(self):
-        '''Add actions to override resource create/update/delete actions'''
+        '''Add actions to override resource view create/update/delete actions and the
+        datastore actions that change records, and the performance figures action'''
         return {
             u'resource_view_create': map_action.resource_view_create,
             u'resource_view_update': map_action.resource_view_update,
-            u'resource_view_delete': map_action.resource_view_delete
+            u'resource_view_delete': map_action.resource_view_delete,
+            u'datastore_create': map_action.datastore_create,
+            u'datastore_upsert': map_action.datastore_upsert,
+            u'datastore_delete': map_action.datastore_delete,
+            u'tiledmap_performance': map_action.tiledmap_performance
             }
 
     ## IAuthFunctions
     def get_auth_functions(self):
-        '''Add auth functions for access to geom column creation actions'''
+        '''Add auth functions for access to geom column creation actions and to the
+        performance figures'''
         return {
             u'create_geom_columns': map_auth.create_geom_columns,
-            u'update_geom_columns': map_auth.update_geom_columns
+            u'update_geom_columns': map_auth.update_geom_columns,
+            u'tiledmap_performance': map_auth.tiledmap_performance
             }
 
     ## ITemplateHelpers
@@ -98,6 +116,7 @@ class TiledMapPlugin(SingletonPlugin):
 
         '''
         plugin_config.update(config)
+        install_slowlog()
 
     ## IResourceView
     def info(self):
@@ -154,7 +173,8 @@ class TiledMapPlugin(SingletonPlugin):
 
         '''
         # Check that the Windshaft server is configured
-        if ((plugin_config.get(u'tiledmap.windshaft.host', None) is None) or
+        if not plugin_config.get(u'tiledmap.windshaft.hosts') and (
+                (plugin_config.get(u'tiledmap.windshaft.host', None) is None) or
                 (plugin_config.get(u'tiledmap.windshaft.port', None) is None)):
             return False
         # Check that we have a datastore for this resource
@@ -228,7 +248,9 @@ class TiledMapPlugin(SingletonPlugin):
                 u'resource_id': rid,
                 u'limit': 0
                 }
-            fields = toolkit.get_action(u'datastore_search')(context, data)[u'fields']
+            with span(u'validate.datastore_fields'):
+                fields = toolkit.get_action(u'datastore_search')(context,
+                                                                 data)[u'fields']
             self._datastore_fields[rid] = [f[u'id'] for f in fields]
 
         return self._datastore_fields[rid]
@@ -299,9 +321,10 @@ class TiledMapPlugin(SingletonPlugin):
 
         '''
         if value:
-            views = toolkit.get_action(u'resource_view_list')(context, {
-                u'id': context[u'resource'].id
-                })
+            with span(u'validate.view_id'):
+                views = toolkit.get_action(u'resource_view_list')(context, {
+                    u'id': context[u'resource'].id
+                    })
             if value not in [v[u'id'] for v in views]:
                 raise toolkit.Invalid(
                     toolkit._(u'Must be a view on the current resource'))
@@ -324,7 +347,8 @@ class TiledMapPlugin(SingletonPlugin):
         query = query.where(not_(table.c[value] == None))
         query = query.where(
             or_(cast(table.c[value], Numeric) < -90, cast(table.c[value], Numeric) > 90))
-        with db.begin() as connection:
+        with span(u'validate.latitude_field'), query_context(
+                context[u'resource'].id), db.begin() as connection:
             try:
                 query_result = connection.execute(query)
             except DataError as e:
@@ -354,7 +378,8 @@ class TiledMapPlugin(SingletonPlugin):
         query = query.where(not_(table.c[value] == None))
         query = query.where(or_(cast(table.c[value], Numeric) < -180,
                                 cast(table.c[value], Numeric) > 180))
-        with db.begin() as connection:
+        with span(u'validate.longitude_field'), query_context(
+                context[u'resource'].id), db.begin() as connection:
             try:
                 query_result = connection.execute(query)
             except DataError as e:
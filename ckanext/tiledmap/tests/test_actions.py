@@ -6,6 +6,10 @@
 
 import nose
 from ckanext.tiledmap.config import config as tm_config
+from ckanext.tiledmap.lib.maintenance import refresh_changed_resource
+from ckanext.tiledmap.lib.stats import get_stats
+from mock import patch
+from nose.tools import assert_equal, assert_false, assert_true
 from sqlalchemy import MetaData, Table, create_engine, func
 from sqlalchemy.engine import reflection
 from sqlalchemy.sql import select
@@ -274,3 +278,93 @@ class TestMapActions(helpers.FunctionalTestBase):
             raise
         finally:
             r.close()
+
+    def _upsert(self):
+        '''Upsert a record into the test resource'''
+        toolkit.get_action(u'datastore_upsert')(TestMapActions.context, {
+            u'resource_id': self.resource[u'resource_id'],
+            u'method': u'upsert',
+            u'records': [{
+                u'id': 5,
+                u'latitude': 10,
+                u'longitude': 10,
+                u'skip': u'no',
+                u'lat2': 3,
+                u'long2': 3
+                }]
+            })
+
+    def test_upsert_without_view(self):
+        '''Ensure datastore writes to resources without a tiled map view don't touch the
+        map data'''
+        with patch(u'ckanext.tiledmap.logic.action.resource_changed') as changed, \
+                patch(u'ckanext.tiledmap.lib.stats._get_engine') as stats_engine:
+            self._upsert()
+        assert_false(changed.called)
+        assert_false(stats_engine.called)
+
+    def _create_view(self):
+        '''Create a tiled map view of the test resource'''
+        toolkit.get_action(u'resource_view_create')(TestMapActions.context, {
+            u'title': u'test',
+            u'resource_id': self.resource[u'resource_id'],
+            u'view_type': u'tiledmap',
+            u'latitude_field': u'lat2',
+            u'longitude_field': u'long2',
+            u'enable_plot_map': u'True',
+            u'enable_utf_grid': u'True',
+            u'utf_grid_title': u'_id',
+            u'utf_grid_fields': [u'skip'],
+            u'plot_marker_color': u'#EE0000',
+            u'plot_marker_line_color': u'#FFFFFF',
+            u'grid_base_color': u'#F02323',
+            u'heat_intensity': u'0.1',
+            u'overlapping_records_view': u''
+            })
+
+    def test_upsert_with_view(self):
+        '''Ensure datastore writes to resources with a tiled map view queue a single
+        refresh of their precomputed map data, which recomputes their statistics'''
+        resource_id = self.resource[u'resource_id']
+        self._create_view()
+        with patch(u'ckanext.tiledmap.lib.maintenance.connect_to_redis') as redis, \
+                patch.object(toolkit, u'enqueue_job', create=True) as enqueue_job:
+            # The second write finds the refresh already queued
+            redis.return_value.set.side_effect = [True, None]
+            self._upsert()
+            self._upsert()
+        assert_equal(enqueue_job.call_count, 1)
+        assert_equal(enqueue_job.call_args[0][:2],
+                     (refresh_changed_resource, [resource_id]))
+        # The map is served from the previous statistics meanwhile
+        assert_equal(get_stats(resource_id)[u'total_count'], 4)
+        with patch(u'ckanext.tiledmap.lib.maintenance.connect_to_redis'), \
+                patch(u'ckanext.tiledmap.lib.maintenance.queue_build_stores') as queue:
+            refresh_changed_resource(resource_id)
+        assert_equal(get_stats(resource_id)[u'total_count'], 5)
+        queue.assert_called_once_with(resource_id)
+
+    def test_view_save_queues_stores(self):
+        '''Ensure the side table and point store are not built while the view is
+        saved, but by a background job'''
+        with patch(u'ckanext.tiledmap.logic.action.queue_build_stores') as queue, \
+                patch(u'ckanext.tiledmap.lib.maintenance.build_side_table') as side, \
+                patch(u'ckanext.tiledmap.lib.maintenance.build_point_store') as store:
+            self._create_view()
+        queue.assert_called_once_with(self.resource[u'resource_id'])
+        assert_false(side.called)
+        assert_false(store.called)
+
+    def test_population_slowlog(self):
+        '''Ensure the slow statements populating the geometries are logged'''
+        tm_config.update({
+            u'tiledmap.slowlog.threshold': u'0.000001',
+            u'tiledmap.slowlog.explain_sample': u'0'
+            })
+        try:
+            with patch(u'ckanext.tiledmap.lib.slowlog.log') as log:
+                self._create_view()
+        finally:
+            tm_config[u'tiledmap.slowlog.threshold'] = u'0'
+        statements = [call[0][5] for call in log.warning.call_args_list]
+        assert_true(any(s.upper().startswith(u'UPDATE') for s in statements))
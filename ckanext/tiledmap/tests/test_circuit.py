@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-map
+# Created by the Natural History Museum in London, UK
+
+import time
+
+from ckanext.tiledmap.lib.circuit import CLOSED, CircuitBreaker, HALF_OPEN, OPEN
+from nose.tools import assert_equal, assert_false, assert_true
+
+
+class TestCircuitBreaker(object):
+    '''Test cases for the circuit breaker guarding the renderers'''
+
+    def test_opens_after_max_failures(self):
+        '''Test the circuit opens once enough calls in the window have failed'''
+        circuit = CircuitBreaker(u'test', window=5, max_failures=3)
+        for success in [False, True, False]:
+            circuit.record(success)
+        assert_equal(circuit.state, CLOSED)
+        assert_true(circuit.allow())
+        circuit.record(False)
+        assert_equal(circuit.state, OPEN)
+        assert_false(circuit.allow())
+
+    def test_old_failures_are_forgotten(self):
+        '''Test failures that have left the window don't count'''
+        circuit = CircuitBreaker(u'test', window=3, max_failures=2)
+        for success in [False, True, True, False, True, True]:
+            circuit.record(success)
+        assert_equal(circuit.state, CLOSED)
+
+    def test_slow_calls_are_failures(self):
+        '''Test calls slower than the latency budget count as failures'''
+        circuit = CircuitBreaker(u'test', max_failures=2, slow_call=1)
+        circuit.record(True, 0.5)
+        circuit.record(True, 2)
+        assert_equal(circuit.state, CLOSED)
+        circuit.record(True, 2)
+        assert_equal(circuit.state, OPEN)
+
+    def test_half_open_trial(self):
+        '''Test a single trial call is allowed after the reset timeout, and its outcome
+        closes or opens the circuit again'''
+        circuit = CircuitBreaker(u'test', max_failures=1, reset_timeout=0.1)
+        circuit.record(False)
+        assert_false(circuit.allow())
+        time.sleep(0.15)
+        assert_equal(circuit.state, HALF_OPEN)
+        assert_true(circuit.allow())
+        assert_false(circuit.allow())
+        circuit.record(False)
+        assert_equal(circuit.state, OPEN)
+        time.sleep(0.15)
+        assert_true(circuit.allow())
+        circuit.record(True)
+        assert_equal(circuit.state, CLOSED)
+        assert_true(circuit.allow())
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-map
+# Created by the Natural History Museum in London, UK
+
+import nose
+import sqlalchemy
+from ckanext.tiledmap.commands.add_geom import AddGeomCommand
+from ckanext.tiledmap.lib.stats import get_stats
+from nose.tools import assert_equal, assert_true
+
+from ckan import model
+from ckan.lib.create_test_data import CreateTestData
+from ckan.plugins import toolkit
+from ckan.tests import helpers, legacy
+
+
+class TestAddAllGeoms(helpers.FunctionalTestBase):
+    '''Test the add-all-geoms command'''
+    context = None
+    _load_plugins = [u'tiledmap', u'datastore']
+
+    @classmethod
+    def setup_class(cls):
+        '''Prepare the test'''
+        # We need datastore for these tests.
+        if not legacy.is_datastore_supported():
+            raise nose.SkipTest(u'Datastore not supported')
+
+        super(TestAddAllGeoms, cls).setup_class()
+
+        CreateTestData.create()
+        cls.context = {
+            u'user': model.User.get(u'testsysadmin').name
+            }
+
+    def test_add_all_geoms(self):
+        '''Test the command populates the configured geometry columns, and computes
+        the map statistics of the resources'''
+        dataset = toolkit.get_action(u'package_create')(TestAddAllGeoms.context, {
+            u'name': u'map-test-add-all-geoms'
+            })
+        resource = toolkit.get_action(u'datastore_create')(TestAddAllGeoms.context, {
+            u'resource': {
+                u'package_id': dataset[u'id']
+                },
+            u'fields': [
+                {
+                    u'id': u'latitude',
+                    u'type': u'text'
+                    },
+                {
+                    u'id': u'longitude',
+                    u'type': u'text'
+                    }
+                ],
+            u'records': [
+                {
+                    u'latitude': u'10',
+                    u'longitude': u'20'
+                    },
+                {
+                    u'latitude': u'',
+                    u'longitude': u''
+                    }
+                ]
+            })
+        command = AddGeomCommand(u'ckanextmap')
+        command.context = dict(TestAddAllGeoms.context)
+        command.datastore_db_engine = sqlalchemy.create_engine(
+            toolkit.config[u'ckan.datastore.write_url'])
+        command.add_all_geoms()
+        stats = get_stats(resource[u'resource_id'])
+        assert_true(stats is not None)
+        assert_equal(stats[u'total_count'], 2)
+        assert_equal(stats[u'geom_count'], 1)
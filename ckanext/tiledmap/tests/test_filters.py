@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-map
+# Created by the Natural History Museum in London, UK
+
+import urllib
+
+from ckanext.tiledmap.lib.filters import canonical_params, filters_digest, \
+    filters_key, format_filters, normalise_geometry, normalise_q, parse_filters
+from nose.tools import assert_equal, assert_not_equal
+
+
+class TestFilters(object):
+    '''Test cases for the canonical form of the map filters'''
+
+    def test_parse_filters(self):
+        '''Test equivalent filters are parsed to the same canonical form'''
+        expected = {
+            u'a': [u'1', u'2'],
+            u'b': [u'x:y']
+            }
+        assert_equal(parse_filters(u'b:x:y|a:2|a:1|a:2'), expected)
+        assert_equal(parse_filters(urllib.quote(u'a:1|b:x:y|a:2||')), expected)
+        assert_equal(format_filters(expected), u'a:1|a:2|b:x:y')
+        assert_equal(parse_filters(u''), {})
+        assert_equal(parse_filters(None), {})
+
+    def test_normalise(self):
+        '''Test whitespace and case differences are removed from queries and
+        geometries'''
+        assert_equal(normalise_q(u'  some   text\t'), u'some text')
+        assert_equal(normalise_geometry(u'polygon (( 0 0 , 0  1,1 1, 0 0 ) )'),
+                     u'POLYGON((0 0,0 1,1 1,0 0))')
+        assert_equal(parse_filters(u'_tmgeom:polygon ((0 0, 0 1, 1 1, 0 0))'),
+                     {u'_tmgeom': [u'POLYGON((0 0,0 1,1 1,0 0))']})
+
+    def test_key(self):
+        '''Test the keys and digests of equivalent filters are equal, and geometries
+        are hashed'''
+        geometry = u'POLYGON((0 0,0 1,1 1,0 0))'
+        key = filters_key({u'a': [u'2', u'1'], u'_tmgeom': [geometry]}, u' text ')
+        assert_equal(key, filters_key({u'a': [u'1', u'2', u'1'], u'_tmgeom': [
+            u'polygon((0 0, 0 1, 1 1, 0 0))']}, u'text'))
+        assert_equal(len(key[0][0][1][0]), 40)
+        assert_equal(filters_digest({u'a': [u'2', u'1']}, u'text'),
+                     filters_digest({u'a': [u'1', u'2']}, u' text'))
+        assert_not_equal(filters_digest({u'a': [u'1']}), filters_digest({u'a': [u'2']}))
+
+    def test_canonical_params(self):
+        '''Test the filters and query of request parameters are canonicalised, and
+        dropped if empty'''
+        assert_equal(canonical_params([(u'style', u'plot'), (u'filters', u'b:1|a:2'),
+                                       (u'q', u'%20text'), (u'x', u'')]),
+                     [(u'style', u'plot'), (u'filters', u'a:2|b:1'), (u'q', u'text'),
+                      (u'x', u'')])
+        assert_equal(canonical_params([(u'filters', u''), (u'q', u' ')]), [])
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-map
+# Created by the Natural History Museum in London, UK
+
+from ckanext.tiledmap.config import config
+from ckanext.tiledmap.lib.hashring import HashRing
+from ckanext.tiledmap.lib.renderer import get_backends, get_ring
+from nose.tools import assert_equal, assert_is, assert_true
+
+
+class TestHashRing(object):
+    '''Test cases for the consistent hashing of tiles onto renderers'''
+
+    def setup(self):
+        '''Prepare each test'''
+        self.keys = [u'resource/{0}/{1}/{2}'.format(z, x, y) for z in range(4)
+                     for x in range(2 ** z) for y in range(2 ** z)]
+
+    def test_keys_are_spread(self):
+        '''Test keys are assigned to all the nodes, in similar proportions'''
+        ring = HashRing([u'a:4000', u'b:4000', u'c:4000'])
+        counts = {}
+        for key in self.keys:
+            node = ring.get_node(key)
+            counts[node] = counts.get(node, 0) + 1
+        assert_equal(sorted(counts.keys()), [u'a:4000', u'b:4000', u'c:4000'])
+        for count in counts.values():
+            assert_true(count > len(self.keys) / 6)
+
+    def test_removing_a_node_only_moves_its_keys(self):
+        '''Test removing a node doesn't change the assignment of the other keys'''
+        before = HashRing([u'a:4000', u'b:4000', u'c:4000'])
+        after = HashRing([u'a:4000', u'c:4000'])
+        for key in self.keys:
+            if before.get_node(key) != u'b:4000':
+                assert_equal(before.get_node(key), after.get_node(key))
+
+    def test_failover_order(self):
+        '''Test the failover order lists each node once, and matches the assignment
+        after the first node is removed'''
+        nodes = [u'a:4000', u'b:4000', u'c:4000']
+        ring = HashRing(nodes)
+        for key in self.keys:
+            order = ring.get_nodes(key)
+            assert_equal(sorted(order), nodes)
+            remaining = [n for n in nodes if n != order[0]]
+            assert_equal(HashRing(remaining).get_node(key), order[1])
+
+    def test_empty_ring(self):
+        '''Test a ring without nodes assigns keys to no node'''
+        assert_equal(HashRing([]).get_node(u'key'), None)
+
+    def test_duplicate_backends(self):
+        '''Test renderer hosts listed twice are only used once, and don't cause the
+        ring to be rebuilt on every call'''
+        saved = dict(config)
+        config[u'tiledmap.windshaft.hosts'] = u'a:4000, b:4000 a:4000'
+        try:
+            assert_equal(get_backends(), [u'a:4000', u'b:4000'])
+            assert_is(get_ring(), get_ring())
+        finally:
+            config.update(saved)
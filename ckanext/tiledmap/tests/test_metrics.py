@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-map
+# Created by the Natural History Museum in London, UK
+
+from ckanext.tiledmap.lib.metrics import MAX_SAMPLES, percentile, record_cache, \
+    record_latency, reset_metrics, resource_metrics
+from nose.tools import assert_equal, assert_is_none
+
+
+class TestMetrics(object):
+    '''Test cases for the map request metrics'''
+
+    def setup(self):
+        reset_metrics()
+
+    def teardown(self):
+        reset_metrics()
+
+    def test_percentile(self):
+        '''Test percentiles use the nearest rank'''
+        samples = range(1, 101)
+        assert_equal(percentile(samples, 0.5), 50)
+        assert_equal(percentile(samples, 0.95), 95)
+        assert_equal(percentile([3, 1, 2], 0.5), 2)
+        assert_equal(percentile([1], 0.95), 1)
+        assert_is_none(percentile([], 0.5))
+
+    def test_resource_metrics(self):
+        '''Test the metrics are kept per resource, over the last samples'''
+        for i in range(MAX_SAMPLES + 100):
+            record_latency(u'a', u'map_info', 1 if i < 100 else 0.01)
+        record_latency(u'a', u'tile', 0.002)
+        record_latency(u'b', u'tile', 1)
+        for hit in [True, True, True, False]:
+            record_cache(u'a', hit)
+        metrics = resource_metrics(u'a')
+        assert_equal(metrics[u'map_info_p50_ms'], 10)
+        assert_equal(metrics[u'map_info_p95_ms'], 10)
+        assert_equal(metrics[u'tile_p95_ms'], 2)
+        assert_equal(metrics[u'tile_cache_hits'], 3)
+        assert_equal(metrics[u'tile_cache_misses'], 1)
+        assert_equal(metrics[u'tile_cache_hit_rate'], 0.75)
+        metrics = resource_metrics(u'c')
+        assert_is_none(metrics[u'tile_cache_hit_rate'])
+        assert_is_none(metrics[u'map_info_p50_ms'])
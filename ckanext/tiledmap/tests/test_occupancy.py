@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-map
+# Created by the Natural History Museum in London, UK
+
+from ckanext.tiledmap.lib.occupancy import is_tile_empty
+from mock import MagicMock, patch
+from nose.tools import assert_equal, assert_false
+from sqlalchemy.exc import ProgrammingError
+
+
+class DBAPIProgrammingError(Exception):
+    '''Stands for the DBAPI's own ProgrammingError, which isn't raised here'''
+
+
+class TestOccupancy(object):
+    '''Test cases for the tile occupancy bitmaps'''
+
+    def test_missing_table_remembered(self):
+        '''Test tiles aren't looked up again for a while once the table was found
+        missing'''
+        error = Exception(u'relation does not exist')
+        error.pgcode = u'42P01'
+        engine = MagicMock()
+        engine.dialect.dbapi.ProgrammingError = DBAPIProgrammingError
+        engine.connect.return_value.__enter__.side_effect = \
+            ProgrammingError(u'SELECT', {}, error)
+        with patch(u'ckanext.tiledmap.lib.occupancy.get_map_engine',
+                   lambda resource_id: engine), \
+                patch(u'ckanext.tiledmap.lib.occupancy.max_zoom', lambda: 8), \
+                patch(u'ckanext.tiledmap.lib.occupancy._table_missing_until', 0):
+            for x in range(3):
+                assert_false(is_tile_empty(u'resource', 4, x, 1))
+            assert_equal(engine.connect.call_count, 1)
+            with patch(u'ckanext.tiledmap.lib.occupancy.time.time',
+                       lambda: 2 ** 40):
+                assert_false(is_tile_empty(u'resource', 4, 0, 1))
+            assert_equal(engine.connect.call_count, 2)
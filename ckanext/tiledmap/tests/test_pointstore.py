@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-map
+# Created by the Natural History Museum in London, UK
+
+import shutil
+import tempfile
+
+import nose
+from ckanext.tiledmap.config import config as tm_config
+from ckanext.tiledmap.lib.occupancy import MERCATOR_EXTENT
+from ckanext.tiledmap.lib.pointstore import get_point_store, morton_coordinates, \
+    morton_keys, numpy, write_point_store
+from ckanext.tiledmap.lib.render import render_tile
+from nose.tools import assert_equal, assert_is_none, assert_true
+
+
+class TestPointStore(object):
+    '''Test cases for the memory mapped point stores'''
+
+    def setup(self):
+        if numpy is None:
+            raise nose.SkipTest(u'numpy is not installed')
+        self.config = dict(tm_config.items())
+        self.directory = tempfile.mkdtemp()
+        tm_config.update({
+            u'tiledmap.point_store.dir': self.directory,
+            u'tiledmap.point_store.zoom': u'2',
+            u'tiledmap.point_store.density_zooms': u'1,3'
+            })
+        # A point at the centre of each tile of zoom level 3
+        size = 2 * MERCATOR_EXTENT / 8
+        self.points = [(x, y, x * 8 + y) for x in range(8) for y in range(8)]
+        write_point_store(u'resource',
+                          [(x + 0.5) * size - MERCATOR_EXTENT for x, y, i in self.points],
+                          [MERCATOR_EXTENT - (y + 0.5) * size for x, y, i in self.points],
+                          [i for x, y, i in self.points])
+
+    def teardown(self):
+        tm_config.update(self.config)
+        shutil.rmtree(self.directory)
+
+    def _tile_ids(self, z, x, y):
+        return sorted(get_point_store(u'resource').tile_points(z, x, y)[2].tolist())
+
+    def test_morton_keys(self):
+        '''Test tiles covered by a parent tile have contiguous keys'''
+        assert_equal([morton_keys(x, y) for y in range(2) for x in range(2)],
+                     [0, 1, 2, 3])
+        keys = sorted(morton_keys(x, y) for x in range(2, 4) for y in range(2, 4))
+        assert_equal(keys, [12, 13, 14, 15])
+
+    def test_tile_points(self):
+        '''Test the points of tiles above, at and below the store's zoom level'''
+        assert_equal(len(get_point_store(u'resource')), 64)
+        assert_equal(self._tile_ids(0, 0, 0), range(64))
+        assert_equal(self._tile_ids(1, 1, 0), [32 + x * 8 + y for x in range(4)
+                                               for y in range(4)])
+        assert_equal(self._tile_ids(2, 3, 3), [54, 55, 62, 63])
+        assert_equal(self._tile_ids(3, 5, 2), [42])
+        # The point of tile (5, 2) is on the top left corner of its tile (11, 5)
+        assert_equal(self._tile_ids(4, 11, 5), [42])
+        assert_equal(self._tile_ids(4, 10, 4), [])
+
+    def test_zero_copy(self):
+        '''Test tiles at the store's zoom level are views on the mapped files'''
+        x, y, ids = get_point_store(u'resource').tile_points(2, 1, 1)
+        assert_true(isinstance(ids.base, numpy.memmap) or
+                    isinstance(ids, numpy.memmap))
+
+    def test_rebuild(self):
+        '''Test stores are reopened when they are rebuilt, and missing stores'''
+        write_point_store(u'resource', [0.0], [0.0], [7])
+        assert_equal(self._tile_ids(0, 0, 0), [7])
+        assert_is_none(get_point_store(u'other'))
+
+    def test_density(self):
+        '''Test density rasters count the points of each tile'''
+        store = get_point_store(u'resource')
+        for z in range(4):
+            for x in range(2 ** z):
+                for y in range(2 ** z):
+                    zoom, px, py, counts = store.tile_density(z, x, y)
+                    assert_equal(zoom, 1 if z <= 1 else 3)
+                    assert_true(((px >> (zoom + 8 - z)) == x).all())
+                    assert_equal(counts.sum(), len(store.tile_points(z, x, y)[0]))
+        assert_is_none(store.tile_density(4, 0, 0))
+        keys = morton_keys(numpy.array([5, 1 << 20]), numpy.array([9, 3]))
+        assert_equal([list(c) for c in morton_coordinates(keys)], [[5, 1 << 20],
+                                                                     [9, 3]])
+
+    def test_density_tiles(self):
+        '''Test heatmap and plot tiles drawn from the density rasters are those drawn
+        from the points'''
+        random = numpy.random.RandomState(1)
+        write_point_store(u'resource', random.normal(1e6, 3e6, 5000),
+                          random.normal(1e6, 3e6, 5000), numpy.arange(5000))
+        store = get_point_store(u'resource')
+        tiles = [(style, z, x, y) for style in (u'heatmap', u'plot')
+                 for z, x, y in [(1, 1, 0), (3, 4, 3), (3, 0, 3)]]
+        rasters = [render_tile(store, style, z, x, y, {}) for style, z, x, y in tiles]
+        store.density = {}
+        points = [render_tile(store, style, z, x, y, {}) for style, z, x, y in tiles]
+        assert_equal(rasters, points)
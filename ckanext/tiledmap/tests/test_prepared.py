@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-map
+# Created by the Natural History Museum in London, UK
+
+from ckanext.tiledmap.lib.prepared import compile_statement
+from ckanext.tiledmap.lib.query import GEOM_FILTER, apply_filters, filter_columns, \
+    filter_params, filter_shape, get_table
+from nose.tools import assert_equal, assert_not_equal
+from sqlalchemy import func
+from sqlalchemy.dialects.postgresql.psycopg2 import PGDialect_psycopg2
+from sqlalchemy.sql import select
+
+
+class TestPrepared(object):
+    '''Test cases for the prepared statements of map queries'''
+
+    def _compile(self, filters, q=None):
+        '''Compile the count query of the given filters'''
+        table = get_table(u'resource', filter_columns(filters, q))
+        query = apply_filters(select([func.count()], from_obj=table), table, filters, q)
+        return compile_statement(query, PGDialect_psycopg2())
+
+    def test_compile_statement(self):
+        '''Test statements use positional parameters, in the order of filter_params'''
+        filters = {
+            u'b': [u'1', u'2'],
+            u'a': [u'100%']
+            }
+        statement = self._compile(filters, u'text')
+        assert_equal(statement.sql.count(u'$'), 4)
+        assert_equal(statement.names, [u'filter_0_0', u'filter_1_0', u'filter_1_1',
+                                       u'filter_q'])
+        params = filter_params(filters, u'text')
+        assert_equal([params[n] for n in statement.names], [u'100%', u'1', u'2',
+                                                            u'text'])
+        statement = compile_statement(u"SELECT 1 WHERE 'a%' LIKE :value",
+                                      PGDialect_psycopg2())
+        assert_equal(statement.sql, u"SELECT 1 WHERE 'a%' LIKE $1")
+
+    def test_filter_shape(self):
+        '''Test filters of the same shape have the same statement'''
+        first = {
+            u'a': [u'x'],
+            GEOM_FILTER: [u'POINT(0 0)']
+            }
+        second = {
+            GEOM_FILTER: [u'POINT(1 1)'],
+            u'a': [u'y']
+            }
+        assert_equal(filter_shape(first), filter_shape(second))
+        assert_equal(self._compile(first).name, self._compile(second).name)
+        assert_not_equal(filter_shape(first), filter_shape(first, u'q'))
+        assert_not_equal(filter_shape(first), filter_shape({
+            u'a': [u'x', u'y']
+            }))
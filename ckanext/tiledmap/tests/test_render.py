@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-map
+# Created by the Natural History Museum in London, UK
+
+import struct
+import zlib
+
+import nose
+from ckanext.tiledmap.lib.occupancy import MERCATOR_EXTENT
+from ckanext.tiledmap.lib.render import TILE_SIZE, cell_counts, density, \
+    gradient_table, grid_cells, numpy, parse_color, pixel_coordinates, render_gridded, \
+    render_heatmap, render_plot, to_png
+from nose.tools import assert_equal, assert_true
+
+
+class TestRender(object):
+    '''Test cases for the builtin tile renderer'''
+
+    def setup(self):
+        if numpy is None:
+            raise nose.SkipTest(u'numpy is not installed')
+
+    def _point(self, px, py, z=1, x=0, y=0):
+        '''Return the web mercator coordinates of the given pixel of the given tile'''
+        size = 2 * MERCATOR_EXTENT / (TILE_SIZE * 2 ** z)
+        return (numpy.array([(x * TILE_SIZE + px) * size - MERCATOR_EXTENT]),
+                numpy.array([MERCATOR_EXTENT - (y * TILE_SIZE + py) * size]))
+
+    def test_parse_color(self):
+        '''Test long and short colour notations are parsed'''
+        assert_equal(parse_color(u'#EE0000'), (238, 0, 0))
+        assert_equal(parse_color(u' #fff'), (255, 255, 255))
+
+    def test_pixel_coordinates(self):
+        '''Test points are placed relative to the tile's top left corner'''
+        px, py = pixel_coordinates(*self._point(10.5, 20.5, x=1, y=1), z=1, x=1, y=1)
+        assert_true(abs(px[0] - 10.5) < 1e-6)
+        assert_true(abs(py[0] - 20.5) < 1e-6)
+
+    def test_render_plot(self):
+        '''Test markers are drawn with their fill and outline colours, including
+        markers of points just outside of the tile'''
+        mx, my = self._point(100.5, 100.5)
+        ox, oy = self._point(-2.5, 50.5)
+        image = render_plot(numpy.concatenate([mx, ox]), numpy.concatenate([my, oy]),
+                            1, 0, 0, 8, (238, 0, 0), (255, 255, 255))
+        assert_equal(image.shape, (TILE_SIZE, TILE_SIZE, 4))
+        assert_equal(tuple(image[100, 100]), (238, 0, 0, 255))
+        assert_equal(tuple(image[100, 104]), (255, 255, 255, 255))
+        assert_equal(tuple(image[100, 110]), (0, 0, 0, 0))
+        assert_equal(image[50, 0, 3], 255)
+
+    def test_grid_cells(self):
+        '''Test points are thinned to the lowest id of each cell, and markers spread
+        over the cells they cover'''
+        px = numpy.array([10.5, 9.5, 11.5, 100.5, -1.5])
+        py = numpy.array([10.5, 9.5, 11.5, 100.5, 100.5])
+        ids = numpy.array([7, 3, 5, 8, 9])
+        grid, representatives, counts, columns, rows = grid_cells(px, py, ids, 4, 4)
+        assert_equal(grid.shape, (64, 64))
+        cells = sorted(zip(ids[representatives], counts, columns, rows))
+        assert_equal(cells, [(3, 3, 2, 2), (8, 1, 25, 25), (9, 1, -1, 25)])
+        assert_equal(ids[representatives[grid[2, 2] - 1]], 3)
+        assert_equal(ids[representatives[grid[25, 26] - 1]], 8)
+        assert_equal(ids[representatives[grid[25, 0] - 1]], 9)
+        assert_equal(grid[25, 27], 0)
+        assert_equal(grid[40, 40], 0)
+
+    def test_render_gridded(self):
+        '''Test cells are more opaque as they contain more points'''
+        mx, my = self._point(numpy.array([1.5] * 100 + [20.5]),
+                             numpy.array([1.5] * 100 + [1.5]))
+        counts = cell_counts(*pixel_coordinates(mx, my, 1, 0, 0), resolution=8)
+        assert_equal(counts[0, 0], 100)
+        assert_equal(counts[0, 2], 1)
+        assert_equal(counts.sum(), 101)
+        image = render_gridded(mx, my, 1, 0, 0, 8, (240, 35, 35))
+        assert_equal(tuple(image[0, 0, :3]), (240, 35, 35))
+        assert_true(image[7, 7, 3] > image[0, 16, 3] > 0)
+        assert_equal(image[0, 8, 3], 0)
+
+    def test_density(self):
+        '''Test the density peaks at 1 per point, and fades out at the radius'''
+        values = density(numpy.array([50.5, 50.5]), numpy.array([50.5, 50.5]), 10)
+        assert_true(abs(values[50, 50] - 2) < 1e-6)
+        assert_true(values[50, 55] < values[50, 52] < 2)
+        assert_equal(values[50, 61], 0)
+
+    def test_render_heatmap(self):
+        '''Test the heatmap colours follow the gradient'''
+        gradient = gradient_table(u'#0000FF, #FF0000')
+        assert_equal(tuple(gradient[0]), (0, 0, 255))
+        assert_equal(tuple(gradient[255]), (255, 0, 0))
+        mx, my = self._point(numpy.array([128.5] * 50), numpy.array([128.5] * 50))
+        image = render_heatmap(mx, my, 1, 0, 0, 20, 0.1, gradient)
+        assert_true(image[128, 128, 3] > 250)
+        assert_true(image[128, 128, 0] > 250)
+        assert_equal(image[0, 0, 3], 0)
+
+    def test_to_png(self):
+        '''Test images are encoded as valid PNGs'''
+        image = numpy.zeros((2, 3, 4), dtype=numpy.uint8)
+        image[1, 2] = (1, 2, 3, 4)
+        png = to_png(image)
+        assert_equal(png[:8], b'\x89PNG\r\n\x1a\n')
+        assert_equal(struct.unpack(u'>II', png[16:24]), (3, 2))
+        length = struct.unpack(u'>I', png[33:37])[0]
+        scanlines = zlib.decompress(png[41:41 + length])
+        assert_equal(scanlines[-4:], b'\x01\x02\x03\x04')
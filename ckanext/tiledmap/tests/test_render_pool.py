@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-map
+# Created by the Natural History Museum in London, UK
+
+import threading
+import time
+
+from ckanext.tiledmap.lib.render_pool import RenderPool, RenderTimeout
+from ckanext.tiledmap.lib.renderer import RendererBusy, RendererUnavailable
+from nose.tools import assert_equal, assert_raises, assert_true
+
+
+def _job(args):
+    '''Job function of the test pools: sleep for the given number of seconds, and
+    return the given number of bytes (or fail if it is negative)'''
+    delay, size = args
+    time.sleep(delay)
+    if size < 0:
+        raise ValueError(u'Invalid size')
+    return b'x' * size
+
+
+class TestRenderPool(object):
+    '''Test cases for the process pool of the builtin renderer'''
+
+    def setup(self):
+        self.pool = RenderPool(1, 2, _job)
+        # Wait for the worker to start
+        self.pool.render((0, 0), 5)
+
+    def teardown(self):
+        self.pool.close()
+
+    def _submit(self, results, args, session=None, z=None):
+        '''Run the given job in a thread, appending the thread's name to the given list
+        when it completes'''
+
+        def run():
+            self.pool.render(args, 5, session, z)
+            results.append(thread.name)
+
+        thread = threading.Thread(target=run, name=u'{0}'.format(z))
+        thread.start()
+        return thread
+
+    def test_render(self):
+        '''Test results are returned whole, and errors raised to the caller'''
+        assert_equal(self.pool.render((0, 1 << 20), 5), b'x' * (1 << 20))
+        with assert_raises(RendererUnavailable):
+            self.pool.render((0, -1), 5)
+        assert_equal(self.pool.render((0, 3), 5), b'xxx')
+
+    def test_queue_size(self):
+        '''Test jobs are refused when the queue is full'''
+        results = []
+        threads = [self._submit(results, (0.5, 1))]
+        time.sleep(0.2)
+        threads += [self._submit(results, (0, 1)) for i in range(2)]
+        time.sleep(0.1)
+        with assert_raises(RendererBusy):
+            self.pool.render((0, 1), 5)
+        for thread in threads:
+            thread.join()
+        assert_equal(len(results), 3)
+
+    def test_deadline(self):
+        '''Test workers overrunning their deadline are replaced'''
+        start = time.time()
+        with assert_raises(RenderTimeout):
+            self.pool.render((5, 1), 0.2)
+        assert_true(time.time() - start < 2)
+        assert_equal(self.pool.render((0, 1), 5), b'x')
+
+    def test_priority(self):
+        '''Test tiles at the session's latest zoom level are rendered first'''
+        results = []
+        threads = [self._submit(results, (0.5, 1))]
+        time.sleep(0.2)
+        threads.append(self._submit(results, (0.1, 1), u'session', 3))
+        time.sleep(0.05)
+        threads.append(self._submit(results, (0.1, 1), u'session', 4))
+        for thread in threads:
+            thread.join()
+        assert_equal(results, [u'None', u'4', u'3'])
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-map
+# Created by the Natural History Museum in London, UK
+
+import time
+
+from ckanext.tiledmap.lib.replicas import Replica, ReplicaSet, parse_replicas
+from nose.tools import assert_equal, assert_greater, assert_in, assert_is_none, \
+    assert_less, assert_raises
+
+
+class TestReplicas(object):
+    '''Test cases for the routing of map queries to read replicas'''
+
+    def setup(self):
+        self.lags = {
+            u'a': 0,
+            u'b': 0
+            }
+        self.replicas = ReplicaSet([
+            Replica(u'a', 1, lambda: self.lags[u'a']),
+            Replica(u'b', 3, lambda: self.lags[u'b'])
+            ], 10, 0)
+
+    def test_parse_replicas(self):
+        '''Test replica URLs and weights are parsed'''
+        assert_equal(parse_replicas(u' postgresql://u:p@a/db#2\npostgresql://b/db '),
+                     [(u'postgresql://u:p@a/db', 2), (u'postgresql://b/db', 1)])
+        assert_equal(parse_replicas(u'postgresql://a/db#0'), [])
+        with assert_raises(ValueError):
+            parse_replicas(u'postgresql://a/db#x')
+
+    def test_weights(self):
+        '''Test queries are spread in proportion to the weights, and sessions stick to
+        a replica'''
+        counts = {
+            u'a': 0,
+            u'b': 0
+            }
+        for i in range(2000):
+            counts[self.replicas.choose().url] += 1
+        assert_greater(counts[u'b'], 2 * counts[u'a'])
+        assert_less(counts[u'b'], 4 * counts[u'a'])
+        sessions = {
+            u'a': 0,
+            u'b': 0
+            }
+        for i in range(2000):
+            replica = self.replicas.choose(session=unicode(i))
+            assert_equal(self.replicas.choose(session=unicode(i)), replica)
+            sessions[replica.url] += 1
+        assert_greater(sessions[u'b'], 2 * sessions[u'a'])
+        assert_less(sessions[u'b'], 4 * sessions[u'a'])
+
+    def test_lag(self):
+        '''Test lagging and unreachable replicas are skipped'''
+        self.lags[u'b'] = 20
+        for i in range(20):
+            assert_equal(self.replicas.choose(session=unicode(i)).url, u'a')
+        self.lags[u'a'] = None
+        assert_is_none(self.replicas.choose())
+        self.lags[u'b'] = 5
+        assert_equal(self.replicas.choose().url, u'b')
+
+    def test_check_interval(self):
+        '''Test the lag is only measured once per check interval'''
+        calls = []
+        replica = Replica(u'a', 1, lambda: calls.append(1) or len(calls))
+        assert_equal(replica.lag(60), 1)
+        assert_equal(replica.lag(60), 1)
+        assert_equal(replica.lag(0), 2)
+
+    def test_recently_written(self):
+        '''Test queries about recently written resources go to the primary'''
+        self.replicas.mark_written(u'resource')
+        assert_is_none(self.replicas.choose(u'resource'))
+        assert_in(self.replicas.choose(u'other').url, [u'a', u'b'])
+        self.replicas.max_lag = 0.1
+        time.sleep(0.2)
+        assert_in(self.replicas.choose(u'resource').url, [u'a', u'b'])
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-map
+# Created by the Natural History Museum in London, UK
+
+from ckanext.tiledmap.lib.seed import seed_requests, tile_range
+from nose.tools import assert_equal, assert_in
+
+
+class TestSeed(object):
+    '''Test cases for the selection of the tiles to seed'''
+
+    view = {
+        u'id': u'view',
+        u'resource_id': u'resource',
+        u'enable_plot_map': True,
+        u'enable_grid_map': False,
+        u'enable_heat_map': True,
+        u'enable_utf_grid': True,
+        u'utf_grid_title': u'_id',
+        u'utf_grid_fields': [u'name']
+        }
+
+    def test_tile_range_world(self):
+        '''Test the whole world is covered by all the tiles'''
+        bounds = ((-85, -180), (85, 180))
+        assert_equal(tile_range(bounds, 0), ((0, 0), (0, 0)))
+        assert_equal(tile_range(bounds, 2), ((0, 3), (0, 3)))
+
+    def test_tile_range_extent(self):
+        '''Test only the tiles covering the extent are selected'''
+        # London
+        bounds = ((51.4, -0.2), (51.6, 0.1))
+        assert_equal(tile_range(bounds, 1), ((0, 1), (0, 0)))
+        assert_equal(tile_range(bounds, 10), ((511, 512), (340, 340)))
+        # South of the equator, east of the meridian
+        assert_equal(tile_range(((-20, 10), (-10, 20)), 1), ((1, 1), (1, 1)))
+
+    def test_seed_requests(self):
+        '''Test the requests match the enabled styles and grids'''
+        bounds = ((-20, 10), (-10, 20))
+        requests = list(seed_requests(self.view, None, 0, 1, bounds))
+        # 2 zoom levels with 1 tile each, plot tile, plot grid and heatmap tile
+        assert_equal(len(requests), 6)
+        assert_in((u'resource', 1, 1, 1), [r[:4] for r in requests])
+        grids = [r for r in requests if r[4] == u'grid.json']
+        assert_equal(len(grids), 2)
+        assert_in((u'style', u'plot'), grids[0][5])
+        assert_in((u'filters', u''), grids[0][5])
+        requests = list(seed_requests(self.view, [u'heatmap'], 0, 1, bounds))
+        assert_equal(len(requests), 2)
+        assert_equal(set(r[4] for r in requests), set([u'png']))
@@ -0,0 +1,32 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-map
+# Created by the Natural History Museum in London, UK
+
+from ckanext.tiledmap.lib.sidetable import drop_side_table, query_table, \
+    side_table_name
+from mock import MagicMock, patch
+from nose.tools import assert_equal
+
+
+class TestSideTable(object):
+    '''Test cases for the side tables'''
+
+    def test_columns_cached(self):
+        '''Test the columns of a side table are only looked up once, until the table
+        is dropped'''
+        columns = MagicMock(return_value=set([u'_id', u'field']))
+        with patch(u'ckanext.tiledmap.lib.sidetable.is_enabled', lambda: True), \
+                patch(u'ckanext.tiledmap.lib.sidetable._get_engine', MagicMock()), \
+                patch(u'ckanext.tiledmap.lib.sidetable.side_table_columns', columns), \
+                patch(u'ckanext.tiledmap.lib.sidetable._columns', {}):
+            for fields in [(), (u'field',), (u'other',)]:
+                expected = resource_id = u'resource'
+                if u'other' not in fields:
+                    expected = side_table_name(resource_id)
+                assert_equal(query_table(resource_id, {}, fields=fields), expected)
+            assert_equal(columns.call_count, 1)
+            drop_side_table(u'resource')
+            query_table(u'resource', {})
+            assert_equal(columns.call_count, 2)
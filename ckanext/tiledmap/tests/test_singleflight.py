@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-map
+# Created by the Natural History Museum in London, UK
+
+import shutil
+import tempfile
+import threading
+import time
+
+from ckanext.tiledmap.lib.singleflight import FileSingleFlight, LockTimeout, SingleFlight
+from nose.tools import assert_equal, assert_raises
+
+
+class TestSingleFlight(object):
+    '''Test cases for the request coalescing'''
+
+    def setup(self):
+        '''Prepare each test'''
+        self.lock_dir = tempfile.mkdtemp()
+        self.calls = 0
+        self.calls_lock = threading.Lock()
+
+    def teardown(self):
+        '''Clean up after each test'''
+        shutil.rmtree(self.lock_dir)
+
+    def _compute(self):
+        '''Slow computation that counts the number of times it was invoked'''
+        with self.calls_lock:
+            self.calls += 1
+        time.sleep(0.2)
+        return {
+            u'count': 42
+            }
+
+    def _run_concurrently(self, single_flight, key, function, count=10):
+        '''Invoke the single flight object concurrently from several threads, and
+        return the results
+
+        :param single_flight: the single flight object
+        :param key: the key of the computation
+        :param function: the function to invoke
+        :param count: the number of threads
+
+        '''
+        results = []
+
+        def run():
+            try:
+                results.append(single_flight.do(key, function))
+            except Exception as e:
+                results.append(e)
+
+        threads = [threading.Thread(target=run) for i in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_concurrent_calls_are_coalesced(self):
+        '''Test concurrent identical calls share a single computation'''
+        results = self._run_concurrently(SingleFlight(), u'key', self._compute)
+        assert_equal(self.calls, 1)
+        assert_equal(results, [{
+            u'count': 42
+            }] * 10)
+
+    def test_distinct_keys_are_not_coalesced(self):
+        '''Test calls with different keys are computed separately'''
+        single_flight = SingleFlight()
+        single_flight.do(u'a', self._compute)
+        single_flight.do(u'b', self._compute)
+        assert_equal(self.calls, 2)
+
+    def test_results_are_not_cached(self):
+        '''Test sequential calls with the same key are computed each time'''
+        single_flight = SingleFlight()
+        single_flight.do(u'key', self._compute)
+        single_flight.do(u'key', self._compute)
+        assert_equal(self.calls, 2)
+
+    def test_errors_are_shared(self):
+        '''Test an error raised by the computation is raised in all callers'''
+
+        def fail():
+            self._compute()
+            raise ValueError(u'failed')
+
+        results = self._run_concurrently(SingleFlight(), u'key', fail)
+        assert_equal(self.calls, 1)
+        assert_equal(len([r for r in results if isinstance(r, ValueError)]), 10)
+        # The failure is not remembered
+        with assert_raises(ValueError):
+            SingleFlight().do(u'key', fail)
+
+    def test_retry_on(self):
+        '''Test waiting callers make the call again when it fails with an error that is
+        specific to the caller that made it'''
+        failures = []
+
+        def fail_once():
+            self._compute()
+            if not failures:
+                failures.append(True)
+                raise KeyError(u'failed')
+            return 42
+
+        single_flight = SingleFlight()
+        results = self._run_concurrently(single_flight, u'key', fail_once)
+        assert_equal(len([r for r in results if isinstance(r, KeyError)]), 10)
+        del failures[:]
+        results = []
+
+        def run():
+            try:
+                results.append(single_flight.do(u'key', fail_once, (KeyError,)))
+            except KeyError as e:
+                results.append(e)
+
+        threads = [threading.Thread(target=run) for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert_equal(len([r for r in results if isinstance(r, KeyError)]), 1)
+        assert_equal(len([r for r in results if r == 42]), 4)
+
+    def test_file_backend(self):
+        '''Test the file backend coalesces calls and shares fresh results'''
+        results = self._run_concurrently(FileSingleFlight(self.lock_dir, 60),
+                                         (u'extent', u'resource'), self._compute)
+        assert_equal(self.calls, 1)
+        assert_equal(results, [{
+            u'count': 42
+            }] * 10)
+        # Another instance (as in another process) uses the stored result
+        result = FileSingleFlight(self.lock_dir, 60).do((u'extent', u'resource'),
+                                                        self._compute)
+        assert_equal(self.calls, 1)
+        assert_equal(result, {
+            u'count': 42
+            })
+        # Unless it has expired
+        FileSingleFlight(self.lock_dir, 0).do((u'extent', u'resource'), self._compute)
+        assert_equal(self.calls, 2)
+
+    def test_file_backend_wait_timeout(self):
+        '''Test calls waiting too long on the same call in another process fail'''
+        started = threading.Event()
+        release = threading.Event()
+
+        def compute():
+            started.set()
+            release.wait()
+            return 42
+
+        key = (u'extent', u'resource')
+        thread = threading.Thread(
+            target=lambda: FileSingleFlight(self.lock_dir, 60).do(key, compute))
+        thread.start()
+        try:
+            started.wait()
+            with assert_raises(LockTimeout):
+                FileSingleFlight(self.lock_dir, 60, wait_timeout=0.1).do(key,
+                                                                         self._compute)
+        finally:
+            release.set()
+            thread.join()
+        assert_equal(self.calls, 0)
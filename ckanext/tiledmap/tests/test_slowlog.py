@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-map
+# Created by the Natural History Museum in London, UK
+
+from ckanext.tiledmap.config import config
+from ckanext.tiledmap.lib.slowlog import analyzed, install, normalise_sql, \
+    query_context, set_query_context
+from mock import patch
+from nose.tools import assert_equal, assert_false, assert_in, assert_true
+from sqlalchemy import create_engine
+
+
+class TestSlowLog(object):
+    '''Test cases for the slow map query log'''
+
+    def setup(self):
+        self.config = dict(config)
+        config.update({
+            u'tiledmap.slowlog.threshold': u'0.000001',
+            u'tiledmap.slowlog.explain_sample': u'0'
+            })
+        install()
+        self.engine = create_engine(u'sqlite://')
+
+    def teardown(self):
+        config.update(self.config)
+        set_query_context()
+
+    def test_normalise_sql(self):
+        '''Test SQL statements are put on a single line'''
+        assert_equal(normalise_sql(u'SELECT a,\n       b\n  FROM t '),
+                     u'SELECT a, b FROM t')
+
+    @patch(u'ckanext.tiledmap.lib.slowlog.log')
+    def test_context(self, log):
+        '''Test only the slow queries made in a query context are logged, with their
+        resource and filters'''
+        self.engine.execute(u'SELECT 1').close()
+        assert_false(log.warning.called)
+        with query_context(u'resource', u'digest'):
+            with query_context(u'other'):
+                pass
+            self.engine.execute(u'SELECT ?', 2).close()
+        self.engine.execute(u'SELECT 3').close()
+        assert_equal(log.warning.call_count, 1)
+        args = log.warning.call_args[0]
+        assert_in(u'resource', args)
+        assert_in(u'digest', args)
+        assert_in(u'SELECT ?', args)
+        assert_true(any(u'2' in unicode(a) for a in args[1:]))
+
+    @patch(u'ckanext.tiledmap.lib.slowlog.log')
+    def test_threshold(self, log):
+        '''Test queries faster than the threshold are not logged'''
+        config[u'tiledmap.slowlog.threshold'] = u'60000'
+        set_query_context(u'resource')
+        self.engine.execute(u'SELECT 1').close()
+        config[u'tiledmap.slowlog.threshold'] = u'0'
+        self.engine.execute(u'SELECT 1').close()
+        assert_false(log.warning.called)
+
+    @patch(u'ckanext.tiledmap.lib.slowlog.log')
+    def test_population_statements(self, log):
+        '''Test the statements populating the geometries, which run on other engines
+        (such as ckanext-dataspatial's), are logged'''
+        engine = create_engine(u'sqlite://')
+        engine.execute(u'CREATE TABLE resource (latitude REAL, geom TEXT)').close()
+        with query_context(u'resource'):
+            engine.execute(u'UPDATE resource SET geom = latitude').close()
+        assert_equal(log.warning.call_count, 1)
+        assert_in(u'UPDATE resource SET geom = latitude', log.warning.call_args[0])
+
+    @patch(u'ckanext.tiledmap.lib.slowlog._queue_explain')
+    def test_analyze(self, queue_explain):
+        '''Test only the queries marked as map reads are explained with ANALYZE'''
+        config[u'tiledmap.slowlog.explain_sample'] = u'1'
+        with query_context(u'resource'), self.engine.connect() as connection:
+            connection.execute(u'SELECT 1').close()
+            analyzed(connection).execute(u'SELECT 2').close()
+        assert_equal([c[0][2] for c in queue_explain.call_args_list],
+                     [u'SELECT 1', u'SELECT 2'])
+        assert_equal([c[0][5] for c in queue_explain.call_args_list], [False, True])
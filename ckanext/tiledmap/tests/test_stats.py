@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-map
+# Created by the Natural History Museum in London, UK
+
+import datetime
+
+from ckanext.tiledmap.lib.stats import _upsert, delete_stats, get_populated, \
+    get_stats, record_populated
+from mock import MagicMock, patch
+from nose.tools import assert_equal, assert_raises, assert_true
+from sqlalchemy import create_engine
+from sqlalchemy.exc import ProgrammingError
+
+
+def _missing_table_engine(pgcode):
+    '''Return a mock engine whose queries fail with the given Postgres error code'''
+    error = Exception(u'relation does not exist')
+    error.pgcode = pgcode
+    engine = MagicMock()
+    engine.connect.return_value.__enter__.return_value.execute.side_effect = \
+        ProgrammingError(u'SELECT', {}, error)
+    return engine
+
+
+class TestStats(object):
+    '''Test the stored statistics'''
+
+    def test_get_stats_missing_table(self):
+        '''Test resources have no statistics until the table is created, and reading
+        them doesn't create it'''
+        engines = []
+
+        def get_engine(write=False):
+            engines.append(write)
+            return _missing_table_engine(u'42P01')
+
+        with patch(u'ckanext.tiledmap.lib.stats._get_engine', get_engine):
+            assert_equal(get_stats(u'resource'), None)
+        assert_equal(engines, [False])
+
+    def test_get_stats_error(self):
+        '''Test other database errors are raised'''
+        with patch(u'ckanext.tiledmap.lib.stats._get_engine',
+                   lambda write=False: _missing_table_engine(u'42501')):
+            assert_raises(ProgrammingError, get_stats, u'resource')
+
+    def test_delete_stats_keeps_population_time(self):
+        '''Test the time the geometries were populated is kept when the statistics are
+        discarded'''
+        engine = create_engine(u'sqlite://')
+        with patch(u'ckanext.tiledmap.lib.stats._get_engine',
+                   lambda write=False: engine), \
+                patch(u'ckanext.tiledmap.lib.stats._table_created', False):
+            record_populated(u'resource')
+            populated = get_populated(u'resource')
+            assert_true(populated is not None)
+            assert_equal(get_stats(u'resource'), None)
+            with engine.begin() as connection:
+                _upsert(connection, u'resource', {
+                    u'total_count': 3,
+                    u'geom_count': 2,
+                    u'updated': datetime.datetime.utcnow()
+                    })
+            assert_equal(get_stats(u'resource')[u'geom_count'], 2)
+            delete_stats(u'resource')
+            assert_equal(get_stats(u'resource'), None)
+            assert_equal(get_populated(u'resource'), populated)
+            assert_equal(get_populated(u'other'), None)
@@ -4,13 +4,26 @@
 # This file is part of ckanext-map
 # Created by the Natural History Museum in London, UK
 
+import csv
 import json
+import shutil
+import tempfile
+import threading
 import urllib
+from StringIO import StringIO
 
 import nose
 from ckanext.tiledmap.config import config as tm_config
+from ckanext.tiledmap.lib.maintenance import refresh_resource, reorder_resource
+from ckanext.tiledmap.lib.render import numpy
+from ckanext.tiledmap.lib.sidetable import drop_side_table
+from ckanext.tiledmap.lib.slowlog import explain
+from ckanext.tiledmap.lib.stub_renderer import StubRenderer, TILE_PNG
+from ckanext.tiledmap.lib.tile_cache import EMPTY_GRID, TRANSPARENT_PNG
+from ckanext.tiledmap.lib.timing import MemorySink, set_sink
 from mock import patch
-from nose.tools import assert_equal, assert_in, assert_true
+from nose.tools import assert_equal, assert_false, assert_in, assert_not_in, \
+    assert_raises, assert_true
 
 from ckan import model
 from ckan.lib.create_test_data import CreateTestData
@@ -203,6 +216,7 @@ class TestTileFetching(helpers.FunctionalTestBase):
         assert_true(values[u'geospatial'])
         assert_equal(values[u'geom_count'], 2)
         assert_equal(values[u'fetch_id'], u'44')
+        assert_equal(values[u'counts_estimated'], False)
         assert_in(u'initial_zoom', values)
         assert_in(u'tile_layer', values)
         assert_equal(values[u'bounds'], [[-15, -11], [48, 23]])
@@ -217,3 +231,503 @@ class TestTileFetching(helpers.FunctionalTestBase):
             assert_in(plugin, values[u'plugin_options'])
         assert_in(u'template', values[u'plugin_options'][u'pointInfo'])
         assert_in(u'template', values[u'plugin_options'][u'tooltipInfo'])
+
+    def test_map_info_prepared(self):
+        '''Test map-info requests with the same filter shape share a prepared
+        statement, but get the counts of their own values'''
+        counts = []
+        for value in [u'hello', u'all your bases', u'hello']:
+            res = self.app.get(
+                '/map-info?resource_id={resource_id}&view_id={view_id}'
+                '&filters={filters}'.format(
+                    resource_id=TestTileFetching.resource[u'resource_id'],
+                    view_id=TestTileFetching.resource_view[u'id'],
+                    filters=urllib.quote_plus(u'some_field_1:' + value)
+                    ))
+            values = json.loads(res.body)
+            counts.append((values[u'total_count'], values[u'geom_count']))
+        assert_equal(counts, [(3, 2), (1, 1), (3, 2)])
+
+    def test_map_info_invalid(self):
+        '''Test map-info rejects malformed geometries, values of the wrong type and
+        fetch ids that don't fit in a bigint'''
+        url = '/map-info?resource_id={resource_id}&view_id={view_id}'.format(
+            resource_id=TestTileFetching.resource[u'resource_id'],
+            view_id=TestTileFetching.resource_view[u'id'])
+        for filters in [u'_tmgeom:POLYGON((-20 -20, -20 0', u'id:hello']:
+            self.app.get(url + '&filters=' + urllib.quote_plus(filters), status=400)
+        self.app.get(url + '&fetch_id=' + u'9' * 19, status=400)
+
+    def test_map_info_timing(self):
+        '''Test the phases of map-info requests are timed, and returned in a
+        Server-Timing header when enabled'''
+        sink = MemorySink()
+        set_sink(sink)
+        try:
+            url = '/map-info?resource_id={resource_id}&view_id={view_id}'.format(
+                resource_id=TestTileFetching.resource[u'resource_id'],
+                view_id=TestTileFetching.resource_view[u'id'])
+            res = self.app.get(url)
+            assert_false(u'Server-Timing' in res.headers)
+            for name in [u'map.resource_show', u'map.resource_view_show',
+                         u'map.templates', u'map.extent', u'map.serialise']:
+                assert_in(name, sink.names())
+            tm_config[u'tiledmap.timing.header'] = u'true'
+            res = self.app.get(url)
+            assert_in(u'map.extent;dur=', res.headers[u'Server-Timing'])
+        finally:
+            set_sink(None)
+
+    def test_map_info_slowlog(self):
+        '''Test the slow queries of map-info requests are logged, and their plans
+        captured, including for prepared statements'''
+        tm_config.update({
+            u'tiledmap.slowlog.threshold': u'0.000001',
+            u'tiledmap.slowlog.explain_sample': u'1'
+            })
+        with patch(u'ckanext.tiledmap.lib.slowlog.log') as log, \
+                patch(u'ckanext.tiledmap.lib.slowlog._queue_explain') as queue_explain:
+            self.app.get(
+                '/map-info?resource_id={resource_id}&view_id={view_id}'
+                '&filters={filters}'.format(
+                    resource_id=TestTileFetching.resource[u'resource_id'],
+                    view_id=TestTileFetching.resource_view[u'id'],
+                    filters=urllib.quote_plus(u'some_field_1:hello')
+                    ))
+        assert_true(any(TestTileFetching.resource[u'resource_id'] in call[0]
+                        for call in log.warning.call_args_list))
+        plans = []
+        for call in queue_explain.call_args_list:
+            engine, query_id, statement, sql, parameters, analyze = call[0]
+            if statement.startswith(u'EXECUTE'):
+                assert_true(analyze)
+                plans.append(explain(engine, statement, sql, parameters, analyze))
+            elif u'set_config' in statement:
+                # Statements with side effects are not run again
+                assert_false(analyze)
+        assert_true(plans)
+        assert_in(u'Execution', plans[0])
+
+    def test_performance(self):
+        '''Test sysadmins get the performance figures of the resources with a tiled map
+        view, including the latencies of the map-info requests'''
+        resource_id = TestTileFetching.resource[u'resource_id']
+        self.app.get('/map-info?resource_id={resource_id}&view_id={view_id}'.format(
+            resource_id=resource_id, view_id=TestTileFetching.resource_view[u'id']))
+        tiledmap_performance = toolkit.get_action(u'tiledmap_performance')
+        resources = tiledmap_performance(TestTileFetching.context, {
+            u'resource_ids': [resource_id]
+            })
+        assert_equal(len(resources), 1)
+        assert_equal(resources[0][u'resource_id'], resource_id)
+        assert_in(TestTileFetching.resource_view[u'id'], resources[0][u'view_ids'])
+        assert_true(resources[0][u'spatial_index'])
+        assert_true(resources[0][u'table_size'] > 0)
+        assert_true(resources[0][u'geom_count'] <= resources[0][u'row_count'])
+        assert_true(resources[0][u'geometries_populated'])
+        assert_true(resources[0][u'map_info_p50_ms'] > 0)
+        with assert_raises(toolkit.NotAuthorized):
+            tiledmap_performance({
+                u'user': u'annafan',
+                u'ignore_auth': False
+                }, {})
+        res = self.app.get('/ckan-admin/tiledmap', extra_environ={
+            u'REMOTE_USER': str(TestTileFetching.context[u'user'])
+            })
+        assert_in(resource_id, res.body)
+
+    def test_map_info_estimated_counts(self):
+        '''Test the map-info controller estimates counts when configured to'''
+        tm_config.update({
+            u'tiledmap.count.estimate': u'true',
+            u'tiledmap.count.exact_threshold': u'0'
+            })
+        res = self.app.get(
+            '/map-info?resource_id={resource_id}&view_id={view_id}'.format(
+                resource_id=TestTileFetching.resource[u'resource_id'],
+                view_id=TestTileFetching.resource_view[u'id']
+                ))
+        values = json.loads(res.body)
+        assert_true(values[u'geospatial'])
+        assert_true(values[u'counts_estimated'])
+        assert_true(values[u'geom_count'] <= values[u'total_count'])
+
+    def _export(self, file_format, filters, status=200):
+        '''Request an export of the test resource
+
+        :param file_format: the export format
+        :param filters: the filters, formatted as per resource view URLs
+        :param status: the expected status of the response (Default value = 200)
+
+        '''
+        return self.app.get(
+            '/map-export.{file_format}?resource_id={resource_id}&view_id={view_id}'
+            '&filters={filters}'.format(
+                file_format=file_format,
+                resource_id=TestTileFetching.resource[u'resource_id'],
+                view_id=TestTileFetching.resource_view[u'id'],
+                filters=urllib.quote_plus(filters)
+                ), status=status)
+
+    def test_export(self):
+        '''Test the export action streams the matching records in each format'''
+        filters = u'some_field_1:hello'
+        res = self._export(u'csv', filters)
+        rows = list(csv.DictReader(StringIO(res.body)))
+        assert_equal(sorted(int(row[u'id']) for row in rows), [1, 2, 3])
+        res = self._export(u'ndjson', filters)
+        records = [json.loads(line) for line in res.body.splitlines()]
+        assert_equal(sorted(r[u'id'] for r in records), [1, 2, 3])
+        res = self._export(u'geojson', filters)
+        features = json.loads(res.body)[u'features']
+        assert_equal(len(features), 3)
+        assert_equal(len([f for f in features if f[u'geometry']]), 2)
+
+    def test_export_selection(self):
+        '''Test the export action only includes records within the drawn selection'''
+        filters = u'some_field_1:hello|_tmgeom:POLYGON((-20 -20, -20 0, 0 0, 0 -20, ' \
+                  u'-20 -20))'
+        res = self._export(u'geojson', filters)
+        features = json.loads(res.body)[u'features']
+        assert_equal(len(features), 1)
+        assert_equal(features[0][u'properties'][u'id'], 1)
+        assert_equal(features[0][u'geometry'][u'coordinates'], [-11, -15])
+
+    def test_export_invalid_filters(self):
+        '''Test the export action rejects malformed geometries and values of the wrong
+        type before it starts streaming'''
+        self._export(u'csv', u'_tmgeom:POLYGON((-20 -20, -20 0', status=400)
+        self._export(u'geojson', u'id:hello', status=400)
+
+    def test_export_invalid_format(self):
+        '''Test the export action rejects unknown formats'''
+        self.app.get(
+            '/map-export.xls?resource_id={resource_id}&view_id={view_id}'.format(
+                resource_id=TestTileFetching.resource[u'resource_id'],
+                view_id=TestTileFetching.resource_view[u'id']
+                ), status=400)
+
+    def _tile_proxy(self, **kwargs):
+        '''Start a stub renderer and enable the tile proxy
+
+        :param kwargs: parameters of the stub renderer
+        :returns: the stub renderer, which must be stopped by the caller
+
+        '''
+        renderer = StubRenderer(**kwargs)
+        renderer.start()
+        tm_config.update({
+            u'tiledmap.tile_proxy': u'true',
+            u'tiledmap.windshaft.host': renderer.host,
+            u'tiledmap.windshaft.port': unicode(renderer.port)
+            })
+        return renderer
+
+    def test_map_info_tile_proxy(self):
+        '''Test the map-info controller points the map at the tile proxy when enabled'''
+        tm_config.update({
+            u'tiledmap.tile_proxy': u'true'
+            })
+        res = self.app.get(
+            '/map-info?resource_id={resource_id}&view_id={view_id}'.format(
+                resource_id=TestTileFetching.resource[u'resource_id'],
+                view_id=TestTileFetching.resource_view[u'id']
+                ))
+        style = json.loads(res.body)[u'map_styles'][u'plot']
+        assert_equal(style[u'tile_source'][u'url'], u'/map-tile/{z}/{x}/{y}.png')
+        assert_equal(style[u'grid_source'][u'url'], u'/map-grid/{z}/{x}/{y}.grid.json')
+        for source in [u'tile_source', u'grid_source']:
+            assert_equal(style[source][u'params'][u'resource_id'],
+                         TestTileFetching.resource[u'resource_id'])
+            assert_equal(style[source][u'params'][u'view_id'],
+                         TestTileFetching.resource_view[u'id'])
+
+    def test_map_info_tile_session(self):
+        '''Test proxied tile URLs only carry the client session when the render pool
+        is enabled, so they can otherwise be cached across clients'''
+        url = '/map-info?resource_id={resource_id}&view_id={view_id}' \
+              '&session=abc'.format(
+            resource_id=TestTileFetching.resource[u'resource_id'],
+            view_id=TestTileFetching.resource_view[u'id'])
+        tm_config.update({
+            u'tiledmap.tile_proxy': u'true'
+            })
+        style = json.loads(self.app.get(url).body)[u'map_styles'][u'plot']
+        assert_not_in(u'session', style[u'tile_source'][u'params'])
+        tm_config.update({
+            u'tiledmap.render_pool.processes': u'1'
+            })
+        style = json.loads(self.app.get(url).body)[u'map_styles'][u'plot']
+        assert_equal(style[u'tile_source'][u'params'][u'session'], u'abc')
+
+    def test_tile_proxy(self):
+        '''Test tiles are streamed from the renderer when the tile proxy is enabled'''
+        renderer = self._tile_proxy()
+        try:
+            res = self.app.get(
+                '/map-tile/2/1/3.png?resource_id={resource_id}&view_id={view_id}'
+                '&style=plot&filters={filters}'.format(
+                    resource_id=TestTileFetching.resource[u'resource_id'],
+                    view_id=TestTileFetching.resource_view[u'id'],
+                    filters=urllib.quote_plus(u'some_field_1:hello')
+                    ))
+            assert_equal(res.body, TILE_PNG)
+            assert_equal(res.headers[u'Content-Type'], u'image/png')
+            res = self.app.get(
+                '/map-grid/2/1/3.grid.json?resource_id={resource_id}&view_id={'
+                'view_id}'.format(
+                    resource_id=TestTileFetching.resource[u'resource_id'],
+                    view_id=TestTileFetching.resource_view[u'id']
+                    ))
+            assert_in(u'grid', json.loads(res.body))
+        finally:
+            renderer.stop()
+        assert_equal(len(renderer.requests), 2)
+        path, params = renderer.requests[0]
+        assert_true(path.endswith(u'/table/{0}/2/1/3.png'.format(
+            TestTileFetching.resource[u'resource_id'])))
+        assert_equal(params[u'style'], [u'plot'])
+        assert_equal(params[u'filters'], [u'some_field_1:hello'])
+        assert_true(u'resource_id' not in params)
+        assert_true(u'view_id' not in params)
+
+    def test_tile_proxy_coalesced(self):
+        '''Test concurrent requests for the same tile make a single renderer request,
+        and all get the tile'''
+        renderer = self._tile_proxy(delay=0.5)
+        url = '/map-tile/1/0/1.png?resource_id={resource_id}&view_id={view_id}' \
+              '&style=plot&filters={filters}'.format(
+                resource_id=TestTileFetching.resource[u'resource_id'],
+                view_id=TestTileFetching.resource_view[u'id'],
+                filters=urllib.quote_plus(u'some_field_1:hello'))
+        bodies = []
+
+        def request():
+            bodies.append(self.app.get(url).body)
+
+        threads = [threading.Thread(target=request) for i in range(5)]
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            renderer.stop()
+        assert_equal(bodies, [TILE_PNG] * 5)
+        assert_equal(len(renderer.requests), 1)
+
+    def test_tile_proxy_errors(self):
+        '''Test placeholders are served when the renderer fails or can't be reached,
+        and the map reports degraded mode once the renderer's circuit has opened'''
+        url = '/map-tile/0/0/0.png?resource_id={resource_id}&view_id={view_id}'.format(
+            resource_id=TestTileFetching.resource[u'resource_id'],
+            view_id=TestTileFetching.resource_view[u'id']
+            )
+        renderer = self._tile_proxy(status=500)
+        try:
+            res = self.app.get(url)
+        finally:
+            renderer.stop()
+        assert_equal(res.body, TRANSPARENT_PNG)
+        assert_in(u'Warning', res.headers)
+        for i in range(int(tm_config[u'tiledmap.circuit.max_failures'])):
+            assert_equal(self.app.get(url).body, TRANSPARENT_PNG)
+        res = self.app.get(
+            '/map-info?resource_id={resource_id}&view_id={view_id}'.format(
+                resource_id=TestTileFetching.resource[u'resource_id'],
+                view_id=TestTileFetching.resource_view[u'id']
+                ))
+        assert_true(json.loads(res.body)[u'degraded'])
+
+    def test_tile_proxy_stale_tiles(self):
+        '''Test the last cached tile is served when the renderer can't be reached'''
+        cache_dir = tempfile.mkdtemp()
+        tm_config.update({
+            u'tiledmap.tile_cache.dir': cache_dir,
+            u'tiledmap.tile_cache.ttl': u'0'
+            })
+        url = '/map-grid/1/0/1.grid.json?resource_id={resource_id}&view_id={' \
+              'view_id}'.format(
+                resource_id=TestTileFetching.resource[u'resource_id'],
+                view_id=TestTileFetching.resource_view[u'id']
+                )
+        renderer = self._tile_proxy()
+        try:
+            fresh = self.app.get(url)
+            assert_true(u'Warning' not in fresh.headers)
+        finally:
+            renderer.stop()
+        try:
+            stale = self.app.get(url)
+            assert_equal(stale.body, fresh.body)
+            assert_in(u'Warning', stale.headers)
+            # Tiles rendered with other parameters are not served in their place
+            other = self.app.get(url + '&style=gridded')
+            assert_equal(other.body, EMPTY_GRID)
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_tile_proxy_disabled(self):
+        '''Test tiles are not served when the tile proxy is disabled'''
+        self.app.get(
+            '/map-tile/0/0/0.png?resource_id={resource_id}&view_id={view_id}'.format(
+                resource_id=TestTileFetching.resource[u'resource_id'],
+                view_id=TestTileFetching.resource_view[u'id']
+                ), status=404)
+
+    def test_map_info_multiple_renderers(self):
+        '''Test the map-info controller spreads tiles over the configured renderers'''
+        tm_config.update({
+            u'tiledmap.windshaft.hosts': u'127.0.0.1:4000 127.0.0.2:4000'
+            })
+        res = self.app.get(
+            '/map-info?resource_id={resource_id}&view_id={view_id}'.format(
+                resource_id=TestTileFetching.resource[u'resource_id'],
+                view_id=TestTileFetching.resource_view[u'id']
+                ))
+        style = json.loads(res.body)[u'map_styles'][u'plot']
+        for source in [u'tile_source', u'grid_source']:
+            assert_true(style[source][u'url'].startswith(u'http://{s}/database/'))
+            assert_equal(style[source][u'subdomains'],
+                         [u'127.0.0.1:4000', u'127.0.0.2:4000'])
+
+    def test_tile_proxy_failover(self):
+        '''Test tiles are served by another renderer when a renderer is down'''
+        renderers = [StubRenderer(), StubRenderer()]
+        for renderer in renderers:
+            renderer.start()
+        tm_config.update({
+            u'tiledmap.tile_proxy': u'true',
+            u'tiledmap.windshaft.hosts': u' '.join(
+                u'{0}:{1}'.format(r.host, r.port) for r in renderers)
+            })
+        urls = [
+            '/map-tile/3/{x}/{y}.png?resource_id={resource_id}&view_id={view_id}'.format(
+                x=x,
+                y=y,
+                resource_id=TestTileFetching.resource[u'resource_id'],
+                view_id=TestTileFetching.resource_view[u'id']
+                ) for x in range(4) for y in range(4)]
+        try:
+            for url in urls:
+                self.app.get(url)
+            # Both renderers got a share of the tiles
+            assert_true(renderers[0].requests)
+            assert_true(renderers[1].requests)
+            renderers[0].stop()
+            for url in urls:
+                assert_equal(self.app.get(url).body, TILE_PNG)
+            assert_equal(len(renderers[1].requests), 2 * len(urls) - len(
+                renderers[0].requests))
+        finally:
+            renderers[1].stop()
+
+    def test_tile_proxy_empty_tiles(self):
+        '''Test empty tiles of unfiltered maps are answered without calling the
+        renderer'''
+        url = '/map-tile/3/{x}/{y}.png?resource_id={resource_id}&view_id={view_id}'
+        renderer = self._tile_proxy()
+        try:
+            # The south east corner of the world has no records
+            res = self.app.get(url.format(
+                x=7, y=7,
+                resource_id=TestTileFetching.resource[u'resource_id'],
+                view_id=TestTileFetching.resource_view[u'id']
+                ))
+            assert_equal(res.body, TRANSPARENT_PNG)
+            assert_equal(len(renderer.requests), 0)
+            # Tiles with records are rendered
+            res = self.app.get(url.format(
+                x=4, y=2,
+                resource_id=TestTileFetching.resource[u'resource_id'],
+                view_id=TestTileFetching.resource_view[u'id']
+                ))
+            assert_equal(res.body, TILE_PNG)
+            assert_equal(len(renderer.requests), 1)
+            # Filtered maps are always rendered
+            res = self.app.get(url.format(
+                x=7, y=7,
+                resource_id=TestTileFetching.resource[u'resource_id'],
+                view_id=TestTileFetching.resource_view[u'id']
+                ) + '&filters=some_field_1%3Ahello')
+            assert_equal(res.body, TILE_PNG)
+            assert_equal(len(renderer.requests), 2)
+        finally:
+            renderer.stop()
+
+    def test_side_table(self):
+        '''Test tiles and counts of maps filtered by the drawn selection only are
+        computed from the side table when it is enabled'''
+        resource_id = TestTileFetching.resource[u'resource_id']
+        tm_config.update({
+            u'tiledmap.side_table': u'true'
+            })
+        refresh_resource(resource_id)
+        url = '/map-tile/3/4/2.png?resource_id={resource_id}&view_id={view_id}'.format(
+            resource_id=resource_id,
+            view_id=TestTileFetching.resource_view[u'id']
+            )
+        selection = urllib.quote_plus(
+            u'_tmgeom:POLYGON((-180 -90, 180 -90, 180 90, -180 90, -180 -90))')
+        renderer = self._tile_proxy()
+        try:
+            self.app.get(url + '&filters=' + selection)
+            self.app.get(url + '&filters=some_field_1%3Ahello')
+            res = self.app.get(
+                '/map-info?resource_id={resource_id}&view_id={view_id}'
+                '&filters={filters}'.format(
+                    resource_id=resource_id,
+                    view_id=TestTileFetching.resource_view[u'id'],
+                    filters=selection
+                    ))
+        finally:
+            renderer.stop()
+            drop_side_table(resource_id)
+        assert_true(renderer.requests[0][0].endswith(
+            u'/table/{0}_tiledmap/3/4/2.png'.format(resource_id)))
+        # Other filters need columns the side table doesn't have
+        assert_true(renderer.requests[1][0].endswith(
+            u'/table/{0}/3/4/2.png'.format(resource_id)))
+        info = json.loads(res.body)
+        assert_equal(info[u'total_count'], 3)
+        assert_equal(info[u'geom_count'], 3)
+
+    def test_builtin_grid(self):
+        '''Test UTFGrid tiles of unfiltered plot maps are built from the point store
+        when the builtin renderer is enabled, with one record per cell'''
+        if numpy is None:
+            raise nose.SkipTest(u'numpy is not installed')
+        resource_id = TestTileFetching.resource[u'resource_id']
+        directory = tempfile.mkdtemp()
+        tm_config.update({
+            u'tiledmap.point_store.dir': directory,
+            u'tiledmap.renderer': u'builtin'
+            })
+        renderer = self._tile_proxy()
+        try:
+            refresh_resource(resource_id)
+            res = self.app.get(
+                '/map-grid/0/0/0.grid.json?resource_id={resource_id}&view_id={view_id}'
+                '&style=plot'.format(resource_id=resource_id,
+                                     view_id=TestTileFetching.resource_view[u'id']))
+        finally:
+            renderer.stop()
+            shutil.rmtree(directory)
+        assert_equal(len(renderer.requests), 0)
+        grid = json.loads(res.body)
+        assert_equal(len(grid[u'grid']), 64)
+        assert_equal(len(grid[u'keys']), 4)
+        records = sorted(grid[u'data'].values(), key=lambda r: r[u'_id'])
+        assert_equal([r[u'some_field_2'] for r in records],
+                     [u'world', u'again', u'are belong to us'])
+        assert_equal(records[1][u'_tiledmap_count'], 1)
+        assert_true(abs(records[1][u'_tiledmap_lat'] - 48) < 1e-6)
+        assert_true(records[1][u'_tiledmap_grid_bbox'].startswith(u'POLYGON(('))
+
+    def test_reorder_resource(self):
+        '''Test tables are reordered by Hilbert key, and skipped once they are'''
+        resource_id = TestTileFetching.resource[u'resource_id']
+        assert_true(reorder_resource(resource_id, force=True))
+        assert_false(reorder_resource(resource_id))
+        # Map queries still work on the reordered table
+        self.test_map_info()
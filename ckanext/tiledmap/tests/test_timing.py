@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-map
+# Created by the Natural History Museum in London, UK
+
+import socket
+import time
+
+from ckanext.tiledmap.lib.timing import MemorySink, StatsdSink, set_sink, span, \
+    start_recording, stop_recording
+from nose.tools import assert_equal, assert_is_none, assert_raises, assert_true
+
+
+class TestTiming(object):
+    '''Test cases for the timing spans'''
+
+    def setup(self):
+        self.sink = MemorySink()
+        set_sink(self.sink)
+
+    def teardown(self):
+        set_sink(None)
+        stop_recording()
+
+    def test_span(self):
+        '''Test spans are emitted to the sink, including when they raise'''
+        with span(u'a'):
+            time.sleep(0.05)
+        with assert_raises(ValueError):
+            with span(u'b'):
+                raise ValueError()
+        assert_equal(self.sink.names(), [u'a', u'b'])
+        assert_true(0.05 <= self.sink.spans[0][1] < 1)
+
+    def test_recording(self):
+        '''Test the spans of the current thread are recorded between
+        start_recording and stop_recording, and formatted as a Server-Timing header'''
+        with span(u'before'):
+            pass
+        timings = start_recording()
+        with span(u'map.extent'):
+            pass
+        with span(u'invalid name'):
+            pass
+        assert_equal(stop_recording(), timings)
+        with span(u'after'):
+            pass
+        assert_is_none(stop_recording())
+        assert_equal([name for name, duration in timings.spans],
+                     [u'map.extent', u'invalid name'])
+        assert_true(timings.header().startswith(u'map.extent;dur='))
+        assert_true(u', invalid_name;dur=' in timings.header())
+
+    def test_statsd(self):
+        '''Test spans are sent to StatsD as timers'''
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server.bind((u'127.0.0.1', 0))
+        server.settimeout(5)
+        try:
+            set_sink(StatsdSink(u'127.0.0.1', server.getsockname()[1], u'tiledmap'))
+            with span(u'map.extent'):
+                pass
+            metric = server.recv(1024)
+            assert_true(metric.startswith(b'tiledmap.map.extent:'))
+            assert_true(metric.endswith(b'|ms'))
+        finally:
+            server.close()
@@ -0,0 +1,27 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-map
+# Created by the Natural History Museum in London, UK
+
+from ckanext.tiledmap.lib.utfgrid import cell_bbox, encode_key, lon_lat
+from nose.tools import assert_equal, assert_true
+
+
+class TestUTFGrid(object):
+    '''Test cases for the UTFGrid tiles of the builtin renderer'''
+
+    def test_encode_key(self):
+        '''Test keys skip the characters that must be escaped in JSON'''
+        assert_equal([encode_key(i) for i in range(4)], [u' ', u'!', u'#', u'$'])
+        assert_equal(encode_key(59), u']')
+
+    def test_cell_bbox(self):
+        '''Test cell bounds are given in WGS84'''
+        assert_equal(lon_lat(0, 0), (0, 0))
+        bbox = cell_bbox(0, 0, 0, 32, 32, 4)
+        corners = [[float(c) for c in point.split()]
+                   for point in bbox[len(u'POLYGON(('):-2].split(u', ')]
+        assert_equal(corners[0], [0, 0])
+        assert_true(abs(corners[2][0] - 360.0 / 64) < 1e-9)
+        assert_true(corners[2][1] < 0)
@@ -5,6 +5,7 @@
 # Created by the Natural History Museum in London, UK
 
 import nose
+from ckanext.tiledmap.lib.stats import get_stats
 from mock import patch
 from nose.tools import assert_equal, assert_raises, assert_true
 from pylons import config
@@ -322,6 +323,33 @@ class TestViewCreated(helpers.FunctionalTestBase):
         data_dict[u'utf_grid_title'] = u'_id'
         resource_view = resource_view_update(TestViewCreated.context, data_dict)
 
+    @patch(u'ckan.lib.helpers.flash')
+    def test_create_view_action_stats(self, flash_mock):
+        '''Test the create view action computes the resource statistics, and that they
+        are discarded when the records change
+
+        :param flash_mock: 
+
+        '''
+        resource_view_create = toolkit.get_action(u'resource_view_create')
+        datastore_upsert = toolkit.get_action(u'datastore_upsert')
+        data_dict = dict(self.base_data_dict.items())
+        resource_view_create(TestViewCreated.context, data_dict)
+        stats = get_stats(self.resource[u'resource_id'])
+        assert_equal(stats[u'total_count'], 2)
+        assert_equal(stats[u'geom_count'], 2)
+        assert_equal(stats[u'bounds'], ((-11, -15), (23, 48)))
+        datastore_upsert(TestViewCreated.context, {
+            u'resource_id': self.resource[u'resource_id'],
+            u'method': u'upsert',
+            u'records': [{
+                u'id': 3,
+                u'latitude': 12,
+                u'longitude': 12
+                }]
+            })
+        assert_equal(get_stats(self.resource[u'resource_id']), None)
+
     def test_delete_view_action(self):
         '''Test the delete view action directly'''
         # There is nothing to test because the action doesn't currently do anything.
@@ -123,16 +123,22 @@ my.CkanFilterUrl = function(input_url){
   /**
    * get_filters
    *
-   * Returns the filter query string alone (not encoded)
+   * Returns the filter query string alone (not encoded), in canonical form: fields sorted by name and
+   * values sorted and de-duplicated, so equivalent filters always produce the same URLs (and hit the same
+   * server side caches).
    */
   this.get_filters = function(){
     if (typeof this.qs['filters'] === 'undefined'){
       return '';
     }
     var b_filter = [];
-    for (var f in this.qs['filters']){
-      for (var i = 0; i < this.qs['filters'][f].length; i++){
-        b_filter.push(f + ':' + this.qs['filters'][f][i]);
+    var names = Object.keys(this.qs['filters']).sort();
+    for (var n = 0; n < names.length; n++){
+      var values = this.qs['filters'][names[n]].slice().sort();
+      for (var i = 0; i < values.length; i++){
+        if (i == 0 || values[i] !== values[i - 1]){
+          b_filter.push(names[n] + ':' + values[i]);
+        }
       }
     }
     return b_filter.join('|')
@@ -20,6 +20,8 @@ this.tiledmap = this.tiledmap || {};
       this.map_ready = false;
       this.visible = true;
       this.fetch_count = 0;
+      // Identifies this map's requests, so the server can cancel superseded queries
+      this.session_id = Math.random().toString(36).substr(2) + new Date().getTime().toString(36);
       this.resource_id = this.options.resource_id;
       this.view_id = this.options.view_id;
       this.filters = this.options.filters;
@@ -106,17 +108,48 @@ this.tiledmap = this.tiledmap || {};
     updateRecordCounter: function(){
       var $rri = $('.tiled-map-info', this.el);
       var template = [
-        'Displaying <span class="doc-count">{{geoRecordCount}}</span>',
+        'Displaying <span class="doc-count">{{#estimated}}&asymp;{{/estimated}}{{geoRecordCount}}</span>',
         ' of ',
-        '</span><span class="doc-count">{{recordCount}}</span>',
-        'records'
+        '</span><span class="doc-count">{{#estimated}}&asymp;{{/estimated}}{{recordCount}}</span>',
+        'records',
+        '{{#degraded}}<span class="tiled-map-degraded">(the map may be out of date)</span>{{/degraded}}',
+        '<span class="tiled-map-export">Download:',
+        '<a href="{{csvUrl}}" target="_blank">CSV</a>',
+        '<a href="{{geojsonUrl}}" target="_blank">GeoJSON</a>',
+        '<a href="{{ndjsonUrl}}" target="_blank">NDJSON</a>',
+        '</span>'
       ].join(' ');
       $rri.html(Mustache.render(template, {
         recordCount: this.map_info.total_count ? this.map_info.total_count.toString() : '0',
-        geoRecordCount: this.map_info.geom_count ? this.map_info.geom_count.toString() : '0'
+        geoRecordCount: this.map_info.geom_count ? this.map_info.geom_count.toString() : '0',
+        estimated: !!this.map_info.counts_estimated,
+        degraded: !!this.map_info.degraded,
+        csvUrl: this._exportUrl('csv'),
+        geojsonUrl: this._exportUrl('geojson'),
+        ndjsonUrl: this._exportUrl('ndjson')
       }));
     },
 
+    /**
+     * Return the URL used to export the records matching the current filters and
+     * selection in the given format (one of csv, geojson or ndjson)
+     */
+    _exportUrl: function(format){
+      var params = {
+        resource_id: this.resource_id,
+        view_id: this.view_id
+      };
+      var filters = new my.CkanFilterUrl().set_filters(this.filters.fields);
+      if (this.filters.geom) {
+        filters.set_filter('_tmgeom', Terraformer.WKT.convert(this.filters.geom))
+      }
+      params['filters'] = filters.get_filters();
+      if (this.filters.q) {
+        params['q'] = this.filters.q;
+      }
+      return ckan.SITE_ROOT + '/map-export.' + format + '?' + $.param(params);
+    },
+
     /**
      * Hide the map.
      *
@@ -240,7 +273,8 @@ this.tiledmap = this.tiledmap || {};
       var params = {
         resource_id: this.resource_id,
         view_id: this.view_id,
-        fetch_id: this.fetch_count
+        fetch_id: this.fetch_count,
+        session: this.session_id
       };
 
       var filters = new my.CkanFilterUrl().set_filters(this.filters.fields);
@@ -297,6 +331,34 @@ this.tiledmap = this.tiledmap || {};
       });
     },
 
+    /**
+     * _backOff
+     *
+     * Called while the tile renderer is degraded. The UTFGrid layer is not loaded, and
+     * the map info is fetched again after an increasing delay until the renderer has
+     * recovered, at which point the map is redrawn.
+     */
+    _backOff: function(){
+      if (this.backoff_timer) {
+        return;
+      }
+      this.backoff_delay = Math.min((this.backoff_delay || 2500) * 2, 120000);
+      this.backoff_timer = setTimeout($.proxy(function(){
+        this.backoff_timer = null;
+        this._fetchMapInfo($.proxy(function(info){
+          this.map_info = info;
+          this.map_info.draw = true;
+          this.updateRecordCounter();
+          if (info.degraded) {
+            this._backOff();
+          } else {
+            this.backoff_delay = null;
+            this.redraw();
+          }
+        }, this), $.proxy(this._backOff, this));
+      }, this), this.backoff_delay);
+    },
+
     /**
      * setGeom
      *
@@ -345,6 +407,9 @@ this.tiledmap = this.tiledmap || {};
       if (!this.map_ready || !this.map_info.draw) {
         return;
       }
+      if (this.map_info.degraded) {
+        this._backOff();
+      }
       // Setup tile request parameters
       var params = {};
       var filters = new my.CkanFilterUrl().set_filters(this.filters.fields);
@@ -372,23 +437,31 @@ this.tiledmap = this.tiledmap || {};
       }
       this._removeAllLayers();
       this._addLayer('selection', L.geoJson(this.filters.geom));
-      this._addLayer('plot', L.tileLayer(tile_url, {
+      var tile_options = {
         noWrap: !this.map_info.repeat_map
-      }));
+      };
+      if (style.tile_source.subdomains) {
+        tile_options.subdomains = style.tile_source.subdomains;
+      }
+      this._addLayer('plot', L.tileLayer(tile_url, tile_options));
 
-      if (style.has_grid) {
+      if (style.has_grid && !this.map_info.degraded) {
         var grid_params = $.extend({}, params);
         if (style.grid_source.params) {
           grid_params = $.extend(grid_params, style.grid_source.params);
         }
         var grid_url = style.grid_source.url + '?' + $.param(grid_params);
 
-        this._addLayer('grid', new L.UtfGrid(grid_url, {
+        var grid_options = {
           resolution: style.grid_resolution,
           useJsonP: false,
           maxRequests: 4,
           pointerCursor: false
-        }));
+        };
+        if (style.grid_source.subdomains) {
+          grid_options.subdomains = style.grid_source.subdomains;
+        }
+        this._addLayer('grid', new L.UtfGrid(grid_url, grid_options));
       }
       // Ensure that click events on the selection get passed to the map.
       if (typeof this.layers['selection'] !== 'undefined') {
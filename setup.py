@@ -29,6 +29,6 @@ setup(
             [ckan.plugins]
                 tiledmap = ckanext.tiledmap.plugin:TiledMapPlugin
             [paste.paster_command]
-                ckanexttiledmapmap=ckanext.tiledmapmap.commands.add_geom:AddGeomCommand
+                ckanextmap=ckanext.tiledmap.commands.add_geom:AddGeomCommand
         ''',
     )